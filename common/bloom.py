@@ -0,0 +1,269 @@
+""" Bloom filters of the keys already loaded, to resume loads with overlap.
+
+A load that resumes at its last timestamp either reads that timestamp
+again and duplicates the rows that have it, or skips past it and loses
+the rows that share it. Instead, a load can re-read an overlap window and
+drop the records whose key it has loaded before. The keys are remembered
+in Bloom filters, one per day of the records, persisted in the cache.
+
+A Bloom filter never misses a key it was given, but may claim a key it
+was not given, at the filter's error rate. The keys it claims can be
+confirmed against the database in one query, so that no record is ever
+dropped by mistake, and the database is only asked about the overlap.
+
+A load reads its records in time order, so only the filters of the days
+of the current page are held in memory: the days behind it are saved once
+and released. The others are saved every SAVE_INTERVAL and by save() at
+the end of the load.
+
+"""
+
+
+from datetime import date, datetime, timedelta
+from glob import glob
+from hashlib import md5
+from logging import getLogger
+from math import ceil, log as ln
+from os import makedirs, remove, replace
+from os.path import basename, isdir, isfile, join
+from time import time
+
+from numpy import (arange, asarray, bitwise_and, bitwise_or, frombuffer,
+                   left_shift, load, savez, uint8, uint64, zeros)
+from pandas import to_datetime
+
+from common.settings import CACHE_DIR
+
+
+log = getLogger(__name__)
+
+SEEN_KEYS_DIR = join(CACHE_DIR, 'seen')
+
+CAPACITY = 1000000
+ERROR_RATE = 0.001
+MAX_AGE = timedelta(days=30)
+# Seconds between two saves of the filters of a load in progress
+SAVE_INTERVAL = 300
+
+
+class BloomFilter(object):
+    """ A Bloom filter of strings, sized for a capacity and an error rate.
+
+    The bits are a NumPy array and the positions of a key are derived from
+    the two halves of its MD5 digest (double hashing), so adding or
+    checking a batch of keys is a couple of array operations.
+    """
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(ceil(-capacity * ln(error_rate) / ln(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * ln(2))))
+        self.bits = zeros((self.size + 7) // 8, dtype=uint8)
+        self.count = 0
+
+    def __repr__(self):
+        return '<BloomFilter (%s of %s keys, %s hashes)>' % (
+            self.count, self.capacity, self.hashes)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return bool(self.contains([key])[0])
+
+    def _positions(self, keys):
+        digests = b''.join(md5(str(key).encode()).digest() for key in keys)
+        halves = frombuffer(digests, dtype=uint64).reshape(-1, 2)
+        rounds = arange(self.hashes, dtype=uint64)
+        # Wraps around on overflow, which is fine for hashing
+        return (halves[:, :1] + rounds * halves[:, 1:]) % uint64(self.size)
+
+    def add(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+
+        positions = self._positions(keys).ravel()
+        masks = left_shift(uint8(1), (positions % uint64(8)).astype(uint8))
+        bitwise_or.at(self.bits, (positions // uint64(8)).astype(int), masks)
+        self.count += len(keys)
+
+        if self.count > self.capacity:
+            log.warning('%r is over capacity: more false positives', self)
+
+    def contains(self, keys):
+        """ Return a boolean array: False where a key is surely not in the
+        filter, True where it probably is.
+        """
+        keys = list(keys)
+        if not keys:
+            return zeros(0, dtype=bool)
+
+        positions = self._positions(keys)
+        masks = left_shift(uint8(1), (positions % uint64(8)).astype(uint8))
+        bits = self.bits[(positions // uint64(8)).astype(int)]
+        return (bitwise_and(bits, masks) > 0).all(axis=1)
+
+    def save(self, filepath):
+        # Written next to the old file and swapped in when complete
+        savez(filepath + '.tmp.npz', bits=self.bits,
+              header=asarray([self.capacity, self.hashes, self.size,
+                              self.count], dtype='i8'),
+              error_rate=asarray(self.error_rate))
+        replace(filepath + '.tmp.npz', filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        with load(filepath) as arrays:
+            capacity, hashes, size, count = (int(value) for value
+                                             in arrays['header'])
+            bloom = cls(capacity, float(arrays['error_rate']))
+            bloom.bits = arrays['bits']
+            bloom.count = count
+
+        assert (bloom.hashes, bloom.size) == (hashes, size), \
+            'Corrupt Bloom filter %s' % filepath
+        return bloom
+
+
+class SeenKeys(object):
+    """ The keys loaded into a target, in one Bloom filter per day.
+
+    The day of a record is the date of its time field. The filters are
+    loaded from the cache when first needed, saved when the load moves
+    past their day, every SAVE_INTERVAL and by save().
+    """
+
+    def __init__(self, name, directory=SEEN_KEYS_DIR, capacity=CAPACITY,
+                 error_rate=ERROR_RATE):
+        self.name = name
+        self.directory = join(directory, name)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filters = {}
+        self.changed = set()
+        self.saved_at = time()
+
+        if not isdir(self.directory):
+            makedirs(self.directory)
+
+    def __repr__(self):
+        return '<SeenKeys %s (%s)>' % (self.name, self.directory)
+
+    def path(self, day):
+        return join(self.directory, day.isoformat() + '.npz')
+
+    def days(self):
+        """ Return the days with a saved filter. """
+        return sorted(datetime.strptime(basename(filepath)[:10],
+                                        '%Y-%m-%d').date()
+                      for filepath in glob(join(self.directory,
+                                                '????-??-??.npz')))
+
+    def has(self, day):
+        return day in self.filters or isfile(self.path(day))
+
+    def filter(self, day):
+        if day not in self.filters:
+            if isfile(self.path(day)):
+                self.filters[day] = BloomFilter.load(self.path(day))
+            else:
+                self.filters[day] = BloomFilter(self.capacity,
+                                                self.error_rate)
+        return self.filters[day]
+
+    def add(self, keys, timestamps):
+        keys = asarray(keys)
+        days = to_datetime(asarray(timestamps)).date
+
+        for day in set(days):
+            self.filter(day).add(keys[days == day])
+            self.changed.add(day)
+
+    def contains(self, keys, timestamps):
+        keys = asarray(keys)
+        days = to_datetime(asarray(timestamps)).date
+        found = zeros(len(keys), dtype=bool)
+
+        for day in set(days):
+            if self.has(day):
+                rows = days == day
+                found[rows] = self.filter(day).contains(keys[rows])
+
+        return found
+
+    def missing_days(self, start, stop):
+        """ Return the days of [start, stop] without a filter. """
+        day = start.date() if isinstance(start, datetime) else start
+        last = stop.date() if isinstance(stop, datetime) else stop
+        days = []
+
+        while day <= last:
+            if not self.has(day):
+                days.append(day)
+            day += timedelta(days=1)
+
+        return days
+
+    def drop_seen(self, df, key, time_field, confirm=None):
+        """ Return the records of the frame that were not loaded before and
+        remember their keys.
+
+        Where the filters claim a key, confirm(keys) is asked which of them
+        are really loaded (e.g. by the database) and the others are kept.
+        Without confirm, the claimed keys are dropped, false positives
+        included. Duplicates within the frame are dropped as well.
+        """
+        if df.empty:
+            return df
+
+        df = df.drop_duplicates(key, keep='last')
+        keys = df[key].astype(str).values
+        timestamps = df[time_field]
+
+        seen = self.contains(keys, timestamps)
+        claimed = int(seen.sum())
+        if confirm and claimed:
+            loaded = set(confirm(list(keys[seen])))
+            seen[seen] = [k in loaded for k in keys[seen]]
+
+        log.debug('%s: %s of %s keys claimed, %s dropped', self.name, claimed,
+                  len(df), int(seen.sum()))
+
+        # Remembered before they are loaded: if the load fails, confirm
+        # finds them missing and they are loaded next time
+        self.add(keys[~seen], timestamps[~seen])
+
+        self.release(to_datetime(asarray(timestamps)).min().date())
+        if time() - self.saved_at >= SAVE_INTERVAL:
+            self.save()
+
+        return df[~seen]
+
+    def save(self):
+        for day in self.changed:
+            self.filters[day].save(self.path(day))
+        self.changed.clear()
+        self.saved_at = time()
+
+    def release(self, before):
+        """ Save the filters of the days before a day and free them. A day
+        that shows up again is loaded from its file.
+        """
+        for day in [day for day in self.filters if day < before]:
+            if day in self.changed:
+                self.filters[day].save(self.path(day))
+                self.changed.discard(day)
+            del self.filters[day]
+
+    def evict(self, max_age=MAX_AGE):
+        """ Delete the filters of the days older than max_age. """
+        oldest = date.today() - max_age
+        evicted = [day for day in self.days() if day < oldest]
+
+        for day in evicted:
+            remove(self.path(day))
+            self.filters.pop(day, None)
+
+        return evicted
@@ -0,0 +1,117 @@
+""" The log of the delivery changes, for incremental aggregates.
+
+Every batch of the delivery loader records the (fleet, gastronomic day)
+pairs it touches in tableau.delivery_changes, before and after the merge,
+so that the tables aggregated from delivery_dwh can be rebuilt for those
+days only. Each of these aggregates is a consumer of the log: it keeps the
+last change it has rebuilt in tableau.materialization_watermark.
+
+Consumers are registered up front, at change 0, and a change is pruned once
+every registered consumer has seen it.
+
+"""
+
+
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+# The jobs reading tableau.delivery_changes, by watermark name
+CONSUMERS = ('hourly_deliveries', 'restaurant_weekly_delivery')
+
+CREATE_CHANGES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS tableau.delivery_changes (
+    change_id bigserial PRIMARY KEY,
+    fleet_backend_name text,
+    gastronomic_day date,
+    loaded_at timestamp with time zone NOT NULL DEFAULT now()
+);
+"""
+
+# Position of each consumer in tableau.delivery_changes
+CREATE_WATERMARK_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS tableau.materialization_watermark (
+    name text PRIMARY KEY,
+    last_change_id bigint NOT NULL,
+    updated_at timestamp with time zone NOT NULL DEFAULT now()
+);
+"""
+
+# A consumer starts at change 0, so nothing is pruned before its first run
+REGISTER_CONSUMER_SQL = """
+INSERT INTO tableau.materialization_watermark (name, last_change_id)
+SELECT %(name)s, 0
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM tableau.materialization_watermark
+    WHERE name = %(name)s
+);
+"""
+
+# The share lock waits for the loads in flight to commit, so that no change
+# id below the new watermark of a consumer can show up later.
+LOCK_CHANGES_SQL = """
+LOCK TABLE tableau.delivery_changes IN SHARE MODE;
+"""
+
+# The watermark of a consumer and the last change
+GET_WATERMARK_SQL = """
+SELECT coalesce(
+  (SELECT last_change_id
+   FROM tableau.materialization_watermark
+   WHERE name = %s), 0),
+  (SELECT coalesce(max(change_id), 0)
+   FROM tableau.delivery_changes);
+"""
+
+UPDATE_WATERMARK_SQL = """
+UPDATE tableau.materialization_watermark
+SET last_change_id = %(change_id)s,
+    updated_at = now()
+WHERE name = %(name)s;
+
+INSERT INTO tableau.materialization_watermark (name, last_change_id)
+SELECT %(name)s, %(change_id)s
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM tableau.materialization_watermark
+    WHERE name = %(name)s
+);
+"""
+
+# Changes that every consumer has seen are no longer needed. A consumer
+# without a watermark counts as having seen none.
+PRUNE_CHANGES_SQL = """
+DELETE FROM tableau.delivery_changes
+WHERE change_id <= (SELECT min(coalesce(watermark.last_change_id, 0))
+                    FROM unnest(%(consumers)s::text[]) AS consumer (name)
+                    LEFT OUTER JOIN tableau.materialization_watermark
+                    AS watermark
+                    ON watermark.name = consumer.name);
+"""
+
+
+def create_change_tables(conn):
+    """ Create the change log and the watermarks of all its consumers,
+    through a psycopg2 connection.
+    """
+    cur = conn.cursor()
+    cur.execute(CREATE_CHANGES_TABLE_SQL)
+    cur.execute(CREATE_WATERMARK_TABLE_SQL)
+    for name in CONSUMERS:
+        cur.execute(REGISTER_CONSUMER_SQL, {'name': name})
+    conn.commit()
+    cur.close()
+
+    log.debug('Registered the consumers %s', ', '.join(CONSUMERS))
+
+
+def advance_watermark(cur, name, change_id):
+    """ Move the watermark of a consumer and prune the changes that every
+    consumer has seen.
+    """
+    cur.execute(UPDATE_WATERMARK_SQL, {'name': name, 'change_id': change_id})
+    cur.execute(PRUNE_CHANGES_SQL, {'consumers': list(CONSUMERS)})
+    log.debug('%s: watermark at change %s, %s changes pruned', name,
+              change_id, cur.rowcount)
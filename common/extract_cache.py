@@ -0,0 +1,227 @@
+""" A columnar cache for extracted DataFrames.
+
+Each extract is stored in its own folder, one .npy file per column plus a
+JSON file of metadata: the source, the filters, the extraction time and a
+hash of the schema. Fixed width columns (numbers, booleans, datetimes and
+short strings) are memory-mapped when read, and only the columns asked for
+are opened, so reading three columns of a wide extract is cheap. Other
+columns (mixed types, lists, long text) are pickled column by column.
+
+"""
+
+
+import json
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from hashlib import md5
+from logging import getLogger
+from os import getpid, listdir, makedirs, rename
+from os.path import getsize, isdir, isfile, join
+from re import compile as compile_regex
+from shutil import rmtree
+
+from numpy import asarray, load, save
+from pandas import DataFrame, Series
+
+from common.settings import CACHE_DIR
+
+
+log = getLogger(__name__)
+
+FORMAT_VERSION = 1
+EXTRACT_CACHE_DIR = join(CACHE_DIR, 'extracts')
+METADATA_FILE = 'metadata.json'
+SWAP_FOLDER = compile_regex(r'\.(tmp|old)-\d+$')
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# Longer strings are pickled rather than padded to the longest one
+MAX_FIXED_WIDTH = 64
+
+MAX_AGE = timedelta(days=30)
+MAX_BYTES = 2 * 1024 ** 3
+
+
+def schema_hash(df):
+    schema = ','.join('%s:%s' % (column, df[column].dtype)
+                      for column in df.columns)
+    return md5(schema.encode()).hexdigest()
+
+
+class ExtractCache(object):
+    def __init__(self, directory=EXTRACT_CACHE_DIR):
+        self.directory = directory
+
+        if not isdir(directory):
+            makedirs(directory)
+
+    def __repr__(self):
+        return '<ExtractCache (%s)>' % self.directory
+
+    def __contains__(self, name):
+        return self.metadata(name) is not None
+
+    def path(self, name):
+        return join(self.directory, name)
+
+    def names(self):
+        # Skip the extracts being written or swapped out
+        return sorted(name for name in listdir(self.directory)
+                      if isfile(join(self.directory, name, METADATA_FILE))
+                      and not SWAP_FOLDER.search(name))
+
+    def metadata(self, name):
+        """ Return the metadata of an extract or None if it's not usable. """
+        filepath = join(self.path(name), METADATA_FILE)
+        if not isfile(filepath):
+            return None
+
+        with open(filepath) as f:
+            metadata = json.load(f)
+
+        if metadata['version'] != FORMAT_VERSION:
+            log.debug('Ignored %s (cache format %s)', name, metadata['version'])
+            return None
+
+        return metadata
+
+    def write(self, name, df, source=None, filters=None):
+        """ Store a DataFrame, replacing the previous extract of that name.
+
+        The index is not kept. The extract is written next to the old one
+        and swapped in when complete, so readers never see half of it.
+        """
+        staging = self.path(name) + '.tmp-%s' % getpid()
+        if isdir(staging):
+            rmtree(staging)
+        makedirs(staging)
+
+        columns = []
+        for i, column in enumerate(df.columns):
+            filename = 'column_%04d.npy' % i
+            values, kind, timezone = self._to_array(df[column])
+            save(join(staging, filename), values, allow_pickle=True)
+            columns.append({'name': column,
+                            'file': filename,
+                            'dtype': str(df[column].dtype),
+                            'kind': kind,
+                            'timezone': timezone})
+
+        metadata = {'version': FORMAT_VERSION,
+                    'name': name,
+                    'source': source,
+                    'filters': filters,
+                    'extracted_at': datetime.now().strftime(DATETIME_FORMAT),
+                    'schema_hash': schema_hash(df),
+                    'rows': len(df),
+                    'columns': columns,
+                    'bytes': sum(getsize(join(staging, column['file']))
+                                 for column in columns)}
+
+        with open(join(staging, METADATA_FILE), 'w') as f:
+            json.dump(metadata, f, indent=2, default=str)
+
+        self._swap(staging, self.path(name))
+        log.debug('Cached %s rows, %s columns of %s (%s bytes)',
+                  len(df), len(columns), name, metadata['bytes'])
+        return metadata
+
+    def read(self, name, columns=None, mmap=True):
+        """ Return the extract, or only some of its columns, as a DataFrame.
+
+        Fixed width columns are memory-mapped unless mmap is False.
+        """
+        metadata = self.metadata(name)
+        if metadata is None:
+            raise FileNotFoundError('%s is not in the extract cache' % name)
+
+        stored = OrderedDict((column['name'], column)
+                             for column in metadata['columns'])
+        columns = list(stored) if columns is None else list(columns)
+
+        data = OrderedDict()
+        for column in columns:
+            data[column] = self._read_column(name, stored[column], mmap)
+
+        log.debug('Read %s columns of %s from the cache', len(columns), name)
+        return DataFrame(data, columns=columns)
+
+    def evict(self, max_age=MAX_AGE, max_bytes=MAX_BYTES):
+        """ Delete the extracts older than max_age, then the oldest ones
+        until the cache holds at most max_bytes. Return the names deleted.
+        """
+        entries = []
+        for name in self.names():
+            metadata = self.metadata(name)
+            if metadata is None:
+                extracted_at = datetime.min
+                size = 0
+            else:
+                extracted_at = datetime.strptime(metadata['extracted_at'],
+                                                 DATETIME_FORMAT)
+                size = metadata['bytes']
+            entries.append((extracted_at, name, size))
+
+        entries.sort()
+        total = sum(size for _, _, size in entries)
+        now = datetime.now()
+
+        evicted = []
+        for extracted_at, name, size in entries:
+            too_old = max_age is not None and now - extracted_at > max_age
+            too_big = max_bytes is not None and total > max_bytes
+            if not (too_old or too_big):
+                continue
+
+            rmtree(self.path(name))
+            total -= size
+            evicted.append(name)
+            log.debug('Evicted %s from the cache (%s)', name, extracted_at)
+
+        return evicted
+
+    @staticmethod
+    def _to_array(series):
+        timezone = None
+        if series.dtype.kind == 'M' and series.dt.tz is not None:
+            timezone = str(series.dt.tz)
+            series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+
+        values = asarray(series.values)
+        if values.dtype.kind != 'O':
+            return values, 'fixed', timezone
+
+        is_short_string = all(isinstance(value, str) and
+                              len(value) <= MAX_FIXED_WIDTH
+                              for value in values)
+        if is_short_string and len(values):
+            return values.astype(str), 'string', timezone
+
+        return values, 'object', timezone
+
+    def _read_column(self, name, column, mmap):
+        filepath = join(self.path(name), column['file'])
+
+        if column['kind'] == 'object':
+            values = load(filepath, allow_pickle=True)
+        else:
+            values = load(filepath, mmap_mode='r' if mmap else None)
+
+        if column['kind'] == 'string':
+            values = values.astype(object)
+
+        series = Series(values)
+        if column['timezone']:
+            series = series.dt.tz_localize('UTC').dt.tz_convert(
+                column['timezone'])
+
+        return series
+
+    @staticmethod
+    def _swap(staging, target):
+        previous = target + '.old-%s' % getpid()
+        if isdir(target):
+            rename(target, previous)
+        rename(staging, target)
+        if isdir(previous):
+            rmtree(previous)
@@ -0,0 +1,61 @@
+""" The fleet dimension, for enriching rows while they are written.
+
+Every table aggregated by fleet carries a copy of the fleet's display name,
+country and city from tableau.fleet. The dimension is read once per run and
+looked up in memory, by fleet UUID or by backend name. Fleets that are not
+in tableau.fleet yet get NULLs, which reenrich_fleet_info fills in later.
+
+"""
+
+
+from collections import namedtuple
+from logging import getLogger
+
+
+log = getLogger(__name__)
+
+FLEET_FIELDS = ('uuid', 'backend_name', 'display_name',
+                'country_code', 'country_name', 'city')
+
+FLEET_SQL = """
+SELECT uuid, backend_name, display_name, country_code, country_name, city
+FROM tableau.fleet;
+"""
+
+Fleet = namedtuple('Fleet', FLEET_FIELDS)
+UNKNOWN_FLEET = Fleet(*(None for _ in FLEET_FIELDS))
+
+
+class FleetDimension(object):
+    def __init__(self, fleets):
+        self.fleets = list(fleets)
+        self.by_uuid = {fleet.uuid: fleet for fleet in self.fleets}
+        self.by_backend_name = {fleet.backend_name: fleet
+                                for fleet in self.fleets}
+
+    def __repr__(self):
+        return '<FleetDimension (%s fleets)>' % len(self.fleets)
+
+    @classmethod
+    def load(cls, conn):
+        """ Read tableau.fleet through a psycopg2 connection. """
+        cur = conn.cursor()
+        cur.execute(FLEET_SQL)
+        fleets = [Fleet(*(None if value is None else str(value)
+                          for value in row))
+                  for row in cur.fetchall()]
+        cur.close()
+
+        log.debug('Loaded %s fleets from tableau.fleet', len(fleets))
+        return cls(fleets)
+
+    def get(self, uuid=None, backend_name=None):
+        if uuid is not None:
+            fleet = self.by_uuid.get(uuid)
+        else:
+            fleet = self.by_backend_name.get(backend_name)
+
+        if fleet is None:
+            log.debug('Unknown fleet %s', uuid or backend_name)
+            return UNKNOWN_FLEET
+        return fleet
@@ -0,0 +1,209 @@
+""" Geometry of GPS trajectories.
+
+Distances are great circle distances in metres. For the simplification
+of a trajectory, the points are projected on a local plane around their
+mean latitude (equirectangular), which is accurate to well under a metre
+at the scale of a city.
+
+A trajectory is simplified in two steps. Stationary points are collapsed:
+while a driver stays within a radius of where they stopped, only the
+first and the last points are kept, so the time they stayed is still
+known. The rest of the line is then simplified with Douglas-Peucker
+within a tolerance in metres, which keeps the ends of the stops whatever
+their distance to the line.
+
+"""
+
+
+from logging import getLogger
+
+from numpy import (arctan2, argmax, asarray, clip, concatenate, cos,
+                   flatnonzero, hypot, mean, ones, radians, searchsorted, sin,
+                   sqrt, where, zeros)
+from pandas import concat, to_datetime
+
+
+log = getLogger(__name__)
+
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """ Return the distances in metres between two arrays of points. """
+    lat1, lng1, lat2, lng2 = (radians(asarray(a, dtype=float))
+                              for a in (lat1, lng1, lat2, lng2))
+
+    a = (sin((lat2 - lat1) / 2) ** 2 +
+         cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * arctan2(sqrt(a), sqrt(1 - a))
+
+
+def path_length(lat, lng):
+    """ Return the length in metres of the line through the points. """
+    if len(lat) < 2:
+        return 0.0
+    return float(haversine(lat[:-1], lng[:-1], lat[1:], lng[1:]).sum())
+
+
+def to_local_metres(lat, lng):
+    """ Project the points on a plane, in metres from their centre. """
+    lat = asarray(lat, dtype=float)
+    lng = asarray(lng, dtype=float)
+    lat0 = radians(lat.mean())
+
+    x = radians(lng - lng.mean()) * cos(lat0) * EARTH_RADIUS
+    y = radians(lat - lat.mean()) * EARTH_RADIUS
+    return x, y
+
+
+def segment_distances(x, y, x1, y1, x2, y2):
+    """ Return the distances from the points to the segments. """
+    dx = x2 - x1
+    dy = y2 - y1
+    length = dx * dx + dy * dy
+
+    # Where the segment is a point, the projection is that point
+    safe_length = where(length > 0, length, 1)
+    t = clip(((x - x1) * dx + (y - y1) * dy) / safe_length, 0, 1)
+    t = where(length > 0, t, 0)
+
+    return hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+
+def douglas_peucker(x, y, tolerance):
+    """ Return a mask of the points kept by Douglas-Peucker. """
+    n = len(x)
+    keep = zeros(n, dtype=bool)
+    if n <= 2:
+        keep[:] = True
+        return keep
+
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+
+    # Iterative, as long trajectories would exceed the recursion limit
+    while stack:
+        start, stop = stack.pop()
+        if stop - start < 2:
+            continue
+
+        distances = segment_distances(x[start + 1:stop], y[start + 1:stop],
+                                      x[start], y[start], x[stop], y[stop])
+        farthest = argmax(distances)
+
+        if distances[farthest] > tolerance:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            stack.append((start, middle))
+            stack.append((middle, stop))
+
+    return keep
+
+
+def collapse_stationary(x, y, radius):
+    """ Return a mask that keeps the first and the last point of each
+    stretch spent within radius metres of where it started.
+    """
+    n = len(x)
+    keep = ones(n, dtype=bool)
+    anchor = 0
+
+    for i in range(1, n):
+        if hypot(x[i] - x[anchor], y[i] - y[anchor]) <= radius:
+            keep[i] = False
+        else:
+            # The last point of the stop tells when the driver left
+            keep[i - 1] = True
+            anchor = i
+
+    if n:
+        keep[-1] = True
+    return keep
+
+
+def simplification_errors(x, y, keep):
+    """ Return the distances from the dropped points to the simplified
+    line, i.e. to the segment between the kept points around them.
+    """
+    kept = flatnonzero(keep)
+    dropped = flatnonzero(~keep)
+    if not len(dropped):
+        return zeros(0)
+
+    before = kept[searchsorted(kept, dropped) - 1]
+    after = kept[searchsorted(kept, dropped)]
+    return segment_distances(x[dropped], y[dropped],
+                             x[before], y[before], x[after], y[after])
+
+
+def simplify(lat, lng, tolerance, stationary_radius=None):
+    """ Return the mask of the points to keep and the distances in metres
+    between the dropped points and the simplified line.
+    """
+    x, y = to_local_metres(lat, lng)
+    keep = ones(len(x), dtype=bool)
+    stops = zeros(len(x), dtype=bool)
+
+    if stationary_radius:
+        keep = collapse_stationary(x, y, stationary_radius)
+        # The points kept next to dropped ones start and end the stops
+        stops[:-1] |= keep[:-1] & ~keep[1:]
+        stops[1:] |= keep[1:] & ~keep[:-1]
+
+    moving = flatnonzero(keep)
+    keep[moving] = douglas_peucker(x[moving], y[moving], tolerance)
+    keep |= stops
+
+    return keep, simplification_errors(x, y, keep)
+
+
+def simplify_trajectories(df, tolerance, stationary_radius=None,
+                          keys=('driver', 'route'), time_field='datetime'):
+    """ Simplify the trajectory of each driver and route in a frame of
+    tracking points. Return the points kept, trajectory by trajectory in
+    time order, and a dictionary of statistics: raw and kept points, the
+    maximum and mean error in metres and the raw and simplified lengths
+    in metres.
+    """
+    stats = {'raw_points': len(df),
+             'points': 0,
+             'max_error': 0.0,
+             'mean_error': 0.0,
+             'raw_length': 0.0,
+             'length': 0.0}
+
+    df = df.dropna(subset=['lat', 'lng'])
+    df = df.assign(_time=to_datetime(df[time_field]))
+    errors = []
+    parts = []
+
+    # Points without a route are a trajectory of their own
+    groups = [df[key].fillna('') for key in keys]
+    for _, trajectory in df.groupby(groups, sort=False):
+        trajectory = trajectory.sort_values('_time')
+        lat = trajectory['lat'].values
+        lng = trajectory['lng'].values
+
+        keep, trajectory_errors = simplify(lat, lng, tolerance,
+                                           stationary_radius)
+        errors.append(trajectory_errors)
+        parts.append(trajectory[keep])
+
+        stats['raw_length'] += path_length(lat, lng)
+        stats['length'] += path_length(lat[keep], lng[keep])
+
+    if not parts:
+        return df.drop('_time', axis=1), stats
+
+    simplified = concat(parts).drop('_time', axis=1)
+    errors = concatenate(errors)
+
+    stats['points'] = len(simplified)
+    if len(errors):
+        stats['max_error'] = float(errors.max())
+        stats['mean_error'] = float(mean(errors))
+
+    log.debug('Simplified %s points to %s (max error %.1fm)',
+              stats['raw_points'], stats['points'], stats['max_error'])
+    return simplified, stats
+
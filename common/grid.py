@@ -0,0 +1,136 @@
+""" A dense occupancy grid over gastronomic days, time slots and keys.
+
+Shift data is aggregated into the number of people on duty during each time
+slot of each gastronomic day, per fleet (or any other key). The grid holds
+the counts in a NumPy array and credits whole arrays of intervals at once,
+including the fractions of the first and last slot of each interval.
+
+"""
+
+
+from datetime import datetime, time, timedelta
+from logging import getLogger
+
+from numpy import add, asarray, floor, int64, maximum, timedelta64, zeros
+from pandas import DataFrame, MultiIndex, to_datetime
+
+
+log = getLogger(__name__)
+
+GASTRO_DAY_FIRST_HOUR = 8
+MINUTES_PER_DAY = 24 * 60
+
+
+class OccupancyGrid(object):
+    """ Occupancy per gastronomic day, slot and key.
+
+    Gastronomic days run from first_hour to first_hour on the next calendar
+    day. Datetimes are naive wall-clock times. The values are available as
+    an array of shape (days, slots per day, keys).
+    """
+
+    def __init__(self, start_date, end_date, keys,
+                 slot_minutes=60, first_hour=GASTRO_DAY_FIRST_HOUR):
+        assert MINUTES_PER_DAY % slot_minutes == 0, \
+            'Slots must divide the day evenly'
+
+        self.start_date = start_date
+        self.end_date = end_date
+        self.keys = list(keys)
+        self.slot_minutes = slot_minutes
+        self.first_hour = first_hour
+
+        self.num_days = (end_date - start_date).days + 1
+        self.slots_per_day = MINUTES_PER_DAY // slot_minutes
+        self.origin = datetime.combine(start_date, time(first_hour))
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+
+        shape = (self.num_days, self.slots_per_day, len(self.keys))
+        self.values = zeros(shape)
+
+    def __repr__(self):
+        return '<OccupancyGrid %s to %s (%s keys, %s min slots)>' % (
+            self.start_date, self.end_date, len(self.keys), self.slot_minutes)
+
+    @property
+    def num_slots(self):
+        return self.num_days * self.slots_per_day
+
+    def _to_slots(self, datetimes):
+        datetimes = to_datetime(asarray(datetimes))
+        offsets = (datetimes - self.origin) / timedelta64(self.slot_minutes,
+                                                          'm')
+        return asarray(offsets, dtype=float).clip(0, self.num_slots)
+
+    def add(self, starts, ends, keys, weight=1.0):
+        """ Credit the intervals [start, end) to the slots they overlap.
+
+        Each slot receives the fraction of its length covered by the
+        interval, so an interval can span midnight, the gastronomic day
+        boundary or several days. Parts outside the grid and intervals
+        with an unknown key are dropped. Return the number of intervals
+        that were dropped for their key.
+        """
+        positions = asarray([self.positions.get(key, -1) for key in keys],
+                            dtype=int64)
+        known = positions >= 0
+
+        starts = self._to_slots(starts)[known]
+        ends = self._to_slots(ends)[known]
+        positions = positions[known]
+
+        ends = maximum(ends, starts)
+        first_slots = floor(starts).astype(int64)
+        last_slots = floor(ends).astype(int64)
+
+        # Every slot in [first_slot, last_slot) is covered whole: mark the
+        # bounds in a difference array and let the cumulative sum fill in.
+        # Then take out what the interval misses of its first slot and add
+        # what it covers of its last slot.
+        counts = zeros((len(self.keys), self.num_slots + 1))
+        add.at(counts, (positions, first_slots), weight)
+        add.at(counts, (positions, last_slots), -weight)
+        counts = counts.cumsum(axis=1)
+        add.at(counts, (positions, first_slots),
+               -weight * (starts - first_slots))
+        add.at(counts, (positions, last_slots),
+               weight * (ends - last_slots))
+
+        counts = counts[:, :self.num_slots]
+        self.values += counts.T.reshape(self.values.shape)
+
+        dropped = int((~known).sum())
+        if dropped:
+            log.debug('Dropped %s intervals with an unknown key', dropped)
+        return dropped
+
+    def slot_datetimes(self):
+        """ Return the actual datetime at which each slot starts. """
+        step = timedelta(minutes=self.slot_minutes)
+        return [self.origin + i * step for i in range(self.num_slots)]
+
+    def to_frame(self, field, actual_field='actual_datetime',
+                 names=('gastronomic_datetime', 'fleet')):
+        """ Export to the hourly tables' layout.
+
+        The frame is indexed by (gastronomic datetime, key) in grid order.
+        The gastronomic datetime is the gastronomic date at the slot's
+        time of day, so 2am of the 1st gastronomic day is 1st 02:00.
+        """
+        gastro_datetimes = []
+        actual_datetimes = []
+
+        for actual_datetime in self.slot_datetimes():
+            gastro_date = (actual_datetime -
+                           timedelta(hours=self.first_hour)).date()
+            gastro_datetimes.append(datetime.combine(gastro_date,
+                                                     actual_datetime.time()))
+            actual_datetimes.extend([actual_datetime] * len(self.keys))
+
+        index = MultiIndex.from_product((gastro_datetimes, self.keys),
+                                        names=list(names))
+
+        return DataFrame({actual_field: actual_datetimes,
+                          field: self.values.reshape(-1)},
+                         index=index,
+                         columns=[actual_field, field])
@@ -0,0 +1,172 @@
+""" Distance, speed and idle time of driver trajectories.
+
+Tracking points are sorted once by trajectory and time, after which every
+metric is a NumPy pass over consecutive points: the segment between two
+points of the same trajectory has a great circle length, a duration and
+a speed. Segments slower than STOP_SPEED are idle; a run of idle segments
+lasting at least MIN_STOP is a stop. Segments longer than MAX_GAP are
+signal losses: their distance (a straight line, so a lower bound) counts,
+but their time is neither moving nor idle.
+
+A trajectory is any grouping of the points, typically a route, a shift or
+a driver's day. The summaries are sums over segments, except the speed
+percentiles, which are taken over the moving segments.
+
+"""
+
+
+from logging import getLogger
+
+from numpy import (asarray, bincount, cumsum, flatnonzero, lexsort, r_,
+                   zeros)
+from pandas import DataFrame, Series, factorize, to_datetime
+
+from common.geo import haversine
+
+
+log = getLogger(__name__)
+
+# Metres per second
+STOP_SPEED = 1.0
+# Seconds
+MIN_STOP = 60
+MAX_GAP = 300
+
+SPEED_PERCENTILES = (50, 90)
+MPS_TO_KMH = 3.6
+
+SUMMARY_COLUMNS = ['start', 'stop', 'points', 'duration', 'distance',
+                   'moving_time', 'idle_time', 'gap_time', 'stops',
+                   'speed_p50', 'speed_p90', 'speed_max']
+
+
+def trajectory_codes(df, keys):
+    """ Return one integer code per point for its combination of keys,
+    numbered from 0 in order of appearance. The keys must not be null.
+    """
+    codes = zeros(len(df), dtype=int)
+    for key in keys:
+        key_codes, uniques = factorize(df[key])
+        codes = codes * len(uniques) + key_codes
+    return factorize(codes)[0]
+
+
+def segments(codes, timestamps, lat, lng):
+    """ Sort the points by trajectory and time and measure the segments
+    between consecutive points.
+
+    Return the order of the points and, per sorted point but the last,
+    whether the segment to the next point belongs to the same trajectory,
+    its length in metres and its duration in seconds.
+    """
+    order = lexsort((timestamps, codes))
+    codes = codes[order]
+    timestamps = timestamps[order]
+    lat = lat[order]
+    lng = lng[order]
+
+    same = codes[1:] == codes[:-1]
+    distances = haversine(lat[:-1], lng[:-1], lat[1:], lng[1:])
+    durations = (timestamps[1:] - timestamps[:-1]) / 1e9
+
+    return order, same, distances, durations
+
+
+def summarize(df, keys, time_field='datetime'):
+    """ Return the summary of each trajectory, a combination of the keys,
+    as a DataFrame with the keys and SUMMARY_COLUMNS.
+
+    Distances are in metres, times in seconds and speeds in km/h. Points
+    with a null key or no location are ignored.
+    """
+    keys = list(keys)
+    df = df.dropna(subset=keys + ['lat', 'lng', time_field])
+    if df.empty:
+        return DataFrame(columns=keys + SUMMARY_COLUMNS)
+
+    codes = trajectory_codes(df, keys)
+    timestamps = to_datetime(df[time_field]).values.astype('M8[ns]').astype(
+        'i8')
+    order, same, distances, durations = segments(
+        codes, timestamps, asarray(df['lat'].values, dtype=float),
+        asarray(df['lng'].values, dtype=float))
+
+    codes = codes[order]
+    timestamps = timestamps[order]
+    n = codes.max() + 1
+
+    # The first point of each trajectory in the sorted points
+    firsts = r_[0, flatnonzero(~same) + 1]
+    lasts = r_[firsts[1:] - 1, len(codes) - 1]
+
+    # Segments across trajectories do not count
+    distances = distances * same
+    durations = durations * same
+    gap = durations > MAX_GAP
+    speeds = distances / durations.clip(min=1e-9)
+    slow = same & ~gap & (speeds < STOP_SPEED)
+    moving = same & ~gap & ~slow
+    segment_codes = codes[:-1]
+
+    idle_time, stops = _stops(slow, durations, segment_codes, n)
+
+    summary = DataFrame({
+        'start': to_datetime(timestamps[firsts]),
+        'stop': to_datetime(timestamps[lasts]),
+        'points': lasts - firsts + 1,
+        'duration': (timestamps[lasts] - timestamps[firsts]) / 1e9,
+        'distance': bincount(segment_codes, distances, n),
+        'moving_time': bincount(segment_codes, durations * moving, n),
+        'idle_time': idle_time,
+        'gap_time': bincount(segment_codes, durations * gap, n),
+        'stops': stops})
+
+    speeds = Series(speeds[moving] * MPS_TO_KMH, index=segment_codes[moving])
+    by_trajectory = speeds.groupby(level=0)
+    for percentile in SPEED_PERCENTILES:
+        summary['speed_p%s' % percentile] = by_trajectory.quantile(
+            percentile / 100.0)
+    summary['speed_max'] = by_trajectory.max()
+
+    original = df.iloc[order[firsts]]
+    for key in keys:
+        summary[key] = original[key].values
+
+    log.debug('Summarized %s points into %s trajectories by %s',
+              len(df), n, ', '.join(keys))
+    return summary[keys + SUMMARY_COLUMNS]
+
+
+def _stops(slow, durations, segment_codes, n):
+    """ Return the idle time and the number of stops per trajectory. """
+    if not slow.any():
+        return zeros(n), zeros(n, dtype=int)
+
+    # Number the runs of consecutive slow segments
+    starts = slow & ~r_[False, slow[:-1]]
+    runs = cumsum(starts) - 1
+
+    run_durations = bincount(runs[slow], durations[slow])
+    run_codes = segment_codes[flatnonzero(starts)]
+
+    stops = run_durations >= MIN_STOP
+    return (bincount(run_codes[stops], run_durations[stops], n),
+            bincount(run_codes[stops], minlength=n))
+
+
+def summarize_routes(df):
+    """ Summarize the points by route and driver (a route is reassigned
+    now and then, and each driver's part is summarized on its own).
+    """
+    return summarize(df, ['route', 'driver'])
+
+
+def summarize_shifts(df):
+    """ Summarize the points by shift and driver. """
+    return summarize(df, ['shift', 'driver'])
+
+
+def summarize_driver_days(df, time_field='datetime'):
+    """ Summarize the points by driver and calendar day. """
+    df = df.assign(day=to_datetime(df[time_field]).dt.date)
+    return summarize(df, ['driver', 'day'], time_field)
@@ -0,0 +1,303 @@
+""" A compact on-disk store of driver trajectories.
+
+Tracking points are kept by calendar day (UTC), in one NumPy structured
+array per day sorted by driver and time: timestamp, lat, lng, speed,
+battery and a route code. The array is memory-mapped when read. An index
+next to it gives the rows of each driver and the runs of rows of each
+route, so a driver's points on a day are a slice of the array, and the
+query methods return views without copying anything.
+
+Points come in as segments, one file per batch, which are cheap to write
+from concurrent extractions. Compacting a day merges its segments into
+the array, dropping duplicate points. Only compacted points are visible
+to the queries.
+
+"""
+
+
+import json
+
+from datetime import datetime, timedelta
+from fcntl import LOCK_EX, LOCK_UN, flock
+from glob import glob
+from logging import getLogger
+from os import makedirs, remove, replace
+from os.path import basename, isdir, isfile, join
+from uuid import uuid4
+
+from numpy import (asarray, datetime64, diff, flatnonzero, full, load, r_,
+                   save, savez, searchsorted, zeros)
+from pandas import DataFrame, concat, factorize, to_datetime
+
+from common.settings import CACHE_DIR
+
+
+log = getLogger(__name__)
+
+TRAJECTORY_DIR = join(CACHE_DIR, 'trajectories')
+INDEX_FILE = 'index.json'
+LOCK_FILE = '.lock'
+SEGMENT_FILE = 'segment-%s.npz'
+SEGMENT_PATTERN = 'segment-*.npz'
+PARTIAL_SEGMENT_FILE = '.segment-%s.partial'
+
+POINT_FIELDS = ('timestamp', 'lat', 'lng', 'speed', 'battery')
+POINT_DTYPE = [('timestamp', 'M8[ms]'),
+               ('lat', 'f8'),
+               ('lng', 'f8'),
+               ('speed', 'f4'),
+               ('battery', 'f4'),
+               ('route', 'i4')]
+
+NO_ROUTE = -1
+
+
+class TrajectoryStore(object):
+    def __init__(self, directory=TRAJECTORY_DIR):
+        self.directory = directory
+
+        if not isdir(directory):
+            makedirs(directory)
+
+    def __repr__(self):
+        return '<TrajectoryStore (%s)>' % self.directory
+
+    def path(self, day):
+        return join(self.directory, day.isoformat())
+
+    def days(self):
+        """ Return the days with compacted points. """
+        return sorted(datetime.strptime(basename(folder), '%Y-%m-%d').date()
+                      for folder in glob(join(self.directory, '*-*-*'))
+                      if isfile(join(folder, INDEX_FILE)))
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def append(self, df):
+        """ Add tracking points as segments, one per day they fall on.
+
+        The frame has the columns of tableau.tracking_points (driver,
+        route, datetime, lat, lng, speed and battery at least). Return
+        the days that were touched.
+        """
+        df = df.dropna(subset=['driver', 'datetime'])
+        timestamps = to_datetime(df['datetime'])
+        days = timestamps.dt.date
+
+        for day in days.unique():
+            rows = (days == day).values
+            folder = self.path(day)
+            if not isdir(folder):
+                makedirs(folder)
+
+            # Written aside, then renamed, so that compact never reads a
+            # half-written segment
+            name = uuid4().hex
+            filepath = join(folder, SEGMENT_FILE % name)
+            partial = join(folder, PARTIAL_SEGMENT_FILE % name)
+            with open(partial, 'wb') as f:
+                savez(f,
+                      driver=asarray(df['driver'].values[rows]).astype('U'),
+                      route=asarray(
+                          df['route'].fillna('').values[rows]).astype('U'),
+                      timestamp=timestamps.values[rows].astype('M8[ms]'),
+                      lat=df['lat'].values[rows].astype(float),
+                      lng=df['lng'].values[rows].astype(float),
+                      speed=df['speed'].values[rows].astype(float),
+                      battery=df['battery'].values[rows].astype(float))
+            replace(partial, filepath)
+
+        return sorted(days.unique())
+
+    def compact(self, day):
+        """ Merge the day's segments into its points. Return the number
+        of points of the day.
+        """
+        folder = self.path(day)
+        if not isdir(folder):
+            return 0
+
+        with open(join(folder, LOCK_FILE), 'w') as lock:
+            flock(lock, LOCK_EX)
+            try:
+                return self._compact(day, folder)
+            finally:
+                flock(lock, LOCK_UN)
+
+    def _compact(self, day, folder):
+        segments = sorted(glob(join(folder, SEGMENT_PATTERN)))
+        if not segments:
+            return self.size(day)
+
+        frames = [self._compacted_frame(day)]
+        for segment in segments:
+            with load(segment) as arrays:
+                frames.append(DataFrame({key: arrays[key]
+                                         for key in arrays.files}))
+
+        df = concat(frames, ignore_index=True)
+        # Extractions may overlap when they resume: the last copy wins
+        df = df.drop_duplicates(['driver', 'timestamp'], keep='last')
+        df = df.sort_values(['driver', 'timestamp'])
+
+        route_codes, routes = factorize(df['route'].where(df['route'] != ''))
+        points = zeros(len(df), dtype=POINT_DTYPE)
+        for field in POINT_FIELDS:
+            points[field] = df[field].values
+        points['route'] = route_codes
+
+        index = {'day': day.isoformat(),
+                 'points': 'points-%s.npy' % uuid4().hex,
+                 'drivers': self._driver_ranges(df['driver'].values),
+                 'routes': self._route_runs(route_codes, routes)}
+
+        self._save(folder, index, points, segments)
+
+        log.debug('Compacted %s segments into %s points on %s',
+                  len(segments), len(points), day)
+        return len(points)
+
+    @staticmethod
+    def _driver_ranges(drivers):
+        # The drivers are sorted, so each one's rows are contiguous
+        if not len(drivers):
+            return {}
+        bounds = r_[0, flatnonzero(drivers[1:] != drivers[:-1]) + 1,
+                    len(drivers)]
+        return {str(drivers[start]): [int(start), int(stop)]
+                for start, stop in zip(bounds[:-1], bounds[1:])}
+
+    @staticmethod
+    def _route_runs(route_codes, routes):
+        runs = {}
+        if not len(route_codes):
+            return runs
+
+        bounds = r_[0, flatnonzero(diff(route_codes)) + 1, len(route_codes)]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            code = route_codes[start]
+            if code != NO_ROUTE:
+                runs.setdefault(str(routes[code]), []).append(
+                    [int(start), int(stop)])
+        return runs
+
+    def _compacted_frame(self, day):
+        if not isfile(join(self.path(day), INDEX_FILE)):
+            return DataFrame()
+
+        index = self._read_index(day)
+        points = self._read_points(day, index)
+
+        drivers = {driver: [rows] for driver, rows
+                   in index['drivers'].items()}
+
+        df = DataFrame({field: points[field] for field in POINT_FIELDS})
+        df['driver'] = self._labels(drivers, len(points))
+        df['route'] = self._labels(index['routes'], len(points))
+        return df
+
+    @staticmethod
+    def _labels(runs, size):
+        # One code per name, set run by run, then the codes are looked up
+        # in the names in one go ('' where no run covers a row)
+        names = sorted(runs)
+        codes = full(size, len(names), dtype='i4')
+        for code, name in enumerate(names):
+            for start, stop in runs[name]:
+                codes[start:stop] = code
+        return asarray(names + [''], dtype='U').take(codes)
+
+    @staticmethod
+    def _save(folder, index, points, segments):
+        # The index names its points file, so swapping the index in
+        # switches readers to the new points in one step.
+        save(join(folder, index['points']), points)
+
+        previous = None
+        index_file = join(folder, INDEX_FILE)
+        if isfile(index_file):
+            with open(index_file) as f:
+                previous = json.load(f)['points']
+
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump(index, f)
+        replace(index_file + '.tmp', index_file)
+
+        if previous:
+            remove(join(folder, previous))
+        for segment in segments:
+            remove(segment)
+
+    # ------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------
+
+    def _read_index(self, day):
+        with open(join(self.path(day), INDEX_FILE)) as f:
+            return json.load(f)
+
+    def _read_points(self, day, index=None):
+        index = index or self._read_index(day)
+        return load(join(self.path(day), index['points']), mmap_mode='r')
+
+    def size(self, day):
+        """ Return the number of compacted points of the day. """
+        if not isfile(join(self.path(day), INDEX_FILE)):
+            return 0
+        return len(self._read_points(day))
+
+    def drivers(self, day):
+        if not isfile(join(self.path(day), INDEX_FILE)):
+            return []
+        return sorted(self._read_index(day)['drivers'])
+
+    def routes(self, day):
+        if not isfile(join(self.path(day), INDEX_FILE)):
+            return []
+        return sorted(self._read_index(day)['routes'])
+
+    def driver_day(self, driver, day):
+        """ Return a view of the driver's points on that day. """
+        if not isfile(join(self.path(day), INDEX_FILE)):
+            return zeros(0, dtype=POINT_DTYPE)
+
+        index = self._read_index(day)
+        points = self._read_points(day, index)
+        start, stop = index['drivers'].get(driver, (0, 0))
+        return points[start:stop]
+
+    def driver_range(self, driver, start, stop):
+        """ Return views of the driver's points in [start, stop), one per
+        day of the range that has any.
+        """
+        views = []
+        day = start.date()
+
+        while day <= stop.date():
+            points = self.driver_day(driver, day)
+            timestamps = points['timestamp']
+            first = searchsorted(timestamps, datetime64(start, 'ms'))
+            last = searchsorted(timestamps, datetime64(stop, 'ms'))
+            if last > first:
+                views.append(points[first:last])
+            day += timedelta(days=1)
+
+        return views
+
+    def route(self, route, days=None):
+        """ Return views of the route's points, one per run of rows. """
+        views = []
+
+        for day in days or self.days():
+            if not isfile(join(self.path(day), INDEX_FILE)):
+                continue
+
+            index = self._read_index(day)
+            runs = index['routes'].get(route)
+            if runs:
+                points = self._read_points(day, index)
+                views.extend(points[start:stop] for start, stop in runs)
+
+        return views
@@ -8,13 +8,19 @@ Created on Jul 28, 2015
 # Warning: deprecated. Use valkfleet model instead.
 
 import argparse
-import http.cookiejar
+import codecs
+import csv
 import json
 import logging
 import pprint
 import sys
+import urllib.error
 import urllib.request
 
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, Timeout
+
 from common import logging_configurer
 from common.logging_configurer import LOG_DIR
 
@@ -24,6 +30,19 @@ DRIVERS_URL = 'https://api.valkfleet.com/drivers/'
 USERS_URL = 'https://api.valkfleet.com/users/'
 FLEETS_URL = 'https://api.valkfleet.com/fleets/'
 
+# Downloads are read from the socket in chunks and abort past the size limit
+CHUNK_SIZE = 65536
+DEFAULT_MAX_BYTES = 256 * 1048576
+CSV_BATCH_SIZE = 5000
+
+# Connections to the backend are kept alive and shared between threads
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 300
+
+# Status of the HTTPError raised for a timeout or a broken connection
+TIMEOUT_STATUS = 408
+CONNECTION_ERROR_STATUS = 503
+
 # __name__ is the name of the module or '__main__'
 logger = logging.getLogger(__name__)
 pp = pprint.PrettyPrinter(indent=4)
@@ -33,20 +52,128 @@ class ScriptError(Exception):
     pass
 
 
+def http_error(url, error):
+    """ Return the urllib HTTPError that stands for a requests error, so
+    that timeouts are handled by the jobs like any failed download.
+    """
+    if isinstance(error, Timeout):
+        status = TIMEOUT_STATUS
+    else:
+        status = CONNECTION_ERROR_STATUS
+    return urllib.error.HTTPError(url, status, str(error), {}, None)
+
+
+class PooledResponse:
+    """ The file-like subset of a urllib response used by the jobs. """
+
+    def __init__(self, response):
+        self.response = response
+        self.chunks = response.iter_content(CHUNK_SIZE)
+        self.buffer = b''
+
+    def read(self, amt=None):
+        while amt is None or len(self.buffer) < amt:
+            try:
+                chunk = next(self.chunks, None)
+            except RequestException as err:
+                raise http_error(self.response.url, err) from err
+            if chunk is None:
+                break
+            self.buffer += chunk
+
+        if amt is None:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return data
+
+    def geturl(self):
+        return self.response.url
+
+    def getcode(self):
+        return self.response.status_code
+
+    def info(self):
+        return self.response.headers
+
+    def close(self):
+        # A response read to the end has already
+        # handed its connection back to the pool
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PooledOpener:
+    """ Drop-in for a urllib opener on top of a keep-alive session.
+
+    Requests go through a connection pool, ask for gzip bodies and give up
+    after timeout seconds instead of hanging. HTTP errors are raised as
+    urllib.error.HTTPError like the opener this replaces, and so are the
+    timeouts and connection errors of requests.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.session = Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def open(self, request, data=None, timeout=None):
+        if isinstance(request, str):
+            request = urllib.request.Request(request)
+        if data is None:
+            data = request.data
+
+        try:
+            response = self.session.request(
+                        'POST' if data is not None else request.get_method(),
+                        request.full_url,
+                        data=data,
+                        headers=dict(request.header_items()),
+                        timeout=timeout or self.timeout,
+                        stream=True)
+        except RequestException as err:
+            raise http_error(request.full_url, err) from err
+
+        if response.status_code >= 400:
+            response.close()
+            raise urllib.error.HTTPError(request.full_url,
+                                         response.status_code,
+                                         response.reason,
+                                         response.headers, None)
+
+        return PooledResponse(response)
+
+    def close(self):
+        self.session.close()
+
+
 class BackendConnector:
 
-    def __init__(self):
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES,
+                 pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
         self.auth_data = None
         self.auth_token = None
         self.opener = None
+        self.max_bytes = max_bytes
+        self.pool_size = pool_size
+        self.timeout = timeout
 
     def authenticate(self, username, password):
         logger.info('Authenticating...')
 
         # In reality the backend doesn't use a cookie, but a JSON token
-        cookie_jar = http.cookiejar.CookieJar()
-        self.opener = urllib.request.build_opener(
-                            urllib.request.HTTPCookieProcessor(cookie_jar))
+        if self.opener is None:
+            self.opener = PooledOpener(self.pool_size, self.timeout)
 
         login_params = {'username': username,
                         'password': password}
@@ -69,14 +196,10 @@ class BackendConnector:
             else:
                 logger.debug('Response received from the expected URL')
 
-            for cookie in cookie_jar:
+            for cookie in self.opener.session.cookies:
                 logger.debug('Received cookie: {}'.format(cookie))
 
-            # The response shouldn't be larger than 1 MiB
-            auth_json = response1.read(1048576).decode('utf-8')
-
-            if (response1.read(1024) != b''):
-                raise ScriptError('Dowloaded JSON is larger than 1 MiB')
+            auth_json = self.read(response1).decode('utf-8')
 
         self.auth_data = json.loads(auth_json)
         self.auth_token = self.auth_data['token']
@@ -96,6 +219,91 @@ class BackendConnector:
 
         return
 
+    def request(self, url):
+        request = urllib.request.Request(url)
+        request.add_header('Authorization', self.auth_token)
+        return request
+
+    def get_json(self, url, max_bytes=None):
+        with self.opener.open(self.request(url)) as response:
+            logger.debug('Retrieved JSON from this URL: {}'.
+                         format(response.geturl()))
+            payload = self.read(response, max_bytes)
+
+        return json.loads(payload.decode('utf-8'))
+
+    def iter_csv(self, url, expected_fields=None,
+                 batch_size=CSV_BATCH_SIZE, max_bytes=None):
+        """ Stream a CSV download as lists of rows, without the header.
+
+        The CSV is decoded while it comes off the socket, so memory stays
+        flat whatever the size of the file. The download is aborted past
+        max_bytes (the connector's limit by default).
+        """
+        with self.opener.open(self.request(url)) as response:
+            logger.debug('Retrieved file from this URL: {}'.
+                         format(response.geturl()))
+
+            csv_reader = csv.reader(self.iter_lines(response, max_bytes),
+                                    dialect='excel')
+            csv_fields = next(csv_reader, [])
+
+            if expected_fields and tuple(csv_fields) != expected_fields:
+                logger.error('Expected fields : {}'.format(expected_fields))
+                logger.error('Input CSV fields: {}'.format(tuple(csv_fields)))
+                raise ScriptError('The CSV does not contain the expected '
+                                  'fields')
+
+            rows = []
+            for row in csv_reader:
+                if len(row) == 0:
+                    continue
+                if len(row) != len(csv_fields):
+                    raise ScriptError('The CSV contains rows with the wrong '
+                                      'number of fields')
+                rows.append(row)
+
+                if len(rows) == batch_size:
+                    yield rows
+                    rows = []
+
+            if rows:
+                yield rows
+
+    def iter_chunks(self, response, max_bytes=None):
+        max_bytes = max_bytes or self.max_bytes
+        downloaded = 0
+
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+
+            downloaded += len(chunk)
+            if max_bytes and downloaded > max_bytes:
+                raise ScriptError('Download from {} is larger than {} bytes'.
+                                  format(response.geturl(), max_bytes))
+            yield chunk
+
+    def iter_lines(self, response, max_bytes=None):
+        # Lines keep their line break so that the CSV
+        # reader can deal with line breaks inside quotes.
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        tail = ''
+
+        for chunk in self.iter_chunks(response, max_bytes):
+            lines = (tail + decoder.decode(chunk)).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line + '\n'
+
+        tail += decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+    def read(self, response, max_bytes=None):
+        return b''.join(self.iter_chunks(response, max_bytes))
+
 
 def parse_args():
 
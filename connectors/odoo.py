@@ -1,15 +1,21 @@
 """ The connector for the Odoo API. """
 
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 from pprint import pprint
+from threading import local
 from xmlrpc.client import ServerProxy
 from erppeek import Client, Error as ERPPeekError
-from pandas import DataFrame
+from pandas import DataFrame, concat
 
 from connectors.base import BaseConnector
 
 ALL = []
+PAGE_SIZE = 1000
+DEFAULT_WORKERS = 4
+
 log = getLogger(__name__)
 
 
@@ -87,9 +93,51 @@ class OdooConnector(BaseConnector):
 
         return self.extract('res.partner', filters)
 
-    def extract(self, table, filters=ALL):
-        records = self.db.read(table, filters)
-        return DataFrame.from_records(records)
+    def extract(self, table, filters=ALL, fields=None,
+                page_size=PAGE_SIZE, workers=DEFAULT_WORKERS):
+        chunks = list(self.extract_iter(table, filters, fields,
+                                        page_size, workers))
+        if not chunks:
+            return DataFrame()
+        return concat(chunks, ignore_index=True)
+
+    def extract_iter(self, table, filters=ALL, fields=None,
+                     page_size=PAGE_SIZE, workers=DEFAULT_WORKERS):
+        """ Yield the records matching the filters as DataFrame chunks.
+
+        The ids are searched first, then read in pages of page_size
+        records by a pool of workers, each over its own XML-RPC client.
+        Only the given fields are read (all of them if fields is None).
+        Chunks come out in id order and at most two pages per worker
+        are fetched ahead of the consumer.
+        """
+        ids = self.db.search(table, filters, order='id')
+        pages = [ids[i:i + page_size] for i in range(0, len(ids), page_size)]
+        log.debug('Reading %s records from %s in %s pages',
+                  len(ids), table, len(pages))
+
+        clients = local()
+
+        def read(page):
+            # XML-RPC proxies are not thread safe
+            if not hasattr(clients, 'db'):
+                clients.db = self._authenticate()
+            if fields is None:
+                return clients.db.execute(table, 'read', page)
+            return clients.db.execute(table, 'read', page, fields)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque(executor.submit(read, page)
+                            for page in pages[:2 * workers])
+            next_pages = iter(pages[2 * workers:])
+
+            while pending:
+                records = pending.popleft().result()
+                page = next(next_pages, None)
+                if page is not None:
+                    pending.append(executor.submit(read, page))
+
+                yield DataFrame.from_records(records)
 
 if __name__ == '__main__':
     OdooConnector().execute_test()
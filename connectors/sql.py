@@ -1,12 +1,119 @@
 """ Connectors for MySQL and Postgres databases. """
 
 
-from pandas import DataFrame
+from collections import OrderedDict
+from hashlib import md5
+from io import StringIO
+from logging import getLogger
+from re import IGNORECASE, compile as compile_regex
+from pandas import DataFrame, Series, isnull
 from sqlalchemy import create_engine
+from sqlparse import split
 from common.sqlreader import SQLReader
 from connectors.base import BaseConnector
 
 
+log = getLogger(__name__)
+
+# Rows per DataFrame when streaming results and per COPY when bulk loading
+CHUNK_SIZE = 10000
+
+# Prepared statements kept per database connection
+MAX_PREPARED = 100
+
+IDENTIFIER = compile_regex(r'^[A-Za-z_][A-Za-z0-9_$]*$')
+PLACEHOLDER = compile_regex(r'%\((\w+)\)s|%%')
+
+# The statements that PREPARE accepts, after any leading comments
+PREPARABLE = compile_regex(r'^(\s*--[^\n]*\n|\s*/\*.*?\*/)*\s*'
+                           r'(SELECT|INSERT|UPDATE|DELETE|VALUES|WITH)\b',
+                           IGNORECASE)
+
+PREPARE = 'PREPARE {name} AS {statement}'
+EXECUTE = 'EXECUTE {name}{arguments}'
+DEALLOCATE = 'DEALLOCATE {name}'
+
+LOAD_MODES = ('append', 'replace', 'merge')
+COPY_NULL = '\\N'
+
+# Postgres column types by numpy dtype kind
+POSTGRES_TYPES = {
+    'i': 'BIGINT',
+    'u': 'BIGINT',
+    'f': 'DOUBLE PRECISION',
+    'b': 'BOOLEAN',
+    'M': 'TIMESTAMP',
+    'm': 'INTERVAL',
+    'O': 'TEXT'
+}
+
+INTEGER_TYPES = ('SMALLINT', 'INTEGER', 'BIGINT', 'INT', 'INT2', 'INT4', 'INT8')
+
+CREATE_TABLE = 'CREATE TABLE IF NOT EXISTS {table} ({definitions});'
+DROP_TABLE = 'DROP TABLE IF EXISTS {table};'
+COPY = "COPY {table} ({columns}) FROM STDIN WITH CSV NULL '\\N';"
+
+STAGING_TABLE = 'bulk_load_staging'
+CREATE_STAGING_TABLE = """
+CREATE TEMPORARY TABLE {staging}
+ON COMMIT DROP AS
+SELECT {columns}
+FROM {table}
+WITH NO DATA;
+"""
+UPDATE_FROM_STAGING = """
+UPDATE {table} AS target
+SET {assignments}
+FROM {staging} AS staging
+WHERE {matches};
+"""
+INSERT_FROM_STAGING = """
+INSERT INTO {table} ({columns})
+SELECT {columns}
+FROM {staging} AS staging
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM {table} AS target
+    WHERE {matches}
+);
+"""
+
+
+def format_identifiers(dynamic_sql, **identifiers):
+    """ Fill in the {field} templates, which may only be SQL identifiers. """
+    for field, identifier in identifiers.items():
+        if not IDENTIFIER.match(str(identifier)):
+            raise ValueError('Invalid identifier for %s: %r'
+                             % (field, identifier))
+    return dynamic_sql.format(**identifiers)
+
+
+def to_positional(sql):
+    """ Turn %(field)s parameters into $1, $2... for PREPARE.
+
+    Return the statement and the parameter fields in order of position.
+    A parameter used more than once keeps its position. Escaped percent
+    signs are unescaped, as the driver would do.
+    """
+    fields = []
+
+    def replace(match):
+        field = match.group(1)
+        if field is None:
+            return '%'
+        if field not in fields:
+            fields.append(field)
+        return '$%s' % (fields.index(field) + 1)
+
+    return PLACEHOLDER.sub(replace, sql), fields
+
+
+def is_preparable(sql):
+    """ Return whether the SQL is a single statement PREPARE accepts. """
+    statements = [statement for statement in split(sql) if statement.strip()]
+    return len(statements) == 1 and bool(PREPARABLE.match(sql))
+
+
 class BaseSQLConnector(BaseConnector):
     def _authenticate(self):
         return create_engine(self.url)
@@ -21,19 +128,258 @@ class BaseSQLConnector(BaseConnector):
         safe_url_format = '{dialect}://{username}:***@{host}/{database}'
         return safe_url_format.format(**self.config)
 
-    def execute(self, dynamic_sql, **parameters):
-        sql = dynamic_sql.format(**parameters)
+    def execute(self, dynamic_sql, parameters=None, **identifiers):
+        """ Execute a statement and return the rows as a DataFrame.
+
+        Schema, table and column names go in {field} templates and are
+        filled in from the identifiers. Values go in %(field)s placeholders
+        and are bound from the parameters dictionary. On Postgres, a single
+        SELECT, INSERT, UPDATE, DELETE or VALUES statement is prepared once
+        per connection and executed again with new values the next time the
+        same SQL text comes along. Anything else (DDL, GRANT, several
+        statements) is executed as is. Statements that return no rows
+        return an empty DataFrame.
+        """
+        sql = format_identifiers(dynamic_sql, **identifiers)
+
+        with self.db.connect() as c:
+            with c.begin():
+                if self.db.dialect.name == 'postgresql' and is_preparable(sql):
+                    result = self._execute_prepared(c, sql, parameters or {})
+                else:
+                    result = c.execute(sql, parameters or {})
+
+                if not result.returns_rows:
+                    return DataFrame()
+
+                records = list(result)
+                columns = result.keys()
+
+        return DataFrame.from_records(records, columns=columns)
+
+    def _execute_prepared(self, c, sql, parameters):
+        # The prepared statements live as long as the DBAPI connection,
+        # so they are tracked in its info dictionary, which the pool keeps.
+        prepared = c.connection.info.setdefault('prepared', OrderedDict())
+        statement, fields = to_positional(sql)
+
+        if sql in prepared:
+            name = prepared.pop(sql)
+        else:
+            if len(prepared) >= MAX_PREPARED:
+                _, oldest = prepared.popitem(last=False)
+                c.execute(DEALLOCATE.format(name=oldest))
+
+            # The statement has its percent signs unescaped by now,
+            # so it must reach the driver without any parameters.
+            name = 'stmt_' + md5(sql.encode()).hexdigest()[:16]
+            raw = c.execution_options(no_parameters=True)
+            raw.execute(PREPARE.format(name=name, statement=statement))
+            log.debug('Prepared %s', name)
+
+        # Most recently used last
+        prepared[sql] = name
+
+        if fields:
+            placeholders = ', '.join('%%(%s)s' % field for field in fields)
+            arguments = '(' + placeholders + ')'
+        else:
+            arguments = ''
+
+        values = {field: parameters[field] for field in fields}
+        return c.execute(EXECUTE.format(name=name, arguments=arguments),
+                         values)
+
+    def execute_iter(self, dynamic_sql, parameters=None, chunksize=CHUNK_SIZE,
+                     **identifiers):
+        """ Stream the result as DataFrames of at most chunksize rows.
+
+        The rows are read through a server-side cursor, so they arrive as
+        the database produces them and only one chunk is held in memory.
+        The column dtypes of the first chunk are imposed on the others, and
+        a chunk that does not fit them raises a ValueError: typically NULLs
+        in a column of integers or booleans, which the query should cast
+        (e.g. to DOUBLE PRECISION) if it expects them. Identifiers and
+        parameters work as in execute, except that the statement is not
+        prepared: Postgres cannot declare a cursor on a prepared statement.
+        """
+        sql = format_identifiers(dynamic_sql, **identifiers)
 
         with self.db.connect() as c:
-            result = c.execute(sql)
+            streaming = c.execution_options(stream_results=True)
+            result = streaming.execute(sql, parameters or {})
+            columns = result.keys()
+            dtypes = None
+
+            while True:
+                records = result.fetchmany(chunksize)
+                if not records:
+                    break
+
+                df = DataFrame.from_records(records, columns=columns)
+                if dtypes is None:
+                    dtypes = df.dtypes
+                else:
+                    df = self._cast(df, dtypes)
+
+                yield df
 
-        records = list(result)
-        df = DataFrame.from_records(records)
-        # noinspection PyProtectedMember
-        df.columns = result._metadata.keys
+            result.close()
+
+    @staticmethod
+    def _cast(df, dtypes):
+        for column, dtype in dtypes.items():
+            if df[column].dtype == dtype:
+                continue
+
+            # NULLs would be cast to False in a column of booleans
+            if dtype.kind in 'biu' and df[column].isnull().any():
+                raise ValueError('Column %s has NULLs and does not fit %s'
+                                 % (column, dtype))
+            try:
+                df[column] = df[column].astype(dtype)
+            except (TypeError, ValueError) as error:
+                raise ValueError('Column %s does not fit %s: %s'
+                                 % (column, dtype, error))
 
         return df
 
+    def bulk_load(self, df, table, schema, mode='append', key=None,
+                  dtype=None, chunksize=CHUNK_SIZE, statements=()):
+        """ Load a DataFrame into a table with COPY FROM STDIN.
+
+        The mode is either 'append', 'replace' (drop the table first) or
+        'merge': rows are copied into a staging table, then update the rows
+        of the target with the same key and insert the others. The table is
+        created if needed, with column types taken from dtype (SQL strings
+        or SQLAlchemy types) or else from the frame's dtypes. The frame is
+        copied in chunks of chunksize rows, in a single transaction.
+        Statements, a list of (SQL, parameters) pairs, are executed in the
+        same transaction after the copy, e.g. to checkpoint the load.
+        Return the number of rows loaded.
+        """
+        assert mode in LOAD_MODES, 'Mode must be one of %s' % (LOAD_MODES,)
+        assert mode != 'merge' or key, 'A merge needs a key'
+
+        if df.empty and mode != 'replace':
+            log.debug('Nothing to load into %s.%s', schema, table)
+            return 0
+
+        if self.db.dialect.name != 'postgresql':
+            assert mode != 'merge', 'Merges need Postgres'
+            assert not statements, 'Statements need Postgres'
+            df.to_sql(table, self.db, schema=schema, if_exists=mode,
+                      index=False, dtype=dtype, chunksize=chunksize)
+            return len(df)
+
+        keys = [key] if isinstance(key, str) else list(key or [])
+        if keys:
+            # The last version of a row wins
+            df = df.drop_duplicates(keys, keep='last')
+
+        column_types = self._column_types(df, dtype or {})
+        df = self._to_copy_frame(df, column_types)
+
+        target = self._quote(schema) + '.' + self._quote(table)
+        columns = ', '.join(self._quote(column) for column in df.columns)
+        definitions = ', '.join(self._quote(column) + ' ' + column_type
+                                for column, column_type
+                                in column_types.items())
+
+        connection = self.db.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if mode == 'replace':
+                cursor.execute(DROP_TABLE.format(table=target))
+            cursor.execute(CREATE_TABLE.format(table=target,
+                                               definitions=definitions))
+
+            if mode == 'merge':
+                cursor.execute(CREATE_STAGING_TABLE.format(
+                    staging=STAGING_TABLE, columns=columns, table=target))
+                copy = COPY.format(table=STAGING_TABLE, columns=columns)
+            else:
+                copy = COPY.format(table=target, columns=columns)
+
+            for start in range(0, len(df), chunksize):
+                with StringIO() as f:
+                    df.iloc[start:start + chunksize].to_csv(
+                        f, header=False, index=False, na_rep=COPY_NULL)
+                    f.seek(0)
+                    cursor.copy_expert(copy, f)
+
+            if mode == 'merge':
+                self._merge_staging(cursor, target, df.columns, keys)
+
+            for statement, parameters in statements:
+                cursor.execute(statement, parameters)
+
+            connection.commit()
+
+        except Exception:
+            connection.rollback()
+            raise
+
+        finally:
+            connection.close()
+
+        log.debug('Loaded (%s) %s rows into %s', mode, len(df), target)
+        return len(df)
+
+    def _merge_staging(self, cursor, target, columns, keys):
+        matches = ' AND '.join('target.{0} = staging.{0}'.format(
+            self._quote(key)) for key in keys)
+        assignments = ', '.join('{0} = staging.{0}'.format(self._quote(column))
+                                for column in columns if column not in keys)
+        quoted_columns = ', '.join(self._quote(column) for column in columns)
+
+        if assignments:
+            cursor.execute(UPDATE_FROM_STAGING.format(
+                table=target, staging=STAGING_TABLE,
+                assignments=assignments, matches=matches))
+            log.debug('Merge updated %s rows', cursor.rowcount)
+
+        cursor.execute(INSERT_FROM_STAGING.format(
+            table=target, staging=STAGING_TABLE,
+            columns=quoted_columns, matches=matches))
+        log.debug('Merge inserted %s rows', cursor.rowcount)
+
+    def _column_types(self, df, dtype):
+        column_types = OrderedDict()
+
+        for column in df.columns:
+            if column in dtype:
+                column_type = dtype[column]
+                if isinstance(column_type, type):
+                    column_type = column_type()
+                if not isinstance(column_type, str):
+                    column_type = column_type.compile(dialect=self.db.dialect)
+            elif str(df[column].dtype).startswith('datetime64[ns, '):
+                column_type = 'TIMESTAMP WITH TIME ZONE'
+            else:
+                column_type = POSTGRES_TYPES.get(df[column].dtype.kind, 'TEXT')
+
+            column_types[column] = column_type
+
+        return column_types
+
+    @staticmethod
+    def _to_copy_frame(df, column_types):
+        # Integers with missing values come as floats,
+        # which COPY refuses to write in integer columns.
+        df = df.copy()
+        for column, column_type in column_types.items():
+            is_integer = column_type.upper() in INTEGER_TYPES
+            if is_integer and df[column].dtype.kind == 'f':
+                values = [None if isnull(value) else int(value)
+                          for value in df[column]]
+                df[column] = Series(values, index=df.index, dtype=object)
+        return df
+
+    @staticmethod
+    def _quote(identifier):
+        return '"%s"' % str(identifier).replace('"', '""')
+
     def _execute_test(self):
         module = '.'.join(['assets', 'sql', self.name])
         test_query = SQLReader(module=module).statements[0]
@@ -3,22 +3,109 @@
 
 from json import loads
 from logging import getLogger
+from time import time
 from pandas import DataFrame
-from requests import Session
+from requests import Session, RequestException
 
 from connectors.base import BaseConnector
 
 
 log = getLogger(__name__)
 
-# Set the API cursor limit
+# Set the API cursor limit (None starts at the adaptive default)
 BATCH_SIZE = None
 
+# Bounds and targets of the adaptive batch size
+DEFAULT_BATCH_SIZE = 200
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 5000
+TARGET_LATENCY = 5.0
+TARGET_BYTES = 5 * 1024 ** 2
+
+# Pages after a failure before the batch size may grow again
+HOLD_PAGES = 5
+
+MAX_RETRIES = 3
+REQUEST_TIMEOUT = 120
+
 
 class ValkfleetAPIError(Exception):
     pass
 
 
+class AdaptiveBatchSize(object):
+    """ Pick the batch size of the next page from the previous ones.
+
+    The size doubles while pages come back in less than half the target
+    latency and bytes, and halves when a page goes over either target or
+    the request fails. It stays within the bounds and does not grow again
+    for a few pages after a failure.
+    """
+
+    def __init__(self, size=None,
+                 min_size=MIN_BATCH_SIZE,
+                 max_size=MAX_BATCH_SIZE,
+                 target_latency=TARGET_LATENCY,
+                 target_bytes=TARGET_BYTES):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.target_bytes = target_bytes
+        self.size = self._bound(size or DEFAULT_BATCH_SIZE)
+
+        self.pages = 0
+        self.items = 0
+        self.errors = 0
+        self.latency = 0.0
+        self.changes = 0
+        self.hold = 0
+
+    def __repr__(self):
+        return '<AdaptiveBatchSize (%s in [%s, %s])>' % (
+            self.size, self.min_size, self.max_size)
+
+    def _bound(self, size):
+        return max(self.min_size, min(self.max_size, int(size)))
+
+    def _resize(self, size, reason):
+        size = self._bound(size)
+        if size != self.size:
+            log.debug('Batch size %s -> %s (%s)', self.size, size, reason)
+            self.size = size
+            self.changes += 1
+
+    def record(self, items, latency, size_bytes):
+        """ Adapt to a page of items that took latency seconds. """
+        self.pages += 1
+        self.items += items
+        self.latency += latency
+        self.hold = max(0, self.hold - 1)
+
+        if latency > self.target_latency or size_bytes > self.target_bytes:
+            reason = '%.1fs, %s bytes' % (latency, size_bytes)
+            self._resize(self.size // 2, reason)
+        elif latency < self.target_latency / 2 and \
+                size_bytes < self.target_bytes / 2 and \
+                items >= self.size and not self.hold:
+            reason = '%.1fs, %s bytes' % (latency, size_bytes)
+            self._resize(self.size * 2, reason)
+
+    def record_error(self, error):
+        self.errors += 1
+        self.hold = HOLD_PAGES
+        self._resize(self.size // 2, error)
+
+    @property
+    def stats(self):
+        mean_latency = self.latency / self.pages if self.pages else 0
+        return {'pages': self.pages,
+                'items': self.items,
+                'errors': self.errors,
+                'changes': self.changes,
+                'mean_latency': round(mean_latency, 3),
+                'batch_size': self.size}
+
+
 class ValkfleetConnector(BaseConnector):
     def _authenticate(self):
         session = Session()
@@ -44,33 +131,84 @@ class ValkfleetConnector(BaseConnector):
 
             raise ValkfleetAPIError(message)
 
-    def _get_endpoint(self, endpoint):
-        url = self.url + '/' + endpoint + '/'
-
-        if BATCH_SIZE:
-            url += '?batch_size=%s' % BATCH_SIZE
+    def iter_pages(self, endpoint, params=None, batch_size=BATCH_SIZE,
+                   batch_param='batch_size', **bounds):
+        """ Follow the cursor of an endpoint and yield the items page by page.
+
+        The endpoint is either a name or a full URL. The batch size adapts
+        to the latency and the size of the pages (see AdaptiveBatchSize,
+        which takes the bounds). A failed request is retried with a smaller
+        batch, up to MAX_RETRIES times in a row.
+        """
+        pages = self.iter_cursor(endpoint, params, batch_size=batch_size,
+                                 batch_param=batch_param, **bounds)
+        for items, _ in pages:
+            yield items
+
+    def iter_cursor(self, endpoint, params=None, cursor=None,
+                    batch_size=BATCH_SIZE, batch_param='batch_size',
+                    **bounds):
+        """ Like iter_pages, but yield (items, cursor) pairs and optionally
+        start from a cursor. The cursor points after the items, so it can
+        be saved to resume later, and is None on the last page.
+        """
+        if endpoint.startswith('http'):
+            url = endpoint
+        else:
+            url = self.url + '/' + endpoint + '/'
 
+        batches = AdaptiveBatchSize(batch_size, **bounds)
+        params = dict(params or {})
         more = True
-        cursor = None
-        uuids = []
-        counter = 1
+        failures = 0
 
         while more:
-            if cursor is not None:
-                url += '?cursor=' + cursor
+            params[batch_param] = batches.size
+            if cursor:
+                params['cursor'] = cursor
+
+            log.debug('Request (page %s, batch %s) = %s',
+                      batches.pages + 1, batches.size, url)
+
+            error = None
+            try:
+                start = time()
+                response = self.db.get(url, params=params,
+                                       timeout=REQUEST_TIMEOUT)
+                latency = time() - start
+                if response.status_code >= 500:
+                    error = '%s %s' % (response.status_code, response.reason)
+                else:
+                    json = response.json()
+                    # Even an empty error, e.g. {"error": {}}, has no items
+                    if 'error' in json:
+                        error = 'API error %r' % (json['error'],)
+            except (RequestException, ValueError) as exception:
+                error = exception
+
+            if error is not None:
+                failures += 1
+                batches.record_error(error)
+                log.warning('Request failed (%s/%s): %s',
+                            failures, MAX_RETRIES, error)
+                if failures >= MAX_RETRIES:
+                    raise ValkfleetAPIError('%s: %s' % (url, error))
+                continue
+
+            failures = 0
+            items = json['items']
+            batches.record(len(items), latency, len(response.content))
 
-            log.debug('Request (cursor %s) = %s', counter, url)
-            response = self.db.get(url)
-            json = loads(response.text)
+            more = json['more']
+            cursor = json['cursor'] if more else None
+            yield items, cursor
 
-            if 'error' in json.keys():
-                raise ValkfleetAPIError('%s' % json)
+        log.info('Done with %s: %s', url, batches.stats)
 
-            items = json['items']
+    def _get_endpoint(self, endpoint):
+        uuids = []
+        for items in self.iter_pages(endpoint):
             uuids.extend(items)
-            more = json['more']
-            cursor = json['cursor']
-            counter += 1
 
         log.debug('Found %s %s', len(uuids), endpoint)
         return uuids
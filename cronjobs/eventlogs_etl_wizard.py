@@ -13,6 +13,7 @@ from datetime import datetime, timedelta
 from logging import getLogger
 from pandas import DataFrame
 
+from common.bloom import SeenKeys
 from common.logger import configure_logger
 from common.sqlreader import SQLReader
 from connectors import ValkfleetConnector, WarehouseConnector
@@ -27,6 +28,11 @@ DEFAULT_BATCH_SIZE = 200
 DEFAULT_START = datetime(2016, 2, 2)
 NOW = datetime.now()
 
+# Events re-read before the last one loaded, see common.bloom
+OVERLAP = timedelta(minutes=10)
+GET_LOADED_KEYS = 10
+GET_KEYS_SINCE = 11
+
 
 configure_logger()
 log = getLogger('audit_logs')
@@ -35,7 +41,8 @@ sql = SQLReader('sql.audit_logs')
 
 def load_audit_logs_into_postgres(options):
     session = ValkfleetConnector().db
-    engine = WarehouseConnector().db
+    dwh = WarehouseConnector()
+    engine = dwh.db
 
     log.info('Loading audit points for {start} to {stop} (batches of {n})'.format(
         start=options.start,
@@ -47,12 +54,30 @@ def load_audit_logs_into_postgres(options):
     result = engine.execute(sql.statements[1])
     resume_from = args.start
 
+    # The events of the overlap that were loaded already are dropped
+    seen = SeenKeys(SCHEMA + '.' + TABLE)
+    seen.evict()
+    last_timestamp = None
+
     if result.rowcount:
-        last_timestamp = list(result)[0][0] + timedelta(milliseconds=1)
-        if last_timestamp > args.start:
-            resume_from = last_timestamp
+        last_timestamp = list(result)[0][0]
+        if last_timestamp - OVERLAP > args.start:
+            resume_from = last_timestamp - OVERLAP
             log.info('Resuming at %s', resume_from)
 
+    if last_timestamp and seen.missing_days(resume_from, last_timestamp):
+        loaded = engine.execute(sql.statements[GET_KEYS_SINCE],
+                                {'since': resume_from})
+        loaded = DataFrame.from_records(list(loaded),
+                                        columns=['uuid', 'timestamp'])
+        seen.add(loaded['uuid'].values, loaded['timestamp'])
+        seen.save()
+
+    def loaded_keys(uuids):
+        loaded = engine.execute(sql.statements[GET_LOADED_KEYS],
+                                {'since': resume_from, 'uuids': uuids})
+        return [row[0] for row in loaded]
+
     cursor = None
     more = True
     batch_counter = 0
@@ -87,11 +112,15 @@ def load_audit_logs_into_postgres(options):
 
             if batch.empty:
                 log.warning('Batch %s is empty', batch_counter)
+                continue
+
+            batch = seen.drop_seen(batch, 'uuid', 'timestamp',
+                                   confirm=loaded_keys)
+            if batch.empty:
+                log.info('Batch %s was loaded already', batch_counter)
+                continue
 
-            batch.to_sql(TABLE, engine,
-                         schema=SCHEMA,
-                         if_exists='append',
-                         index=False)
+            dwh.bulk_load(batch, TABLE, SCHEMA)
 
             # The time columns are actually strings
             batch_min_timestamp = batch['timestamp'].min()[:19]
@@ -117,8 +146,10 @@ def load_audit_logs_into_postgres(options):
                 error=response.json()
             )
             log.error(message, exc_info=True)
+            seen.save()
             exit(message)
 
+    seen.save()
     log.info('Finished loading tracks for %s to %s', options.start, NOW)
 
 
@@ -4,10 +4,10 @@ both in the public.delivery and tableau.delivery tables of the DH BI
 PostgreSQL DB
 '''
 import argparse
-import csv
+import collections
+import concurrent.futures
 import datetime
 import io
-import json
 import logging
 import os
 import pprint
@@ -16,12 +16,15 @@ import time
 import urllib.request
 
 import arrow
+import numpy as np
+import pandas as pd
 import psycopg2
 
 from common.logging_configurer import LOG_DIR
 from scripts import get_fleets_from_backend as fleets
 from connectors.backend import BackendConnector
 from common import logging_configurer
+from common.delivery_changes import create_change_tables
 
 MODULE_NAME = 'get_deliveries_from_backend'
 LOGIN_URL = 'https://api.valkfleet.com/login'
@@ -72,369 +75,548 @@ EXPECTED_FIELDS = ('fleet', 'timezone', 'order_uuid', 'delivery_uuid',
                    'sla_met'
                    )
 
+# Column types of the reporting CSV. Fields that are not listed here are
+# passed through as text and cast by Postgres.
+FIELD_TYPES = {
+    'ordering_in_route': 'integer',
+    'distance_traveled_to_customer': 'integer',
+    'distance_to_restaurant': 'integer',
+    'distance_traveled_to_restaurant': 'integer',
+    'delivery_fee': 'integer',
+
+    'battery_status': 'float',
+    'distance_to_customer': 'float',
+    'total': 'float',
+    'air_distance_to_customer': 'float',
+    'customer_lat': 'float',
+    'customer_lng': 'float',
+
+    'sla_met': 'boolean',
+
+    'last_delivery_status_timestamp': 'datetime',
+    'transaction_timestamp': 'datetime',
+    'created_at_timestamp': 'datetime',
+    'accepted_timestamp': 'datetime',
+    'at_restaurant_timestamp': 'datetime',
+    'start_route_timestamp': 'datetime',
+    'real_pickup_timestamp': 'datetime',
+    'requested_pickup_timestamp': 'datetime',
+    'confirmed_pickup_timestamp': 'datetime',
+    'pick_up_eta': 'datetime',
+    'delivery_at_eta': 'datetime',
+    }
+
+CSV_SCHEMA = tuple((field, FIELD_TYPES.get(field, 'text'))
+                   for field in EXPECTED_FIELDS)
+
+# The parser adds the created_at_hour to the CSV fields
+STAGING_FIELDS = EXPECTED_FIELDS + ('created_at_hour',)
+
 # Legacy table: public.delivery, still used by most reports. The last field
 # is the driver_uuid. SOon to be implemented as a view on the new table.
 # New table: tableau.delivery, used by fewer reports, but contains all the
 # fields
 
-COUNT_EXISTING_SQL_PUBLIC = """
-SELECT COUNT(*)
-FROM public.delivery
-WHERE delivery_uuid = %s;
+# Each hourly batch is copied once into a temporary staging table and then
+# merged into the three delivery tables with set-based statements, all in
+# one transaction. The staging table borrows its column types from
+# tableau.delivery, so COPY casts the values like the old row INSERTs did.
+# The gastronomic_day and created_at_hour are derived by the CSV parser.
+# The fleet info of delivery_dwh is joined from tableau.fleet on the way in;
+# reenrich_fleet_info catches up the old rows when tableau.fleet changes.
+
+CREATE_STAGING_SQL = """
+CREATE TEMPORARY TABLE delivery_staging
+ON COMMIT DROP AS
+SELECT fleet, timezone, order_uuid, delivery_uuid, delivery_short_id,
+source_name, source_id, route_id, ordering_in_route,
+source_transaction_id, restaurant_uuid, restaurant_name,
+restaurant_city, restaurant_zipcode, restaurant_source_id,
+driver_username, battery_status, customer_phone_number,
+customer_street, customer_number, customer_zipcode, customer_city,
+customer_country, customer_raw_address, distance_to_customer,
+distance_traveled_to_customer, distance_to_restaurant,
+distance_traveled_to_restaurant, total, payment_type, delivery_fee,
+last_delivery_status, last_delivery_status_timestamp,
+transaction_timestamp, created_at_timestamp, assigned_timestamp,
+fc_reaction_timestamp, assignment_accuracy, accepted_timestamp,
+driver_reaction_timestamp, at_restaurant_timestamp,
+start_route_timestamp, real_pickup_timestamp,
+requested_pickup_timestamp, confirmed_pickup_timestamp,
+requested_delivery_timestamp, expected_delivery_timestamp,
+waiting_time, pick_up_eta, delivery_at_eta, cancellation_reason,
+assigned_by, cancelled_by, reassigned_by, unassigned_by,
+gastronomic_day, driver_uuid, air_distance_to_customer, customer_lat,
+customer_lng, sla_met, created_at_hour
+FROM tableau.delivery
+WITH NO DATA;
 """
 
-INSERT_SQL_PUBLIC = """
-INSERT INTO public.delivery
-(fleet, timezone, order_uuid, delivery_uuid,
-delivery_short_id, source_name, source_id,
-route_id, ordering_in_route, source_transaction_id,
-restaurant_uuid, restaurant_name, restaurant_city,
-restaurant_zipcode, restaurant_source_id,
-driver_username, battery_status,
-customer_phone_number, customer_street,
-customer_number, customer_zipcode, customer_city,
-customer_country, customer_raw_address,
-distance_to_customer, distance_traveled_to_customer,
-distance_to_restaurant, distance_traveled_to_restaurant,
-total, payment_type, delivery_fee,
+COPY_STAGING_SQL = """
+COPY delivery_staging
+(fleet, timezone, order_uuid, delivery_uuid, delivery_short_id,
+source_name, source_id, route_id, ordering_in_route,
+source_transaction_id, restaurant_uuid, restaurant_name,
+restaurant_city, restaurant_zipcode, restaurant_source_id,
+driver_username, battery_status, customer_phone_number,
+customer_street, customer_number, customer_zipcode, customer_city,
+customer_country, customer_raw_address, distance_to_customer,
+distance_traveled_to_customer, distance_to_restaurant,
+distance_traveled_to_restaurant, total, payment_type, delivery_fee,
 last_delivery_status, last_delivery_status_timestamp,
-transaction_timestamp, created_at_timestamp,
-assigned_timestamp, fc_reaction_timestamp,
-assignment_accuracy, accepted_timestamp,
+transaction_timestamp, created_at_timestamp, assigned_timestamp,
+fc_reaction_timestamp, assignment_accuracy, accepted_timestamp,
 driver_reaction_timestamp, at_restaurant_timestamp,
 start_route_timestamp, real_pickup_timestamp,
 requested_pickup_timestamp, confirmed_pickup_timestamp,
-requested_delivery_timestamp,
-expected_delivery_timestamp, waiting_time,
-pick_up_eta, delivery_at_eta, cancellation_reason,
-assigned_by, cancelled_by, reassigned_by,
-unassigned_by, gastronomic_day, driver_uuid)
-VALUES (
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, date_trunc('day', %s), %s
-);
+requested_delivery_timestamp, expected_delivery_timestamp,
+waiting_time, pick_up_eta, delivery_at_eta, cancellation_reason,
+assigned_by, cancelled_by, reassigned_by, unassigned_by,
+gastronomic_day, driver_uuid, air_distance_to_customer, customer_lat,
+customer_lng, sla_met, created_at_hour)
+FROM STDIN WITH CSV NULL '\\N';
 """
 
-UPDATE_SQL_PUBLIC = """
-UPDATE public.delivery SET
-fleet = %s,
-timezone = %s,
-order_uuid = %s,
-delivery_short_id = %s,
-source_name = %s,
-source_id = %s,
-route_id = %s,
-ordering_in_route = %s,
-source_transaction_id = %s,
-restaurant_uuid = %s,
-restaurant_name = %s,
-restaurant_city = %s,
-restaurant_zipcode = %s,
-restaurant_source_id = %s,
-driver_username = %s,
-battery_status = %s,
-customer_phone_number = %s,
-customer_street = %s,
-customer_number = %s,
-customer_zipcode = %s,
-customer_city = %s,
-customer_country = %s,
-customer_raw_address = %s,
-distance_to_customer = %s,
-distance_traveled_to_customer = %s,
-distance_to_restaurant = %s,
-distance_traveled_to_restaurant = %s,
-total = %s,
-payment_type = %s,
-delivery_fee = %s,
-last_delivery_status = %s,
-last_delivery_status_timestamp = %s,
-transaction_timestamp = %s,
-created_at_timestamp = %s,
-assigned_timestamp = %s,
-fc_reaction_timestamp = %s,
-assignment_accuracy = %s,
-accepted_timestamp = %s,
-driver_reaction_timestamp = %s,
-at_restaurant_timestamp = %s,
-start_route_timestamp = %s,
-real_pickup_timestamp = %s,
-requested_pickup_timestamp = %s,
-confirmed_pickup_timestamp = %s,
-requested_delivery_timestamp = %s,
-expected_delivery_timestamp = %s,
-waiting_time = %s,
-pick_up_eta = %s,
-delivery_at_eta = %s,
-cancellation_reason = %s,
-assigned_by = %s,
-cancelled_by = %s,
-reassigned_by = %s,
-unassigned_by = %s,
-gastronomic_day = date_trunc('day', %s),
-driver_uuid = %s
-WHERE delivery_uuid = %s;
+UPDATE_FROM_STAGING_SQL_PUBLIC = """
+UPDATE public.delivery AS target SET
+fleet = staging.fleet,
+timezone = staging.timezone,
+order_uuid = staging.order_uuid,
+delivery_short_id = staging.delivery_short_id,
+source_name = staging.source_name,
+source_id = staging.source_id,
+route_id = staging.route_id,
+ordering_in_route = staging.ordering_in_route,
+source_transaction_id = staging.source_transaction_id,
+restaurant_uuid = staging.restaurant_uuid,
+restaurant_name = staging.restaurant_name,
+restaurant_city = staging.restaurant_city,
+restaurant_zipcode = staging.restaurant_zipcode,
+restaurant_source_id = staging.restaurant_source_id,
+driver_username = staging.driver_username,
+battery_status = staging.battery_status,
+customer_phone_number = staging.customer_phone_number,
+customer_street = staging.customer_street,
+customer_number = staging.customer_number,
+customer_zipcode = staging.customer_zipcode,
+customer_city = staging.customer_city,
+customer_country = staging.customer_country,
+customer_raw_address = staging.customer_raw_address,
+distance_to_customer = staging.distance_to_customer,
+distance_traveled_to_customer = staging.distance_traveled_to_customer,
+distance_to_restaurant = staging.distance_to_restaurant,
+distance_traveled_to_restaurant = staging.distance_traveled_to_restaurant,
+total = staging.total,
+payment_type = staging.payment_type,
+delivery_fee = staging.delivery_fee,
+last_delivery_status = staging.last_delivery_status,
+last_delivery_status_timestamp = staging.last_delivery_status_timestamp,
+transaction_timestamp = staging.transaction_timestamp,
+created_at_timestamp = staging.created_at_timestamp,
+assigned_timestamp = staging.assigned_timestamp,
+fc_reaction_timestamp = staging.fc_reaction_timestamp,
+assignment_accuracy = staging.assignment_accuracy,
+accepted_timestamp = staging.accepted_timestamp,
+driver_reaction_timestamp = staging.driver_reaction_timestamp,
+at_restaurant_timestamp = staging.at_restaurant_timestamp,
+start_route_timestamp = staging.start_route_timestamp,
+real_pickup_timestamp = staging.real_pickup_timestamp,
+requested_pickup_timestamp = staging.requested_pickup_timestamp,
+confirmed_pickup_timestamp = staging.confirmed_pickup_timestamp,
+requested_delivery_timestamp = staging.requested_delivery_timestamp,
+expected_delivery_timestamp = staging.expected_delivery_timestamp,
+waiting_time = staging.waiting_time,
+pick_up_eta = staging.pick_up_eta,
+delivery_at_eta = staging.delivery_at_eta,
+cancellation_reason = staging.cancellation_reason,
+assigned_by = staging.assigned_by,
+cancelled_by = staging.cancelled_by,
+reassigned_by = staging.reassigned_by,
+unassigned_by = staging.unassigned_by,
+gastronomic_day = date_trunc('day', staging.gastronomic_day),
+driver_uuid = staging.driver_uuid
+FROM delivery_staging AS staging
+WHERE target.delivery_uuid = staging.delivery_uuid;
 """
 
-COUNT_EXISTING_SQL_TABLEAU = """
-SELECT COUNT(*)
-FROM tableau.delivery
-WHERE delivery_uuid = %s;
+INSERT_FROM_STAGING_SQL_PUBLIC = """
+INSERT INTO public.delivery
+(fleet, timezone, order_uuid, delivery_uuid, delivery_short_id,
+source_name, source_id, route_id, ordering_in_route,
+source_transaction_id, restaurant_uuid, restaurant_name,
+restaurant_city, restaurant_zipcode, restaurant_source_id,
+driver_username, battery_status, customer_phone_number,
+customer_street, customer_number, customer_zipcode, customer_city,
+customer_country, customer_raw_address, distance_to_customer,
+distance_traveled_to_customer, distance_to_restaurant,
+distance_traveled_to_restaurant, total, payment_type, delivery_fee,
+last_delivery_status, last_delivery_status_timestamp,
+transaction_timestamp, created_at_timestamp, assigned_timestamp,
+fc_reaction_timestamp, assignment_accuracy, accepted_timestamp,
+driver_reaction_timestamp, at_restaurant_timestamp,
+start_route_timestamp, real_pickup_timestamp,
+requested_pickup_timestamp, confirmed_pickup_timestamp,
+requested_delivery_timestamp, expected_delivery_timestamp,
+waiting_time, pick_up_eta, delivery_at_eta, cancellation_reason,
+assigned_by, cancelled_by, reassigned_by, unassigned_by,
+gastronomic_day, driver_uuid)
+SELECT
+staging.fleet, staging.timezone, staging.order_uuid,
+staging.delivery_uuid, staging.delivery_short_id, staging.source_name,
+staging.source_id, staging.route_id, staging.ordering_in_route,
+staging.source_transaction_id, staging.restaurant_uuid,
+staging.restaurant_name, staging.restaurant_city,
+staging.restaurant_zipcode, staging.restaurant_source_id,
+staging.driver_username, staging.battery_status,
+staging.customer_phone_number, staging.customer_street,
+staging.customer_number, staging.customer_zipcode,
+staging.customer_city, staging.customer_country,
+staging.customer_raw_address, staging.distance_to_customer,
+staging.distance_traveled_to_customer, staging.distance_to_restaurant,
+staging.distance_traveled_to_restaurant, staging.total,
+staging.payment_type, staging.delivery_fee,
+staging.last_delivery_status, staging.last_delivery_status_timestamp,
+staging.transaction_timestamp, staging.created_at_timestamp,
+staging.assigned_timestamp, staging.fc_reaction_timestamp,
+staging.assignment_accuracy, staging.accepted_timestamp,
+staging.driver_reaction_timestamp, staging.at_restaurant_timestamp,
+staging.start_route_timestamp, staging.real_pickup_timestamp,
+staging.requested_pickup_timestamp,
+staging.confirmed_pickup_timestamp,
+staging.requested_delivery_timestamp,
+staging.expected_delivery_timestamp, staging.waiting_time,
+staging.pick_up_eta, staging.delivery_at_eta,
+staging.cancellation_reason, staging.assigned_by,
+staging.cancelled_by, staging.reassigned_by, staging.unassigned_by,
+date_trunc('day', staging.gastronomic_day), staging.driver_uuid
+FROM delivery_staging AS staging
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM public.delivery AS target
+    WHERE target.delivery_uuid = staging.delivery_uuid
+);
 """
 
-INSERT_SQL_TABLEAU = """
+UPDATE_FROM_STAGING_SQL_TABLEAU = """
+UPDATE tableau.delivery AS target SET
+fleet = staging.fleet,
+timezone = staging.timezone,
+order_uuid = staging.order_uuid,
+delivery_short_id = staging.delivery_short_id,
+source_name = staging.source_name,
+source_id = staging.source_id,
+route_id = staging.route_id,
+ordering_in_route = staging.ordering_in_route,
+source_transaction_id = staging.source_transaction_id,
+restaurant_uuid = staging.restaurant_uuid,
+restaurant_name = staging.restaurant_name,
+restaurant_city = staging.restaurant_city,
+restaurant_zipcode = staging.restaurant_zipcode,
+restaurant_source_id = staging.restaurant_source_id,
+driver_username = staging.driver_username,
+battery_status = staging.battery_status,
+customer_phone_number = staging.customer_phone_number,
+customer_street = staging.customer_street,
+customer_number = staging.customer_number,
+customer_zipcode = staging.customer_zipcode,
+customer_city = staging.customer_city,
+customer_country = staging.customer_country,
+customer_raw_address = staging.customer_raw_address,
+distance_to_customer = staging.distance_to_customer,
+distance_traveled_to_customer = staging.distance_traveled_to_customer,
+distance_to_restaurant = staging.distance_to_restaurant,
+distance_traveled_to_restaurant = staging.distance_traveled_to_restaurant,
+total = staging.total,
+payment_type = staging.payment_type,
+delivery_fee = staging.delivery_fee,
+last_delivery_status = staging.last_delivery_status,
+last_delivery_status_timestamp = staging.last_delivery_status_timestamp,
+transaction_timestamp = staging.transaction_timestamp,
+created_at_timestamp = staging.created_at_timestamp,
+assigned_timestamp = staging.assigned_timestamp,
+fc_reaction_timestamp = staging.fc_reaction_timestamp,
+assignment_accuracy = staging.assignment_accuracy,
+accepted_timestamp = staging.accepted_timestamp,
+driver_reaction_timestamp = staging.driver_reaction_timestamp,
+at_restaurant_timestamp = staging.at_restaurant_timestamp,
+start_route_timestamp = staging.start_route_timestamp,
+real_pickup_timestamp = staging.real_pickup_timestamp,
+requested_pickup_timestamp = staging.requested_pickup_timestamp,
+confirmed_pickup_timestamp = staging.confirmed_pickup_timestamp,
+requested_delivery_timestamp = staging.requested_delivery_timestamp,
+expected_delivery_timestamp = staging.expected_delivery_timestamp,
+waiting_time = staging.waiting_time,
+pick_up_eta = staging.pick_up_eta,
+delivery_at_eta = staging.delivery_at_eta,
+cancellation_reason = staging.cancellation_reason,
+assigned_by = staging.assigned_by,
+cancelled_by = staging.cancelled_by,
+reassigned_by = staging.reassigned_by,
+unassigned_by = staging.unassigned_by,
+gastronomic_day = date_trunc('day', staging.gastronomic_day),
+driver_uuid = staging.driver_uuid,
+air_distance_to_customer = staging.air_distance_to_customer,
+customer_lat = staging.customer_lat,
+customer_lng = staging.customer_lng,
+sla_met = staging.sla_met,
+created_at_hour = staging.created_at_hour
+FROM delivery_staging AS staging
+WHERE target.delivery_uuid = staging.delivery_uuid;
+"""
+
+INSERT_FROM_STAGING_SQL_TABLEAU = """
 INSERT INTO tableau.delivery
-(fleet, timezone, order_uuid, delivery_uuid,
-delivery_short_id, source_name, source_id,
-route_id, ordering_in_route, source_transaction_id,
-restaurant_uuid, restaurant_name, restaurant_city,
-restaurant_zipcode, restaurant_source_id,
-driver_username, battery_status,
-customer_phone_number, customer_street,
-customer_number, customer_zipcode, customer_city,
-customer_country, customer_raw_address,
-distance_to_customer, distance_traveled_to_customer,
-distance_to_restaurant, distance_traveled_to_restaurant,
-total, payment_type, delivery_fee,
+(fleet, timezone, order_uuid, delivery_uuid, delivery_short_id,
+source_name, source_id, route_id, ordering_in_route,
+source_transaction_id, restaurant_uuid, restaurant_name,
+restaurant_city, restaurant_zipcode, restaurant_source_id,
+driver_username, battery_status, customer_phone_number,
+customer_street, customer_number, customer_zipcode, customer_city,
+customer_country, customer_raw_address, distance_to_customer,
+distance_traveled_to_customer, distance_to_restaurant,
+distance_traveled_to_restaurant, total, payment_type, delivery_fee,
 last_delivery_status, last_delivery_status_timestamp,
-transaction_timestamp, created_at_timestamp,
-assigned_timestamp, fc_reaction_timestamp,
-assignment_accuracy, accepted_timestamp,
+transaction_timestamp, created_at_timestamp, assigned_timestamp,
+fc_reaction_timestamp, assignment_accuracy, accepted_timestamp,
 driver_reaction_timestamp, at_restaurant_timestamp,
 start_route_timestamp, real_pickup_timestamp,
 requested_pickup_timestamp, confirmed_pickup_timestamp,
-requested_delivery_timestamp,
-expected_delivery_timestamp, waiting_time,
-pick_up_eta, delivery_at_eta, cancellation_reason,
-assigned_by, cancelled_by, reassigned_by,
-unassigned_by, gastronomic_day, driver_uuid,
-
-air_distance_to_customer, customer_lat,
+requested_delivery_timestamp, expected_delivery_timestamp,
+waiting_time, pick_up_eta, delivery_at_eta, cancellation_reason,
+assigned_by, cancelled_by, reassigned_by, unassigned_by,
+gastronomic_day, driver_uuid, air_distance_to_customer, customer_lat,
 customer_lng, sla_met, created_at_hour)
-VALUES (
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, date_trunc('day', %s), %s,
-%s, %s, %s, %s, date_part('hour', %s)
+SELECT
+staging.fleet, staging.timezone, staging.order_uuid,
+staging.delivery_uuid, staging.delivery_short_id, staging.source_name,
+staging.source_id, staging.route_id, staging.ordering_in_route,
+staging.source_transaction_id, staging.restaurant_uuid,
+staging.restaurant_name, staging.restaurant_city,
+staging.restaurant_zipcode, staging.restaurant_source_id,
+staging.driver_username, staging.battery_status,
+staging.customer_phone_number, staging.customer_street,
+staging.customer_number, staging.customer_zipcode,
+staging.customer_city, staging.customer_country,
+staging.customer_raw_address, staging.distance_to_customer,
+staging.distance_traveled_to_customer, staging.distance_to_restaurant,
+staging.distance_traveled_to_restaurant, staging.total,
+staging.payment_type, staging.delivery_fee,
+staging.last_delivery_status, staging.last_delivery_status_timestamp,
+staging.transaction_timestamp, staging.created_at_timestamp,
+staging.assigned_timestamp, staging.fc_reaction_timestamp,
+staging.assignment_accuracy, staging.accepted_timestamp,
+staging.driver_reaction_timestamp, staging.at_restaurant_timestamp,
+staging.start_route_timestamp, staging.real_pickup_timestamp,
+staging.requested_pickup_timestamp,
+staging.confirmed_pickup_timestamp,
+staging.requested_delivery_timestamp,
+staging.expected_delivery_timestamp, staging.waiting_time,
+staging.pick_up_eta, staging.delivery_at_eta,
+staging.cancellation_reason, staging.assigned_by,
+staging.cancelled_by, staging.reassigned_by, staging.unassigned_by,
+date_trunc('day', staging.gastronomic_day), staging.driver_uuid,
+staging.air_distance_to_customer, staging.customer_lat,
+staging.customer_lng, staging.sla_met, staging.created_at_hour
+FROM delivery_staging AS staging
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM tableau.delivery AS target
+    WHERE target.delivery_uuid = staging.delivery_uuid
 );
 """
 
-UPDATE_SQL_TABLEAU = """
-UPDATE tableau.delivery SET
-fleet = %s,
-timezone = %s,
-order_uuid = %s,
-delivery_short_id = %s,
-source_name = %s,
-source_id = %s,
-route_id = %s,
-ordering_in_route = %s,
-source_transaction_id = %s,
-restaurant_uuid = %s,
-restaurant_name = %s,
-restaurant_city = %s,
-restaurant_zipcode = %s,
-restaurant_source_id = %s,
-driver_username = %s,
-battery_status = %s,
-customer_phone_number = %s,
-customer_street = %s,
-customer_number = %s,
-customer_zipcode = %s,
-customer_city = %s,
-customer_country = %s,
-customer_raw_address = %s,
-distance_to_customer = %s,
-distance_traveled_to_customer = %s,
-distance_to_restaurant = %s,
-distance_traveled_to_restaurant = %s,
-total = %s,
-payment_type = %s,
-delivery_fee = %s,
-last_delivery_status = %s,
-last_delivery_status_timestamp = %s,
-transaction_timestamp = %s,
-created_at_timestamp = %s,
-assigned_timestamp = %s,
-fc_reaction_timestamp = %s,
-assignment_accuracy = %s,
-accepted_timestamp = %s,
-driver_reaction_timestamp = %s,
-at_restaurant_timestamp = %s,
-start_route_timestamp = %s,
-real_pickup_timestamp = %s,
-requested_pickup_timestamp = %s,
-confirmed_pickup_timestamp = %s,
-requested_delivery_timestamp = %s,
-expected_delivery_timestamp = %s,
-waiting_time = %s,
-pick_up_eta = %s,
-delivery_at_eta = %s,
-cancellation_reason = %s,
-assigned_by = %s,
-cancelled_by = %s,
-reassigned_by = %s,
-unassigned_by = %s,
-gastronomic_day = date_trunc('day', %s),
-driver_uuid = %s,
-
-air_distance_to_customer = %s,
-customer_lat = %s,
-customer_lng = %s,
-sla_met = %s,
-created_at_hour = date_part('hour', %s)
-WHERE delivery_uuid = %s;
+UPDATE_FROM_STAGING_SQL_DWH = """
+UPDATE tableau.delivery_dwh AS target SET
+fleet_backend_name = staging.fleet,
+timezone = staging.timezone,
+order_uuid = staging.order_uuid,
+delivery_short_id = staging.delivery_short_id,
+source_name = staging.source_name,
+source_id = staging.source_id,
+route_id = staging.route_id,
+ordering_in_route = staging.ordering_in_route,
+source_transaction_id = staging.source_transaction_id,
+restaurant_uuid = staging.restaurant_uuid,
+restaurant_name = staging.restaurant_name,
+restaurant_city = staging.restaurant_city,
+restaurant_zipcode = staging.restaurant_zipcode,
+restaurant_source_id = staging.restaurant_source_id,
+driver_username = staging.driver_username,
+battery_status = staging.battery_status,
+customer_phone_number = staging.customer_phone_number,
+customer_street = staging.customer_street,
+customer_number = staging.customer_number,
+customer_zipcode = staging.customer_zipcode,
+customer_city = staging.customer_city,
+customer_country = staging.customer_country,
+customer_raw_address = staging.customer_raw_address,
+distance_to_customer = staging.distance_to_customer,
+distance_traveled_to_customer = staging.distance_traveled_to_customer,
+distance_to_restaurant = staging.distance_to_restaurant,
+distance_traveled_to_restaurant = staging.distance_traveled_to_restaurant,
+total = staging.total,
+payment_type = staging.payment_type,
+delivery_fee = staging.delivery_fee,
+last_delivery_status = staging.last_delivery_status,
+last_delivery_status_timestamp = staging.last_delivery_status_timestamp,
+transaction_timestamp = staging.transaction_timestamp,
+created_at_timestamp = staging.created_at_timestamp,
+assigned_timestamp = staging.assigned_timestamp,
+fc_reaction_timestamp = staging.fc_reaction_timestamp,
+assignment_accuracy = staging.assignment_accuracy,
+accepted_timestamp = staging.accepted_timestamp,
+driver_reaction_timestamp = staging.driver_reaction_timestamp,
+at_restaurant_timestamp = staging.at_restaurant_timestamp,
+start_route_timestamp = staging.start_route_timestamp,
+real_pickup_timestamp = staging.real_pickup_timestamp,
+requested_pickup_timestamp = staging.requested_pickup_timestamp,
+confirmed_pickup_timestamp = staging.confirmed_pickup_timestamp,
+requested_delivery_timestamp = staging.requested_delivery_timestamp,
+expected_delivery_timestamp = staging.expected_delivery_timestamp,
+waiting_time = staging.waiting_time,
+pick_up_eta = staging.pick_up_eta,
+delivery_at_eta = staging.delivery_at_eta,
+cancellation_reason = staging.cancellation_reason,
+assigned_by = staging.assigned_by,
+cancelled_by = staging.cancelled_by,
+reassigned_by = staging.reassigned_by,
+unassigned_by = staging.unassigned_by,
+gastronomic_day = date_trunc('day', staging.gastronomic_day),
+driver_uuid = staging.driver_uuid,
+air_distance_to_customer = staging.air_distance_to_customer,
+customer_lat = staging.customer_lat,
+customer_lng = staging.customer_lng,
+sla_met = staging.sla_met,
+created_at_hour = staging.created_at_hour,
+fleet_display_name = fleet.display_name,
+fleet_uuid = fleet.uuid,
+fleet_country_code = fleet.country_code,
+fleet_country_name = fleet.country_name,
+fleet_city = fleet.city
+FROM delivery_staging AS staging
+LEFT JOIN tableau.fleet AS fleet
+ON fleet.backend_name = staging.fleet
+WHERE target.delivery_uuid = staging.delivery_uuid;
 """
 
-
-COUNT_EXISTING_SQL_DWH = """
-SELECT COUNT(*)
-FROM tableau.delivery_dwh
-WHERE delivery_uuid = %s;
-"""
-
-INSERT_SQL_DWH = """
+INSERT_FROM_STAGING_SQL_DWH = """
 INSERT INTO tableau.delivery_dwh
 (fleet_backend_name, timezone, order_uuid, delivery_uuid,
-delivery_short_id, source_name, source_id,
-route_id, ordering_in_route, source_transaction_id,
-restaurant_uuid, restaurant_name, restaurant_city,
-restaurant_zipcode, restaurant_source_id,
-driver_username, battery_status,
-customer_phone_number, customer_street,
-customer_number, customer_zipcode, customer_city,
-customer_country, customer_raw_address,
-distance_to_customer, distance_traveled_to_customer,
-distance_to_restaurant, distance_traveled_to_restaurant,
-total, payment_type, delivery_fee,
+delivery_short_id, source_name, source_id, route_id,
+ordering_in_route, source_transaction_id, restaurant_uuid,
+restaurant_name, restaurant_city, restaurant_zipcode,
+restaurant_source_id, driver_username, battery_status,
+customer_phone_number, customer_street, customer_number,
+customer_zipcode, customer_city, customer_country,
+customer_raw_address, distance_to_customer,
+distance_traveled_to_customer, distance_to_restaurant,
+distance_traveled_to_restaurant, total, payment_type, delivery_fee,
 last_delivery_status, last_delivery_status_timestamp,
-transaction_timestamp, created_at_timestamp,
-assigned_timestamp, fc_reaction_timestamp,
-assignment_accuracy, accepted_timestamp,
+transaction_timestamp, created_at_timestamp, assigned_timestamp,
+fc_reaction_timestamp, assignment_accuracy, accepted_timestamp,
 driver_reaction_timestamp, at_restaurant_timestamp,
 start_route_timestamp, real_pickup_timestamp,
 requested_pickup_timestamp, confirmed_pickup_timestamp,
-requested_delivery_timestamp,
-expected_delivery_timestamp, waiting_time,
-pick_up_eta, delivery_at_eta, cancellation_reason,
-assigned_by, cancelled_by, reassigned_by,
-unassigned_by, gastronomic_day, driver_uuid,
-
-air_distance_to_customer, customer_lat,
-customer_lng, sla_met, created_at_hour)
-VALUES (
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-%s, %s, %s, %s, %s, date_trunc('day', %s), %s,
-%s, %s, %s, %s, date_part('hour', %s)
+requested_delivery_timestamp, expected_delivery_timestamp,
+waiting_time, pick_up_eta, delivery_at_eta, cancellation_reason,
+assigned_by, cancelled_by, reassigned_by, unassigned_by,
+gastronomic_day, driver_uuid, air_distance_to_customer, customer_lat,
+customer_lng, sla_met, created_at_hour, fleet_display_name, fleet_uuid,
+fleet_country_code, fleet_country_name, fleet_city)
+SELECT
+staging.fleet, staging.timezone, staging.order_uuid,
+staging.delivery_uuid, staging.delivery_short_id, staging.source_name,
+staging.source_id, staging.route_id, staging.ordering_in_route,
+staging.source_transaction_id, staging.restaurant_uuid,
+staging.restaurant_name, staging.restaurant_city,
+staging.restaurant_zipcode, staging.restaurant_source_id,
+staging.driver_username, staging.battery_status,
+staging.customer_phone_number, staging.customer_street,
+staging.customer_number, staging.customer_zipcode,
+staging.customer_city, staging.customer_country,
+staging.customer_raw_address, staging.distance_to_customer,
+staging.distance_traveled_to_customer, staging.distance_to_restaurant,
+staging.distance_traveled_to_restaurant, staging.total,
+staging.payment_type, staging.delivery_fee,
+staging.last_delivery_status, staging.last_delivery_status_timestamp,
+staging.transaction_timestamp, staging.created_at_timestamp,
+staging.assigned_timestamp, staging.fc_reaction_timestamp,
+staging.assignment_accuracy, staging.accepted_timestamp,
+staging.driver_reaction_timestamp, staging.at_restaurant_timestamp,
+staging.start_route_timestamp, staging.real_pickup_timestamp,
+staging.requested_pickup_timestamp,
+staging.confirmed_pickup_timestamp,
+staging.requested_delivery_timestamp,
+staging.expected_delivery_timestamp, staging.waiting_time,
+staging.pick_up_eta, staging.delivery_at_eta,
+staging.cancellation_reason, staging.assigned_by,
+staging.cancelled_by, staging.reassigned_by, staging.unassigned_by,
+date_trunc('day', staging.gastronomic_day), staging.driver_uuid,
+staging.air_distance_to_customer, staging.customer_lat,
+staging.customer_lng, staging.sla_met, staging.created_at_hour,
+fleet.display_name, fleet.uuid, fleet.country_code, fleet.country_name,
+fleet.city
+FROM delivery_staging AS staging
+LEFT JOIN tableau.fleet AS fleet
+ON fleet.backend_name = staging.fleet
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM tableau.delivery_dwh AS target
+    WHERE target.delivery_uuid = staging.delivery_uuid
 );
 """
 
-UPDATE_SQL_DWH = """
-UPDATE tableau.delivery_dwh SET
-fleet_backend_name = %s,
-timezone = %s,
-order_uuid = %s,
-delivery_short_id = %s,
-source_name = %s,
-source_id = %s,
-route_id = %s,
-ordering_in_route = %s,
-source_transaction_id = %s,
-restaurant_uuid = %s,
-restaurant_name = %s,
-restaurant_city = %s,
-restaurant_zipcode = %s,
-restaurant_source_id = %s,
-driver_username = %s,
-battery_status = %s,
-customer_phone_number = %s,
-customer_street = %s,
-customer_number = %s,
-customer_zipcode = %s,
-customer_city = %s,
-customer_country = %s,
-customer_raw_address = %s,
-distance_to_customer = %s,
-distance_traveled_to_customer = %s,
-distance_to_restaurant = %s,
-distance_traveled_to_restaurant = %s,
-total = %s,
-payment_type = %s,
-delivery_fee = %s,
-last_delivery_status = %s,
-last_delivery_status_timestamp = %s,
-transaction_timestamp = %s,
-created_at_timestamp = %s,
-assigned_timestamp = %s,
-fc_reaction_timestamp = %s,
-assignment_accuracy = %s,
-accepted_timestamp = %s,
-driver_reaction_timestamp = %s,
-at_restaurant_timestamp = %s,
-start_route_timestamp = %s,
-real_pickup_timestamp = %s,
-requested_pickup_timestamp = %s,
-confirmed_pickup_timestamp = %s,
-requested_delivery_timestamp = %s,
-expected_delivery_timestamp = %s,
-waiting_time = %s,
-pick_up_eta = %s,
-delivery_at_eta = %s,
-cancellation_reason = %s,
-assigned_by = %s,
-cancelled_by = %s,
-reassigned_by = %s,
-unassigned_by = %s,
-gastronomic_day = date_trunc('day', %s),
-driver_uuid = %s,
-
-air_distance_to_customer = %s,
-customer_lat = %s,
-customer_lng = %s,
-sla_met = %s,
-created_at_hour = date_part('hour', %s)
-WHERE delivery_uuid = %s;
-"""
-
+# The test orders of a batch are flagged as cancelled in delivery_dwh once
+# it is merged, in the same transaction, so that the days recorded for the
+# batch are aggregated with the flags.
 CLEANUP_SQL_DWH = """
-UPDATE tableau.delivery_dwh
+UPDATE tableau.delivery_dwh AS target
 set last_delivery_status = 'cancelled',
 cancellation_reason = 'Test Order'
-where
-(restaurant_name = 'New Box - automated tests'
-or driver_username ILIKE 'demo%%'
-or driver_username ILIKE '%%test%%'
-or source_id ILIKE '%%test%%')
-and cancellation_reason <> 'Test Order';
+FROM delivery_staging AS staging
+where target.delivery_uuid = staging.delivery_uuid
+and (target.restaurant_name = 'New Box - automated tests'
+or target.driver_username ILIKE 'demo%%'
+or target.driver_username ILIKE '%%test%%'
+or target.source_id ILIKE '%%test%%')
+and target.cancellation_reason <> 'Test Order';
 """
 
-ADD_FLEET_INFO_SQL_DWH = """
-UPDATE tableau.delivery_dwh
-SET fleet_display_name = tableau.fleet.display_name,
-    fleet_uuid = tableau.fleet.uuid,
-    fleet_country_code = tableau.fleet.country_code,
-    fleet_country_name = tableau.fleet.country_name,
-    fleet_city = tableau.fleet.city
-FROM tableau.fleet
-WHERE tableau.delivery_dwh.fleet_backend_name = tableau.fleet.backend_name;
+# Every batch records the (fleet, gastronomic day) pairs it touches, before
+# and after the merge, so that the tables aggregated from delivery_dwh can
+# be rebuilt for those days only (see common.delivery_changes).
+RECORD_CHANGES_SQL = """
+INSERT INTO tableau.delivery_changes (fleet_backend_name, gastronomic_day)
+SELECT staging.fleet, date_trunc('day', staging.gastronomic_day)::date
+FROM delivery_staging AS staging
+UNION
+SELECT target.fleet_backend_name, target.gastronomic_day::date
+FROM tableau.delivery_dwh AS target
+JOIN delivery_staging AS staging
+ON target.delivery_uuid = staging.delivery_uuid;
 """
 
+MERGE_SQL = (
+    ('tableau.delivery',
+     UPDATE_FROM_STAGING_SQL_TABLEAU, INSERT_FROM_STAGING_SQL_TABLEAU),
+    ('tableau.delivery_dwh',
+     UPDATE_FROM_STAGING_SQL_DWH, INSERT_FROM_STAGING_SQL_DWH),
+    ('public.delivery',
+     UPDATE_FROM_STAGING_SQL_PUBLIC, INSERT_FROM_STAGING_SQL_PUBLIC),
+)
+
+COPY_NULL = '\\N'
 
 ONE_HOUR = datetime.timedelta(hours=1)
 ONE_DAY = datetime.timedelta(days=1)
 GASTRO_DATE_START_HOUR = datetime.time(hour=8)
 
+# Concurrent report downloads, number of windows fetched ahead
+# and default size of the report windows in hours.
+DEFAULT_WORKERS = 8
+PREFETCHED_WINDOWS = 3
+DEFAULT_WINDOW = 1
+
 # __name__ is the name of the module or '__main__'
 logger = logging.getLogger(__name__)
 pp = pprint.PrettyPrinter(indent=4)
@@ -470,6 +652,14 @@ def parse_args():
                         dest='dbpassword', required=True,
                         help='password to log into the DB')
 
+    parser.add_argument('-w', '--workers', action='store', type=int,
+                        dest='workers', default=DEFAULT_WORKERS,
+                        help='number of concurrent report downloads')
+    parser.add_argument('--window', action='store', type=int,
+                        dest='window', default=DEFAULT_WINDOW,
+                        choices=range(1, 25), metavar='HOURS',
+                        help='hours of deliveries per report (max 24)')
+
     parsed_args = parser.parse_args()
     return parsed_args
 
@@ -496,286 +686,231 @@ def configure_logs(args):
                                      logging.WARNING)
 
 
-def append_data(rows, backend_conn, fleets_dict, start_datetime,
-                end_datetime):
-    # iso_date = date.isoformat()
-    # logger.info('Getting data for {}'.format(iso_date))
-    for fleet_uuid in fleets_dict:
-        fleet_name = fleets_dict[fleet_uuid]['name']
-        if fleet_uuid in FLEETS_TO_SKIP:
-            logger.info('Skipping fleet: {}'.format(fleet_name))
-            continue
-
-        logger.debug('Processing fleet: {}'.
-                     format(fleet_name))
-        url = (DELIVERIES_URL + '?' +
-               urllib.parse.urlencode({'fleet': fleet_uuid,
-                                       'start': start_datetime,
-                                       'end': end_datetime}))
-
-        request = urllib.request.Request(url)
-        request.add_header('Authorization', backend_conn.auth_token)
-        logger.debug('Getting JSON data')
-        try:
-            with backend_conn.opener.open(request) as response:
-
-                logger.debug('Retrieved JSON from this URL: {}'.
-                             format(response.geturl()))
-
-                # The response shouldn't be larger than 1 MiB
-                reporting_json = response.read(1048576).decode('utf-8')
-
-                if (response.read(1024) != b''):
-                    raise ScriptError('Dowloaded JSON is larger than 1 MiB')
-        except urllib.error.HTTPError as err:
-            logger.warn('"{}" Error downloading data for Fleet = {} and '
-                        'dates = {} to {}'.
-                        format(err, fleet_name, start_datetime, end_datetime))
-            continue
-
-        data = json.loads(reporting_json)
-        file_name = os.path.basename(data['filename'])
-        logger.info('Retrieving file {}'.format(file_name))
-
-        url = (REPORTS_URL + urllib.parse.quote(file_name))
-        logger.debug('URL: ' + url)
-
-        # fh = open(file_name, 'w')
-
-        request = urllib.request.Request(url)
-        request.add_header('Authorization', backend_conn.auth_token)
-        with backend_conn.opener.open(request) as response:
-
-            logger.debug('Retrieved file from this URL: {}'.
-                         format(response.geturl()))
-
-            # The response shouldn't be larger than 1 MiB
-            payload = response.read(1048576).decode('utf-8')
-
-            if (response.read(1024) != b''):
-                raise ScriptError('Dowloaded payload is larger than 1 MiB')
-
-        with io.StringIO(payload) as f:
-            csv_reader = csv.reader(f, dialect='excel')
-            csv_fields = next(csv_reader)
-
-            if tuple(csv_fields) != EXPECTED_FIELDS:
-                logger.error('Expected fields : {}'.format(EXPECTED_FIELDS))
-                logger.error('Input CSV fields: {}'.format(tuple(csv_fields)))
-                raise ScriptError('The CSV does not contain the expected '
-                                  'fields')
-
-            num_rows = 0
-            for row in csv_reader:
-                num_rows += 1
-                logger.debug('CSV created_at_timestamp={}, '
-                             'gastronomic_day={}'.
-                             format(row[34], row[55]))
-
-                if len(row) == 0:
-                    continue
-                if len(row) != len(csv_fields):
-                    raise ScriptError('The CSV contains rows with the wrong '
-                                      'number of fields')
-                # datetime
-                for i in (32, 33, 34, 38, 40, 41, 42, 43, 44, 48, 49):
-                    if row[i] == '':
-                        row[i] = None
-                    else:
-                        row[i] = arrow.get(row[i]).datetime
-                # int
-                for i in (8, 25, 26, 27, 30):
-                    if row[i] == '':
-                        row[i] = None
-                    else:
-                        row[i] = int(row[i])
-                # float
-                for i in (16, 24, 28, 57, 58, 59):
-                    if row[i] == '':
-                        row[i] = None
-                    else:
-                        row[i] = float(row[i])
-                # boolean
-                for i in (60, ):
-                    if row[i] == '':
-                        row[i] = None
-                    else:
-                        row[i] = bool(row[i])
-
-                # Fixing gastronomic_day issue here until it's fixed in backend
-                created_at_timestamp = row[34]
-                gastronomic_day = datetime.datetime(
-                                        year=created_at_timestamp.year,
-                                        month=created_at_timestamp.month,
-                                        day=created_at_timestamp.day,
-                                        tzinfo=created_at_timestamp.tzinfo)
-                if created_at_timestamp.hour <= 7:
-                    gastronomic_day -= ONE_DAY
-                row[55] = gastronomic_day
-
-                # Creating a copy of created_at_timestamp to ease insert
-                # the create_at_hour
-                row.append(row[34])
-
-                logger.debug('Python created_at_timestamp={}, '
-                             'gastronomic_day={}'.
-                             format(row[34], row[55]))
-                rows.append(row)
-
-        logger.info('Retrieved {} row for fleet: {}'.
-                    format(num_rows, fleet_name))
-
-    logger.info('{} deliveries retrieved for all fleets'.format(len(rows)))
-    return rows
-
-
-def download_data(backend_conn, db_conn, start_date, end_date):
+def fetch_report(backend_conn, fleet_uuid, fleet_name, start_datetime,
+                 end_datetime):
+    logger.debug('Processing fleet: {}'.
+                 format(fleet_name))
+    url = (DELIVERIES_URL + '?' +
+           urllib.parse.urlencode({'fleet': fleet_uuid,
+                                   'start': start_datetime,
+                                   'end': end_datetime}))
 
-    logger.info('Getting fleet data')
-    fleets_dict = fleets.download_data(backend_conn)
+    logger.debug('Getting JSON data')
+    try:
+        data = backend_conn.get_json(url)
+    except urllib.error.HTTPError as err:
+        logger.warn('"{}" Error downloading data for Fleet = {} and '
+                    'dates = {} to {}'.
+                    format(err, fleet_name, start_datetime, end_datetime))
+        return empty_batch()
+
+    file_name = os.path.basename(data['filename'])
+    logger.info('Retrieving file {}'.format(file_name))
+
+    url = (REPORTS_URL + urllib.parse.quote(file_name))
+    logger.debug('URL: ' + url)
+
+    batches = [parse_deliveries(rows)
+               for rows in backend_conn.iter_csv(url, EXPECTED_FIELDS)]
+    batch = pd.concat(batches, ignore_index=True) if batches else empty_batch()
+
+    logger.info('Retrieved {} row for fleet: {}'.
+                format(len(batch), fleet_name))
+    return batch
+
+
+def parse_deliveries(rows):
+    """ Parse rows of a reporting CSV into a DataFrame, column by column. """
 
-    logger.info('Begin download_data')
+    batch = pd.DataFrame.from_records(rows, columns=EXPECTED_FIELDS)
 
+    # Fixing gastronomic_day issue here until it's fixed in backend.
+    # The backend sends ISO-8601 timestamps in the local time of the
+    # fleet, so the local day and hour are read straight off the text.
+    created_at = batch['created_at_timestamp']
+    created_at_day = pd.to_datetime(created_at.str[:10], format='%Y-%m-%d')
+    created_at_hour = created_at.str[11:13].astype(int)
+    before_8am = pd.to_timedelta((created_at_hour <= 7).astype(int), unit='D')
+
+    for field, field_type in CSV_SCHEMA:
+        batch[field] = PARSERS[field_type](batch[field])
+
+    batch['gastronomic_day'] = created_at_day - before_8am
+    batch['created_at_hour'] = created_at_hour
+
+    return batch
+
+
+def empty_batch():
+    return pd.DataFrame(columns=STAGING_FIELDS)
+
+
+def parse_text(column):
+    # Empty strings stay empty strings, as in the old INSERTs
+    return column
+
+
+def parse_integers(column):
+    # Python ints and None: COPY refuses 3.0 in an integer column
+    numbers = pd.to_numeric(column.replace('', np.nan))
+    integers = [None if pd.isnull(number) else int(number)
+                for number in numbers]
+    return pd.Series(integers, index=column.index, dtype=object)
+
+
+def parse_floats(column):
+    return pd.to_numeric(column.replace('', np.nan))
+
+
+def parse_booleans(column):
+    # Any non empty value is true, as it always has been
+    present = column != ''
+    return present.astype(object).where(present, None)
+
+
+def parse_datetimes(column):
+    # The backend's timestamps carry the offset of the fleet. The columns
+    # hold its local time, as they always have, so the offset is dropped.
+    present = column.notnull() & (column != '')
+    datetimes = pd.to_datetime(strip_utc_offsets(column.where(present)),
+                               errors='coerce')
+
+    # Whatever pandas cannot read as ISO-8601 goes the slow way
+    unparsed = datetimes.isnull() & present
+    if unparsed.any():
+        fallback = column[unparsed].map(lambda value: arrow.get(value).naive)
+        datetimes[unparsed] = pd.to_datetime(fallback)
+
+    return datetimes
+
+
+def strip_utc_offsets(column):
+    """ Drop the trailing Z or +HH:MM of ISO-8601 timestamps. """
+    zulu = column.str[-1:] == 'Z'
+    offset = column.str[-6:-5].isin(['+', '-']) & (column.str[-3:-2] == ':')
+    return column.where(~zulu, column.str[:-1]).where(~offset,
+                                                      column.str[:-6])
+
+
+PARSERS = {
+    'text': parse_text,
+    'integer': parse_integers,
+    'float': parse_floats,
+    'boolean': parse_booleans,
+    'datetime': parse_datetimes,
+    }
+
+
+def fetch_reports(executor, backend_conn, fleet_uuids, fleets_dict,
+                  start_datetime, end_datetime):
+    return [executor.submit(fetch_report, backend_conn, fleet_uuid,
+                            fleets_dict[fleet_uuid]['name'],
+                            start_datetime, end_datetime)
+            for fleet_uuid in fleet_uuids]
+
+
+def report_windows(start_date, end_date, hours):
     gastro_date = start_date
 
     while gastro_date <= end_date:
         logger.info('Gastro date = {}'.format(gastro_date))
         start_datetime = datetime.datetime.combine(gastro_date,
                                                    GASTRO_DATE_START_HOUR)
-        for _ in range(24):
-            end_datetime = start_datetime + ONE_HOUR
-            logger.info('Downloading data from {} to {}'.
-                        format(start_datetime, end_datetime))
-
-            rows = []
-            append_data(rows, backend_conn, fleets_dict,
-                        start_datetime, end_datetime)
-            insert_in_db_tableau(db_conn, rows)
-            insert_in_db_dwh(db_conn, rows)
-            insert_in_db_public(db_conn, rows)
-
+        end_of_day = start_datetime + ONE_DAY
+        while start_datetime < end_of_day:
+            end_datetime = min(start_datetime + hours * ONE_HOUR, end_of_day)
+            yield start_datetime, end_datetime
             start_datetime = end_datetime
         gastro_date += ONE_DAY
 
-    return
-
 
-def insert_in_db_public(conn, rows):
+def download_data(backend_conn, db_conn, start_date, end_date,
+                  workers=DEFAULT_WORKERS, window=DEFAULT_WINDOW):
 
-    cur = conn.cursor()
+    logger.info('Getting fleet data')
+    fleets_dict = fleets.download_data(backend_conn)
 
-    processed = 0
-    inserted = 0
-    updated = 0
-    for row in rows:
-        row = row[:57]  # Adapt row to the old table format
-        if processed > 0 and processed % 100 == 0:
-            logger.info('{} inserted and {} updated rows so far, committing'.
-                        format(inserted, updated))
-            conn.commit()
-            logger.info('Committed. Continuing...')
-
-        # row[3:4] is a list with just the delivery_uuid
-        cur.execute(COUNT_EXISTING_SQL_PUBLIC, row[3:4])
-        result = cur.fetchone()
-        if int(result[0]) == 0:
-            cur.execute(INSERT_SQL_PUBLIC, row)
-            inserted += 1
-        elif int(result[0]) == 1:
-            # The row manipulation puts delivery_uuid last to match the UPDATE
-            # query format
-            cur.execute(UPDATE_SQL_PUBLIC, row[:3] + row[4:] + row[3:4])
-            updated += 1
+    fleet_uuids = []
+    for fleet_uuid in fleets_dict:
+        if fleet_uuid in FLEETS_TO_SKIP:
+            logger.info('Skipping fleet: {}'.
+                        format(fleets_dict[fleet_uuid]['name']))
         else:
-            raise ScriptError('SQL COUNT() returned {}'.format(result[0]))
-        processed += 1
+            fleet_uuids.append(fleet_uuid)
 
-    logger.info('{} inserted and {} updated rows in this batch'.
-                format(inserted, updated))
-    conn.commit()
-    cur.close()
+    logger.info('Begin download_data with {} workers'.format(workers))
 
+    # The reports of the next few windows are fetched in the background
+    # while the current window is loaded. Windows are loaded in order.
+    pending = collections.deque()
 
-def insert_in_db_tableau(conn, rows):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for start_datetime, end_datetime in report_windows(start_date,
+                                                           end_date, window):
+            futures = fetch_reports(executor, backend_conn, fleet_uuids,
+                                    fleets_dict, start_datetime, end_datetime)
+            pending.append((start_datetime, end_datetime, futures))
 
-    cur = conn.cursor()
+            if len(pending) >= PREFETCHED_WINDOWS:
+                load_window(db_conn, *pending.popleft())
 
-    processed = 0
-    inserted = 0
-    updated = 0
-    for row in rows:
-        if processed > 0 and processed % 100 == 0:
-            logger.info('{} inserted and {} updated rows so far, committing'.
-                        format(inserted, updated))
-            conn.commit()
-            logger.info('Committed. Continuing...')
-
-        # row[3:4] is a list with just the delivery_uuid
-        cur.execute(COUNT_EXISTING_SQL_TABLEAU, row[3:4])
-        result = cur.fetchone()
-        if int(result[0]) == 0:
-            cur.execute(INSERT_SQL_TABLEAU, row)
-            inserted += 1
-        elif int(result[0]) == 1:
-            # The row manipulation puts delivery_uuid last to match the UPDATE
-            # query format
-            cur.execute(UPDATE_SQL_TABLEAU, row[:3] + row[4:] + row[3:4])
-            updated += 1
-        else:
-            raise ScriptError('SQL COUNT() returned {}'.format(result[0]))
-        processed += 1
+        while pending:
+            load_window(db_conn, *pending.popleft())
+
+    return
 
-    logger.info('{} inserted and {} updated rows in this batch'.
-                format(inserted, updated))
-    conn.commit()
-    cur.close()
 
+def load_window(db_conn, start_datetime, end_datetime, futures):
+    logger.info('Loading data from {} to {}'.
+                format(start_datetime, end_datetime))
 
-def insert_in_db_dwh(conn, rows):
+    batch = pd.concat([future.result() for future in futures],
+                      ignore_index=True)
 
-    cur = conn.cursor()
+    logger.info('{} deliveries retrieved for all fleets'.format(len(batch)))
+    merge_in_db(db_conn, batch)
 
-    processed = 0
-    inserted = 0
-    updated = 0
-    for row in rows:
-        if processed > 0 and processed % 100 == 0:
-            logger.info('{} inserted and {} updated rows so far, committing'.
-                        format(inserted, updated))
-            conn.commit()
-            logger.info('Committed. Continuing...')
-
-        # row[3:4] is a list with just the delivery_uuid
-        cur.execute(COUNT_EXISTING_SQL_DWH, row[3:4])
-        result = cur.fetchone()
-        if int(result[0]) == 0:
-            cur.execute(INSERT_SQL_DWH, row)
-            inserted += 1
-        elif int(result[0]) == 1:
-            # The row manipulation puts delivery_uuid last to match the UPDATE
-            # query format
-            cur.execute(UPDATE_SQL_DWH, row[:3] + row[4:] + row[3:4])
-            updated += 1
-        else:
-            raise ScriptError('SQL COUNT() returned {}'.format(result[0]))
-        processed += 1
 
-    logger.info('{} inserted and {} updated rows in this batch'.
-                format(inserted, updated))
-    conn.commit()
+def merge_in_db(conn, batch):
+    """ Copy a batch of deliveries into staging and merge it everywhere. """
 
-    cur.close()
+    # The same delivery may show up twice in a batch:
+    # the last version wins, like with the old UPDATEs.
+    deliveries = batch.drop_duplicates('delivery_uuid', keep='last')
 
+    with io.StringIO() as f:
+        deliveries.to_csv(f, columns=STAGING_FIELDS, header=False,
+                          index=False, na_rep=COPY_NULL)
+        f.seek(0)
 
-def enrich_dwh_table(conn):
-    cur = conn.cursor()
-    logger.info('Flagging test orders')
-    cur.execute(CLEANUP_SQL_DWH)
-    conn.commit()
+        cur = conn.cursor()
+        try:
+            cur.execute(CREATE_STAGING_SQL)
+            cur.copy_expert(COPY_STAGING_SQL, f)
+            logger.info('{} deliveries copied into staging'.
+                        format(len(deliveries)))
+
+            cur.execute(RECORD_CHANGES_SQL)
+            logger.info('{} changed fleet days recorded'.
+                        format(cur.rowcount))
+
+            for table, update_sql, insert_sql in MERGE_SQL:
+                cur.execute(update_sql)
+                updated = cur.rowcount
+                cur.execute(insert_sql)
+                inserted = cur.rowcount
+                logger.info('{} inserted and {} updated rows in {}'.
+                            format(inserted, updated, table))
+
+            cur.execute(CLEANUP_SQL_DWH)
+            logger.info('{} test orders flagged'.format(cur.rowcount))
 
-    logger.info('Adding fleet info')
-    cur.execute(ADD_FLEET_INFO_SQL_DWH)
-    conn.commit()
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
 
 
 def main(parsed_args):
@@ -784,7 +919,7 @@ def main(parsed_args):
     start_date = end_date - datetime.timedelta(days=1)
     logger.debug('Start date = {}, end date = {}'.format(start_date, end_date))
 
-    backend_conn = BackendConnector()
+    backend_conn = BackendConnector(pool_size=parsed_args.workers)
     backend_conn.authenticate(parsed_args.username, parsed_args.password)
 
     db_conn = psycopg2.connect(("host='bi-live-mon.deliveryhero.com' "
@@ -793,8 +928,10 @@ def main(parsed_args):
                                format(parsed_args.dbuser,
                                       parsed_args.dbpassword))
 
-    download_data(backend_conn, db_conn, start_date, end_date)
-    enrich_dwh_table(db_conn)
+    # With its consumers registered, so that none misses a change
+    create_change_tables(db_conn)
+    download_data(backend_conn, db_conn, start_date, end_date,
+                  parsed_args.workers, parsed_args.window)
 
     sys.stdout.flush()
     # Flushing is not enough (at least inside Eclipse)
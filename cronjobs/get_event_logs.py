@@ -2,15 +2,20 @@
 
 Usage:
     cronjob.events_etl_wizard SOURCE TARGET [--start=BEGIN] [--batch=SIZE]
+    cronjob.events_etl_wizard all DRIVERS_TARGET CONTROLLERS_TARGET
+                              [--start=BEGIN] [--batch=SIZE]
 
 Arguments:
     SOURCE                 Either "drivers" or "fleet-controllers"
     TARGET                 Target table in the data warehouse
+    all                    Load both sources in a single pass over the API
+    DRIVERS_TARGET         Target table for the drivers events
+    CONTROLLERS_TARGET     Target table for the fleet controllers events
 
 Options:
     --help                  Show this message
     --start=DATE            Start date [default: 2016-01-01]
-    --batch=SIZE            API batch size [default: 500]
+    --batch=SIZE            Initial API batch size, adapted on the way [default: 500]
 
 """
 
@@ -19,194 +24,362 @@ from cached_property import cached_property
 from dateutil.parser import parse
 from datetime import datetime, timedelta
 from logging import getLogger
+from queue import Queue, Empty, Full
+from threading import Event, Thread, current_thread
 from docopt import docopt
 from pandas import DataFrame, to_datetime
 
+from common.bloom import SeenKeys
 from common.logger import configure_logger
 from common.sqlreader import sql
 from connectors import ValkfleetConnector, WarehouseConnector
-from connectors.valkfleet import ValkfleetAPIError
+from connectors.sql import format_identifiers
 
 
 CREATE_TABLE_IF_NOT_EXISTS = sql('get_event_logs')[0]
 GET_LAST_TIMESTAMP = sql('get_event_logs')[1]
 GRANT_ACCESS = sql('get_event_logs')[2]
+GET_LOADED_KEYS = sql('get_event_logs')[3]
+GET_KEYS_SINCE = sql('get_event_logs')[4]
 
-configure_logger()
-log = getLogger('get_event_logs')
-
+SOURCES = ('drivers', 'fleet-controllers')
+TIME_FIELDS = {'drivers': 'created_at', 'fleet-controllers': 'timestamp'}
+SHARED_TIME_FIELD = 'created_at'
 
-class EventsETL(object):
-    api_endpoint = 'event_audit_logs'
+# Events re-read before the last one loaded, see common.bloom
+OVERLAP = timedelta(minutes=10)
 
-    # The CRUD doesn't let me filter by event type
-    api_query = [
-        'filter={time_field} gt {start_time}',
-        'batch_size={batch_size}',
-        'orderby={time_field}'
-    ]
+# Batches waiting between two stages of the pipeline
+QUEUE_SIZE = 4
+# Seconds between checks for a failed stage while waiting on a queue
+POLL_INTERVAL = 1
+# Marks the end of the stream in the queues
+DONE = object()
 
-    def __init__(self,
-                 source,
-                 target,
-                 start='2016-01-01',
-                 batch='200'):
+configure_logger()
+log = getLogger('get_event_logs')
 
-        assert source in ('drivers', 'fleet-controllers')
 
-        self.api = ValkfleetConnector()
-        self.dwh = WarehouseConnector()
+class EventSink(object):
+    """ A target table for one source of events.
 
-        self.api_source = source
-        self.dwh_target = target
+    Driver events are the acceptRoute-clicked ones, with the route in
+    their metadata. Fleet controller events are all the others, with the
+    delivery in their metadata. Each sink resumes a little before the last
+    event in its own table and drops the events it has already loaded,
+    which it remembers by uuid.
 
-        self.etl_timestamp = datetime.now()
-        self.start_time = parse(start)
-        self.batch_size = int(batch)
+    """
+    def __init__(self, dwh, source, target, time_field=None):
+        assert source in SOURCES
 
+        self.dwh = dwh
+        self.source = source
+        self.target = target
         self.counter = 0
-        self.cursor = None
-        self.more = True
-
-        self.batch_df = DataFrame()
-        self.batch_records = []
 
-        self.time_field = 'created_at' if self.api_source == 'drivers' else 'timestamp'
-        self.metadata = 'route_uuid' if self.api_source == 'drivers' else 'delivery_uuid'
-        # TODO: use python urllib or request module to buils the URL 
-        self.api_payload = '?' + '&'.join(self.api_query).format(**self.api_params)
+        self.time_field = time_field or TIME_FIELDS[source]
+        self.metadata = 'route_uuid' if source == 'drivers' else 'delivery_uuid'
+        self.seen = SeenKeys(dwh.schema + '.' + target)
 
-    @property
-    def base_url(self):
-        return self.api.url + '/' + self.api_endpoint + '/' + self.api_payload
-
-    @property
-    def url(self):
-        url = self.base_url
-        if self.cursor:
-            url += '&cursor=%s' % self.cursor
-        return url
-
-    @property
-    def api_params(self):
-        return {'start_time': self.resume_time.isoformat(),
-                'batch_size': self.batch_size,
-                'time_field': self.time_field}
+    def __repr__(self):
+        return '<EventSink (%s into %s)>' % (self.source, self.target)
 
     @property
     def sql_params(self):
         return {'schema_': self.dwh.schema,
-                'table_': self.dwh_target,
+                'table_': self.target,
                 'time_field': self.time_field,
                 'metadata': self.metadata}
 
-    @cached_property
-    def resume_time(self):
-        timestamps = self.dwh.execute(GET_LAST_TIMESTAMP, **self.sql_params)
-        timestamp = parse(str(timestamps[self.time_field].iloc[0]))
-        # TODO: rethink, as this might potentially skip events (rare, but possible)
-        last_timestamp = timestamp + timedelta(microseconds=1)
-
-        if last_timestamp > self.start_time:
-            return last_timestamp
-        else:
-            return self.start_time
-
     def setup(self):
-        create_table = CREATE_TABLE_IF_NOT_EXISTS.format(**self.sql_params)
-        grant_access = GRANT_ACCESS.format(**self.sql_params)
+        create_table = format_identifiers(CREATE_TABLE_IF_NOT_EXISTS,
+                                          **self.sql_params)
+        grant_access = format_identifiers(GRANT_ACCESS, **self.sql_params)
         self.dwh.db.execute(create_table + grant_access + 'COMMIT;')
-        log.info('Target table %s set up', self.dwh_target)
-
-    def extract(self):
-        log.debug('Request base URL: %s', self.base_url)
-        log.debug('Cursor: %s', self.cursor)
+        log.info('Target table %s set up', self.target)
 
-        response = self.api.db.get(self.url)
-        json = response.json()
+        evicted = self.seen.evict()
+        log.debug('Evicted the loaded keys of %s days', len(evicted))
 
-        if 'error' not in json.keys():
-            self.batch_records = json['items']
-            self.more = json['more']
-            self.cursor = json['cursor']
+    def get_resume_time(self, start_time):
+        timestamps = self.dwh.execute(GET_LAST_TIMESTAMP, **self.sql_params)
+        if timestamps.empty:
+            return start_time
 
+        timestamp = parse(str(timestamps[self.time_field].iloc[0]))
+        resume_time = max(timestamp - OVERLAP, start_time)
+        self.seed(resume_time, timestamp)
+        return resume_time
+
+    def seed(self, since, until):
+        """ Fill in the filters of the days of the overlap that have none,
+        e.g. when the cache was cleared, from the table itself.
+        """
+        if not self.seen.missing_days(since, until):
+            return
+
+        loaded = self.dwh.execute(GET_KEYS_SINCE, {'since': since},
+                                  **self.sql_params)
+        self.seen.add(loaded['uuid'].values, loaded[self.time_field])
+        self.seen.save()
+        log.info('Seeded the loaded keys of %s since %s (%s events)',
+                 self.target, since, len(loaded))
+
+    def loaded_keys(self, uuids, since):
+        loaded = self.dwh.execute(GET_LOADED_KEYS,
+                                  {'since': since, 'uuids': uuids},
+                                  **self.sql_params)
+        return loaded['uuid'].values
+
+    def accepts(self, record):
+        if self.source == 'drivers':
+            return record['event'] == 'acceptRoute-clicked'
         else:
-            parameters = {'count': self.counter, 'error': response.json()}
-            message = 'API error on batch {count}: {error}'.format(**parameters)
-            log.error(message, exc_info=True)
-            raise ValkfleetAPIError(message)
+            return record['event'] != 'acceptRoute-clicked'
 
-    def transform(self):
+    def transform(self, records, etl_timestamp, resume_time):
         events = []
 
-        for record in self.batch_records:
-            if self.api_source == 'drivers':
-                if record['event'] == 'acceptRoute-clicked':
-                    route_uuid = record['metadata']['route']
-                    metadata = {'route_uuid': route_uuid}
-                else:
-                    continue
+        for record in records:
+            if not self.accepts(record):
+                continue
+
+            if self.source == 'drivers':
+                metadata = {'route_uuid': record['metadata']['route']}
             else:
-                if record['event'] != 'acceptRoute-clicked':
-                    delivery_uuid = record['metadata']['delivery']
-                    metadata = {'delivery_uuid': delivery_uuid}
-                else:
-                    continue
+                metadata = {'delivery_uuid': record['metadata']['delivery']}
+
+            # The records are shared between sinks
+            event = dict(record, **metadata)
+            del event['metadata']
+            events.append(event)
 
-            record.update(metadata)
-            del record['metadata']
-            events.append(record)
+        batch_df = DataFrame().from_records(events)
+        if batch_df.empty:
+            return batch_df
 
-        self.batch_df = DataFrame().from_records(events)
-        self.batch_df['etl_timestamp'] = self.etl_timestamp
-        self.batch_df[self.time_field] = to_datetime(self.batch_df[self.time_field])
+        batch_df['etl_timestamp'] = etl_timestamp
+        # The API sends UTC offsets, the warehouse has naive UTC timestamps
+        times = to_datetime(batch_df[self.time_field], utc=True)
+        if times.dt.tz is not None:
+            times = times.dt.tz_convert(None)
+        batch_df[self.time_field] = times
 
-    def load(self):
+        # A shared read starts at the earliest of the sinks' resume times
+        already_loaded = batch_df[self.time_field] < resume_time
+        batch_df = batch_df[~already_loaded]
+
+        return self.seen.drop_seen(
+            batch_df, 'uuid', self.time_field,
+            confirm=lambda uuids: self.loaded_keys(uuids, resume_time))
+
+    def load(self, batch_df):
         self.counter += 1
 
-        if 'event' in self.batch_df.columns:
-            self.batch_df.to_sql(self.dwh_target,
-                                 self.dwh.db,
-                                 schema=self.dwh.schema,
-                                 if_exists='append',
-                                 index=False)
+        if 'event' in batch_df.columns and not batch_df.empty:
+            self.dwh.bulk_load(batch_df,
+                               self.target,
+                               self.dwh.schema)
 
             parameters = dict(schema=self.dwh.schema,
-                              table=self.dwh_target,
+                              table=self.target,
                               count=self.counter,
-                              records=self.batch_df.shape[0],
-                              fields=self.batch_df.shape[1],
-                              tmin=self.batch_df[self.time_field].min(),
-                              tmax=self.batch_df[self.time_field].max())
+                              records=batch_df.shape[0],
+                              fields=batch_df.shape[1],
+                              tmin=batch_df[self.time_field].min(),
+                              tmax=batch_df[self.time_field].max())
 
             log.info('Loaded batch {count} into table {schema}.{table} '
                      '({records} records, {fields} fields): '
                      '{tmin} to {tmax}'.format(**parameters))
 
         else:
-            log.info('Batch %s is empty: no events found', self.counter)
+            log.info('Batch %s is empty: no events found for %s',
+                     self.counter, self.target)
+
+
+class EventsETL(object):
+    """ Read the event audit logs once and route them to one or more sinks.
+
+    With a single sink, the API is filtered and ordered on the sink's own
+    time field, as before. With several sinks, they all use created_at,
+    so that one pass over the endpoint serves them all.
+
+    """
+    api_endpoint = 'event_audit_logs'
+
+    def __init__(self,
+                 sinks,
+                 start='2016-01-01',
+                 batch='200'):
+
+        self.api = ValkfleetConnector()
+        self.dwh = WarehouseConnector()
+
+        self.time_field = TIME_FIELDS[sinks[0][0]] if len(sinks) == 1 \
+            else SHARED_TIME_FIELD
+        self.sinks = [EventSink(self.dwh, source, target, self.time_field)
+                      for source, target in sinks]
+
+        self.etl_timestamp = datetime.now()
+        self.start_time = parse(start)
+        self.batch_size = int(batch)
+
+        self.fetched = 0
+
+        self.stop = Event()
+        self.errors = []
+
+    @property
+    def api_params(self):
+        # The CRUD doesn't let me filter by event type
+        start_time = self.resume_time.isoformat()
+        return {'filter': '%s gt %s' % (self.time_field, start_time),
+                'orderby': self.time_field}
+
+    @cached_property
+    def resume_times(self):
+        return {sink.target: sink.get_resume_time(self.start_time)
+                for sink in self.sinks}
+
+    @property
+    def resume_time(self):
+        return min(self.resume_times.values())
+
+    def setup(self):
+        for sink in self.sinks:
+            sink.setup()
+
+    def extract(self):
+        """ Yield the pages of events, with an adaptive batch size. """
+        pages = self.api.iter_pages(self.api_endpoint,
+                                    self.api_params,
+                                    batch_size=self.batch_size)
+
+        for records in pages:
+            self.fetched += 1
+            log.debug('Fetched page %s (%s events)', self.fetched, len(records))
+            yield records
+
+    def transform(self, records):
+        return [(sink, sink.transform(records,
+                                      self.etl_timestamp,
+                                      self.resume_times[sink.target]))
+                for sink in self.sinks]
+
+    def load(self, batches):
+        for sink, batch_df in batches:
+            sink.load(batch_df)
+
+    def run(self):
+        """ Run the three stages at the same time, each in its own thread.
+
+        The fetcher follows the API cursor until there is no more, the
+        transformer builds the batches and the loader copies them into the
+        warehouse. Each stage waits when the queue to the next one is full,
+        so at most QUEUE_SIZE batches are held between two stages. If a
+        stage fails, the others stop and the error is raised here.
+        """
+        records_queue = Queue(QUEUE_SIZE)
+        frames_queue = Queue(QUEUE_SIZE)
+
+        threads = [Thread(target=self._stage, name='fetcher',
+                          args=(self._fetch, records_queue)),
+                   Thread(target=self._stage, name='transformer',
+                          args=(self._transform, records_queue, frames_queue)),
+                   Thread(target=self._stage, name='loader',
+                          args=(self._load, frames_queue))]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Failed or not, the keys remembered so far are kept
+        for sink in self.sinks:
+            sink.seen.save()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def _stage(self, function, *queues):
+        try:
+            function(*queues)
+        except Exception as error:
+            log.error('The %s stopped on an error', current_thread().name,
+                      exc_info=True)
+            self.errors.append(error)
+            self.stop.set()
+
+    def _fetch(self, records_queue):
+        for records in self.extract():
+            if self.stop.is_set():
+                break
+            self._put(records_queue, records)
+        self._put(records_queue, DONE)
+
+    def _transform(self, records_queue, frames_queue):
+        for records in self._consume(records_queue):
+            self._put(frames_queue, self.transform(records))
+        self._put(frames_queue, DONE)
+
+    def _load(self, frames_queue):
+        for batch_df in self._consume(frames_queue):
+            self.load(batch_df)
+
+    def _put(self, queue, item):
+        while not self.stop.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except Full:
+                continue
+
+    def _consume(self, queue):
+        while not self.stop.is_set():
+            try:
+                item = queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+            if item is DONE:
+                return
+            yield item
 
 
 def run_etl_job(*io, **options):
-    """ ETL job for driver or fleet controller events. """
+    """ ETL job for driver or fleet controller events, or both. """
+
+    if io[0] == 'all':
+        sinks = list(zip(SOURCES, io[1:]))
+    else:
+        sinks = [io]
 
-    etl = EventsETL(*io, **options)
+    etl = EventsETL(sinks, **options)
     etl.setup()
 
     log.info('Starting ETL job at %s', etl.etl_timestamp)
+    for target, resume_time in etl.resume_times.items():
+        log.info('Resuming %s at %s', target, resume_time)
     log.info('Resuming extraction at %s', etl.resume_time)
 
-    while etl.more:
-        etl.extract()
-        etl.transform()
-        etl.load()
+    etl.run()
 
     log.info('Finished ETL job')
 
 
 def parse_args():
     kwargs = {k.replace('--', ''): v for k, v in docopt(__doc__).items()}
-    args = (kwargs.pop('SOURCE'), kwargs.pop('TARGET'))
+    if kwargs.pop('all'):
+        args = ('all',
+                kwargs.pop('DRIVERS_TARGET'),
+                kwargs.pop('CONTROLLERS_TARGET'))
+        kwargs.pop('SOURCE')
+        kwargs.pop('TARGET')
+    else:
+        args = (kwargs.pop('SOURCE'), kwargs.pop('TARGET'))
+        kwargs.pop('DRIVERS_TARGET')
+        kwargs.pop('CONTROLLERS_TARGET')
     log.info('ETL job source and target: %s', args)
     log.info('ETL options: %s', kwargs)
     return args, kwargs
@@ -3,10 +3,7 @@ Copies shift data from backend into tableau.backend_shift table and enriches
 it with data from the tableau.fleet and tableau.driver_rosetta tables
 '''
 import argparse
-import csv
 import datetime
-import io
-import json
 import logging
 import os
 import pprint
@@ -16,6 +13,7 @@ import urllib.request
 
 import psycopg2
 
+from common.fleets import FleetDimension
 from common.logging_configurer import LOG_DIR
 from scripts import get_fleets_from_backend as fleets
 from connectors.backend import BackendConnector
@@ -45,11 +43,17 @@ INSERT INTO tableau.backend_shift
   on_break_timestamp,
   off_break_timestamp,
   no_of_breaks,
-  break_time
+  break_time,
+  fleet_display_name,
+  fleet_backend_name,
+  fleet_country_code,
+  fleet_country_name,
+  fleet_city
 )
 VALUES (
 %s, %s, %s, %s, %s,
 %s, %s, %s, %s, %s,
+%s, %s, %s, %s, %s,
 %s);
 """
 
@@ -73,23 +77,17 @@ SET
   on_break_timestamp = %s,
   off_break_timestamp = %s,
   no_of_breaks = %s,
-  break_time = %s
+  break_time = %s,
+  fleet_display_name = %s,
+  fleet_backend_name = %s,
+  fleet_country_code = %s,
+  fleet_country_name = %s,
+  fleet_city = %s
 WHERE
   driver_username = %s
   AND on_shift_timestamp = %s
 ;"""
 
-UPDATE_FLEET_INFO_SQL = """
-UPDATE tableau.backend_shift
-SET fleet_display_name = tableau.fleet.display_name,
-    fleet_backend_name = tableau.fleet.backend_name,
-    fleet_country_code = tableau.fleet.country_code,
-    fleet_country_name = tableau.fleet.country_name,
-    fleet_city = tableau.fleet.city
-FROM tableau.fleet
-WHERE tableau.backend_shift.fleet_uuid = tableau.fleet.uuid;
-"""
-
 # __name__ is the name of the module or '__main__'
 logger = logging.getLogger(__name__)
 pp = pprint.PrettyPrinter(indent=4)
@@ -161,28 +159,16 @@ def download_data(backend_conn, fleets_dict, date):
                urllib.parse.urlencode({'fleet': fleet,
                                        'date': iso_date}))
 
-        request = urllib.request.Request(url)
-        request.add_header('Authorization', backend_conn.auth_token)
         logger.debug('Getting JSON data')
         try:
-            with backend_conn.opener.open(request) as response:
-
-                logger.debug('Retrieved JSON from this URL: {}'.
-                             format(response.geturl()))
-
-                # The response shouldn't be larger than 1 MiB
-                fleet_json = response.read(1048576).decode('utf-8')
-
-                if (response.read(1024) != b''):
-                    raise ScriptError('Dowloaded JSON is larger than 1 MiB')
+            data = backend_conn.get_json(url)
         except urllib.error.HTTPError as err:
             logger.warn('Error downloading fleet data for Fleet = {} and '
                         'date = {}. Error message: {}'.
                         format(fleet_name, iso_date, err))
             continue
 
-        data = json.loads(fleet_json)
-        logger.debug("Got data:\n{}".format(pp.pformat(fleet_json)))
+        logger.debug("Got data:\n{}".format(pp.pformat(data)))
 
         file_name = os.path.basename(data['filename'])
         logger.info('Saving file {}'.format(file_name))
@@ -190,39 +176,9 @@ def download_data(backend_conn, fleets_dict, date):
         url = (REPORTS_URL + urllib.parse.quote(file_name))
         logger.debug('URL: ' + url)
 
-        # fh = open(file_name, 'w')
-
-        request = urllib.request.Request(url)
-        request.add_header('Authorization', backend_conn.auth_token)
-        logger.debug('Getting JSON data')
-        with backend_conn.opener.open(request) as response:
-
-            logger.debug('Retrieved JSON from this URL: {}'.
-                         format(response.geturl()))
-
-            # The response shouldn't be larger than 1 MiB
-            payload = response.read(1048576).decode('utf-8')
-
-            if (response.read(1024) != b''):
-                raise ScriptError('Dowloaded payload is larger than 1 MiB')
-
-        with io.StringIO(payload) as f:
-            csv_reader = csv.reader(f, dialect='excel')
-            csv_fields = next(csv_reader)
-
-            if tuple(csv_fields) != EXPECTED_FIELDS:
-                logger.error('Expected fields : {}'.format(EXPECTED_FIELDS))
-                logger.error('Input CSV fields: {}'.format(tuple(csv_fields)))
-                raise ScriptError('The CSV does not contain the expected '
-                                  'fields')
-
-            for row in csv_reader:
-                if len(row) == 0:
-                    continue
-                if len(row) != len(csv_fields):
-                    raise ScriptError('The CSV contains rows with the wrong '
-                                      'number of fields')
-                row_dict = dict(zip(csv_fields, row))
+        for batch in backend_conn.iter_csv(url, EXPECTED_FIELDS):
+            for row in batch:
+                row_dict = dict(zip(EXPECTED_FIELDS, row))
                 for key in row_dict:
                     row_dict[key] = row_dict[key].strip()
                 row_dict['fleet_uuid'] = fleet
@@ -237,7 +193,7 @@ def download_data(backend_conn, fleets_dict, date):
     return rows
 
 
-def insert_in_db(db_conn, rows):
+def insert_in_db(db_conn, rows, fleet_dimension):
     cur = db_conn.cursor()
 
     processed = 0
@@ -250,6 +206,10 @@ def insert_in_db(db_conn, rows):
             db_conn.commit()
             logger.info('Committed. Continuing...')
 
+        fleet = fleet_dimension.get(uuid=row['fleet_uuid'])
+        fleet_info = (fleet.display_name, fleet.backend_name,
+                      fleet.country_code, fleet.country_name, fleet.city)
+
         cur.execute(COUNT_EXISTING_SQL, (row['driver_username'],
                                          row['on_shift_timestamp']))
         result = cur.fetchone()
@@ -266,7 +226,7 @@ def insert_in_db(db_conn, rows):
                          row['on_break_timestamp'],
                          row['off_break_timestamp'],
                          row['no_of_breaks'],
-                         row['break_time']))
+                         row['break_time']) + fleet_info)
         elif int(result[0]) == 1:
             updated += 1
             cur.execute(UPDATE_SQL,
@@ -278,8 +238,8 @@ def insert_in_db(db_conn, rows):
                          row['on_break_timestamp'],
                          row['off_break_timestamp'],
                          row['no_of_breaks'],
-                         row['break_time'],
-                         row['driver_username'],
+                         row['break_time']) + fleet_info +
+                        (row['driver_username'],
                          row['on_shift_timestamp']))
         else:
             raise ScriptError('SQL COUNT() returned {}'.format(result[0]))
@@ -306,18 +266,15 @@ def main(parsed_args):
 
     logger.info('Getting fleet data')
     fleets_dict = fleets.download_data(backend_conn)
+    fleet_dimension = FleetDimension.load(db_conn)
 
     date = start_date
     one_day = datetime.timedelta(days=1)
     while date <= end_date:
         rows = download_data(backend_conn, fleets_dict, date)
-        insert_in_db(db_conn, rows)
+        insert_in_db(db_conn, rows, fleet_dimension)
         date += one_day
 
-    cur = db_conn.cursor()
-    cur.execute(UPDATE_FLEET_INFO_SQL)
-    db_conn.commit()
-    cur.close()
     db_conn.close()
     # print(pp.pprint(fleets[0]))
     # generate_csv(fleets)
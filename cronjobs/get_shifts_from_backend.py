@@ -4,12 +4,8 @@ Created on Jul 28, 2015
 @author: nicolasguenon
 '''
 import argparse
-import csv
 import datetime
-import io
-import json
 import logging
-import math
 import os
 import pprint
 import sys
@@ -17,9 +13,10 @@ import time
 import urllib.request
 
 import arrow
-import pandas as pd
 import psycopg2
 
+from common.fleets import FleetDimension
+from common.grid import OccupancyGrid
 from common.logging_configurer import LOG_DIR
 from scripts import get_fleets_from_backend as fleets
 from connectors.backend import BackendConnector
@@ -58,24 +55,20 @@ COUNT_EXISTING_SQL = """SELECT COUNT(*)
                             AND fleet_uuid = %s;"""
 INSERT_SQL = """INSERT INTO tableau.backend_hourly_drivers
                    (gastronomic_day, hour, fleet_uuid, actual_datetime,
-                   total_active_drivers)
-                   VALUES (%s, %s, %s, %s, %s);"""
+                   total_active_drivers, fleet_display_name,
+                   fleet_backend_name, fleet_country_code,
+                   fleet_country_name)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);"""
 UPDATE_SQL = """UPDATE tableau.backend_hourly_drivers
-                   SET total_active_drivers = %s
+                   SET total_active_drivers = %s,
+                       fleet_display_name = %s,
+                       fleet_backend_name = %s,
+                       fleet_country_code = %s,
+                       fleet_country_name = %s
                    WHERE gastronomic_day = %s
                        AND hour = %s
                        AND fleet_uuid = %s;"""
 
-UPDATE_FLEET_INFO_SQL = """
-UPDATE tableau.backend_hourly_drivers
-SET fleet_display_name = tableau.fleet.display_name,
-    fleet_backend_name = tableau.fleet.backend_name,
-    fleet_country_code = tableau.fleet.country_code,
-    fleet_country_name = tableau.fleet.country_name
-FROM tableau.fleet
-WHERE tableau.backend_hourly_drivers.fleet_uuid = tableau.fleet.uuid;
-"""
-
 # __name__ is the name of the module or '__main__'
 logger = logging.getLogger(__name__)
 pp = pprint.PrettyPrinter(indent=4)
@@ -148,28 +141,16 @@ def append_data(rows, backend_connector, fleets_dict, date):
                urllib.parse.urlencode({'fleet': fleet,
                                        'date': iso_date}))
 
-        request = urllib.request.Request(url)
-        request.add_header('Authorization', backend_connector.auth_token)
         logger.debug('Getting JSON data')
         try:
-            with backend_connector.opener.open(request) as response:
-
-                logger.debug('Retrieved JSON from this URL: {}'.
-                             format(response.geturl()))
-
-                # The response shouldn't be larger than 1 MiB
-                fleet_json = response.read(1048576).decode('utf-8')
-
-                if (response.read(1024) != b''):
-                    raise ScriptError('Dowloaded JSON is larger than 1 MiB')
+            data = backend_connector.get_json(url)
         except urllib.error.HTTPError as err:
             logger.warn('Error downloading fleet data for Fleet = {} and '
                         'date = {}. Error message: {}'.
                         format(fleet_name, iso_date, err))
             continue
 
-        data = json.loads(fleet_json)
-        logger.debug("Got data:\n{}".format(pp.pformat(fleet_json)))
+        logger.debug("Got data:\n{}".format(pp.pformat(data)))
 
         file_name = os.path.basename(data['filename'])
         logger.info('Saving file {}'.format(file_name))
@@ -177,40 +158,9 @@ def append_data(rows, backend_connector, fleets_dict, date):
         url = (REPORTS_URL + urllib.parse.quote(file_name))
         logger.debug('URL: ' + url)
 
-        # fh = open(file_name, 'w')
-
-        request = urllib.request.Request(url)
-        request.add_header('Authorization', backend_connector.auth_token)
-        logger.debug('Getting JSON data')
-        with backend_connector.opener.open(request) as response:
-
-            logger.debug('Retrieved JSON from this URL: {}'.
-                         format(response.geturl()))
-
-            # The response shouldn't be larger than 1 MiB
-            payload = response.read(1048576).decode('utf-8')
-
-            if (response.read(1024) != b''):
-                raise ScriptError('Dowloaded payload is larger than 1 MiB')
-
-        with io.StringIO(payload) as f:
-            csv_reader = csv.reader(f, dialect='excel')
-            csv_fields = next(csv_reader)
-
-            if tuple(csv_fields) != EXPECTED_FIELDS:
-                logger.error('Expected fields : {}'.format(EXPECTED_FIELDS))
-                logger.error('Input CSV fields: {}'.format(tuple(csv_fields)))
-                raise ScriptError('The CSV does not contain the expected '
-                                  'fields')
-
-            for row in csv_reader:
-
-                if len(row) == 0:
-                    continue
-                if len(row) != len(csv_fields):
-                    raise ScriptError('The CSV contains rows with the wrong '
-                                      'number of fields')
-                row_dict = dict(zip(csv_fields, row))
+        for batch in backend_connector.iter_csv(url, EXPECTED_FIELDS):
+            for row in batch:
+                row_dict = dict(zip(EXPECTED_FIELDS, row))
                 for key in row_dict:
                     row_dict[key] = row_dict[key].strip()
                 row_dict['fleet_uuid'] = fleet
@@ -240,114 +190,41 @@ def download_data(username, password, start_date, end_date):
     return (fleets_dict, rows)
 
 
-def create_output_df(start_date, end_date, fleets_dict):
-
-    one_day = datetime.timedelta(days=1)
-    one_hour = datetime.timedelta(hours=1)
-    hours = [_ for _ in range(8, 24)]
-    hours.extend([_ for _ in range(8)])
-
-    fleet_uuids = list(fleets_dict.keys())
-    for fleet_uuid in FLEETS_TO_SKIP:
-        fleet_uuids.remove(fleet_uuid)
-    num_fleets = len(fleet_uuids)
-    gastro_datetimes = []
-    real_datetimes = []
-    init_values = []
-    current_gastro_date = start_date  # dates are immutable
-    while current_gastro_date <= end_date:
-        current_real_datetime = datetime.datetime(current_gastro_date.year,
-                                                  current_gastro_date.month,
-                                                  current_gastro_date.day,
-                                                  8)
-
-        for hour in hours:
-            current_gastro_datetime = datetime.datetime(
-                            current_gastro_date.year,
-                            current_gastro_date.month,
-                            current_gastro_date.day,
-                            hour)
-            gastro_datetimes.append(current_gastro_datetime)
-            for _ in range(num_fleets):
-                real_datetimes.append(current_real_datetime)
-                # TODO get rid of this ugly thing
-                init_values.append(0.0)
-
-            current_real_datetime += one_hour
-        current_gastro_date += one_day
-
-    index = pd.MultiIndex.from_product((gastro_datetimes, fleet_uuids),
-                                       names=['gastronomic_datetime',
-                                              'fleet'])
-
-    output_df = pd.DataFrame(index=index, columns=DB_FIELDS)
-    output_df['actual_datetime'] = real_datetimes
-    output_df['total_active_drivers'] = init_values
-
-    logger.info('Output DataFrame created')
-    logger.debug('Head:\n{}'.format(output_df.head(4)))
-    logger.debug('Tail:\n{}'.format(output_df.tail(4)))
-
-    return output_df
-
-
 def aggregate_data(start_date, end_date, fleets_dict, rows):
-    output_df = create_output_df(start_date, end_date, fleets_dict)
-
-    for i in range(len(rows)):
-        if i % 100 == 0:
-            logger.info('Read {} input rows so far'.format(i))
-
-        row = rows[i]
+    fleet_uuids = [fleet_uuid for fleet_uuid in fleets_dict
+                   if fleet_uuid not in FLEETS_TO_SKIP]
+    grid = OccupancyGrid(start_date, end_date, fleet_uuids)
+
+    starts = []
+    ends = []
+    shift_fleets = []
+    for row in rows:
         try:
             start = arrow.get(row['on_shift_timestamp']).datetime
         except arrow.parser.ParserError as err:
             logger.error('on_shift_timestamp parse error "{}" in row: {}'.
                          format(err, row))
+            continue
         try:
             end = arrow.get(row['off_shift_timestamp']).datetime
         except:
-            end = start.replace(hour=7, minute=59, second=59, microsecond=9999)
-        fleet_uuid = row['fleet_uuid']
+            # Open shifts last until the end of the gastronomic day
+            end = start.replace(hour=8, minute=0, second=0, microsecond=0)
+            if end <= start:
+                end += datetime.timedelta(days=1)
 
-        start_hour_contribution = (60 - start.minute) / 60
-        end_hour_contribution = end.minute / 60
-        # logger.debug(start.hour, start.minute, start_hour_contribution)
-        # logger.debug(end.hour, end.minute, end_hour_contribution)
+        # The grid works on the local times of the backend
+        starts.append(start.replace(tzinfo=None))
+        ends.append(end.replace(tzinfo=None))
+        shift_fleets.append(row['fleet_uuid'])
 
-        gastro_date = datetime.date(start.year, start.month, start.day)
-        if start.hour < 8:
-            gastro_date -= datetime.timedelta(days=1)
+    dropped = grid.add(starts, ends, shift_fleets)
+    if dropped:
+        logger.warning('{} shifts from unknown fleets ignored'.
+                       format(dropped))
 
-        if end.hour < start.hour:
-            hours = range(start.hour, end.hour + 25)
-        else:
-            hours = range(start.hour, end.hour + 1)
-        for hour in hours:
-            hour %= 24
-            gastro_datetime = datetime.datetime(gastro_date.year,
-                                                gastro_date.month,
-                                                gastro_date.day,
-                                                hour)
-
-            try:
-                current_drivers = output_df.loc[(gastro_datetime, fleet_uuid),
-                                                'total_active_drivers']
-            except:
-                logger.error('Error with {}, {}'.format(gastro_datetime,
-                                                        fleet_uuid))
-                continue
-            if math.isnan(current_drivers):
-                current_drivers = 0.0
-            if hour == start.hour:
-                current_drivers += start_hour_contribution
-            elif hour == end.hour:
-                current_drivers += end_hour_contribution
-            else:
-                current_drivers += 1.0
-            output_df.loc[(gastro_datetime, fleet_uuid),
-                          'total_active_drivers'] = current_drivers
-            # logger.debug((gastro_date, hour, fleet, current_drivers))
+    output_df = grid.to_frame('total_active_drivers')
+    output_df = output_df[list(DB_FIELDS)]
 
     logger.info(output_df.tail(24))
     return output_df
@@ -359,6 +236,7 @@ def insert_in_db(df, username, password):
     conn = psycopg2.connect(("host='bi-live-mon.deliveryhero.com' "
                              "dbname='valk_fleet' user='{}' "
                              "password='{}'").format(username, password))
+    fleet_dimension = FleetDimension.load(conn)
     cur = conn.cursor()
 
     processed = 0
@@ -378,6 +256,9 @@ def insert_in_db(df, username, password):
         gastro_date = datetime.date(gastro_datetime.year,
                                     gastro_datetime.month,
                                     gastro_datetime.day)
+        fleet = fleet_dimension.get(uuid=fleet_uuid)
+        fleet_info = (fleet.display_name, fleet.backend_name,
+                      fleet.country_code, fleet.country_name)
 
         cur.execute(COUNT_EXISTING_SQL, (gastro_date, hour, fleet_uuid))
         result = cur.fetchone()
@@ -385,20 +266,17 @@ def insert_in_db(df, username, password):
             inserted += 1
             cur.execute(INSERT_SQL,
                         (gastro_date, hour, fleet_uuid, row['actual_datetime'],
-                         row['total_active_drivers']))
+                         row['total_active_drivers']) + fleet_info)
         elif int(result[0]) == 1:
             updated += 1
             cur.execute(UPDATE_SQL,
-                        (row['total_active_drivers'],
-                         gastro_date, hour, fleet_uuid))
+                        (row['total_active_drivers'],) + fleet_info +
+                        (gastro_date, hour, fleet_uuid))
         else:
             raise ScriptError('SQL COUNT() returned {}'.format(result[0]))
         processed += 1
 
     conn.commit()
-
-    cur.execute(UPDATE_FLEET_INFO_SQL)
-    conn.commit()
     cur.close()
     conn.close()
 
@@ -0,0 +1,219 @@
+"""Extract tracking points from the backend in parallel time shards.
+
+Usage:
+    cronjob.get_tracking_points START STOP [--shard=HOURS]
+                                           [--workers=N]
+                                           [--batch=SIZE]
+                                           [--simplify=METRES]
+                                           [--stationary=METRES]
+                                           [--store]
+
+Arguments:
+    START                   Start datetime (included)
+    STOP                    Stop datetime (excluded)
+
+Options:
+    --help                  Show this message
+    --shard=HOURS           Length of the time shards [default: 6]
+    --workers=N             Shards extracted at the same time [default: 4]
+    --batch=SIZE            Initial API batch size [default: 500]
+    --simplify=METRES       Simplify the trajectories within a tolerance
+    --stationary=METRES     Radius of a stop when simplifying [default: 10]
+    --store                 Also write the points to the trajectory store
+
+The interval is cut into shards, which are extracted concurrently, each
+following its own cursor. After every page, the points and the shard's
+cursor are committed together, so a restart resumes each unfinished shard
+where it stopped and skips the finished ones. Shards are cut on a fixed
+grid, at multiples of the shard length since the epoch, so that runs over
+other intervals line up with the recorded shards. Recorded shards are
+reused as they are and only the rest of the interval is cut anew.
+
+When simplifying, stops are collapsed to their first and last points and
+each driver's route is simplified with Douglas-Peucker (see common.geo).
+The shards record the raw and the kept number of points, the maximum
+distance between a dropped point and the simplified line, and the raw
+and simplified lengths of the trajectories.
+
+"""
+
+
+import concurrent.futures
+
+from datetime import datetime, timedelta
+from logging import getLogger
+from dateutil.parser import parse
+from docopt import docopt
+from pandas import DataFrame
+
+from common.geo import simplify_trajectories
+from common.logger import configure_logger
+from common.sqlreader import sql
+from common.trajectory_store import TrajectoryStore
+from connectors import ValkfleetConnector, WarehouseConnector
+
+
+CREATE_TABLE = sql('get_tracking_points')[0]
+CREATE_SHARD_TABLE = sql('get_tracking_points')[2]
+GET_SHARDS = sql('get_tracking_points')[3]
+ADD_SHARD = sql('get_tracking_points')[4]
+CHECKPOINT_SHARD = sql('get_tracking_points')[5]
+
+ENDPOINT = 'tracking_points/inrange'
+SCHEMA = 'tableau'
+TABLE = 'tracking_points'
+
+# The columns of tableau.tracking_points
+COLUMNS = ['accuracy', 'altitude', 'battery', 'bearing', 'created_at',
+           'datetime', 'deleted_at', 'device', 'driver', 'gsm_signal',
+           'lat', 'lng', 'location_provider', 'modified_at', 'network_type',
+           'num_satelites', 'route', 'shift', 'speed', 'ts_milisecond',
+           'uuid']
+
+# The origin of the grid of shards
+EPOCH = datetime(1970, 1, 1)
+
+configure_logger()
+log = getLogger('get_tracking_points')
+
+
+def split_interval(start, stop, shard_length):
+    """ Cut [start, stop) at the multiples of shard_length since the epoch
+    and return the (shard_start, shard_stop) pairs.
+    """
+    epoch = EPOCH.replace(tzinfo=start.tzinfo)
+    shards = []
+    shard_start = start
+
+    while shard_start < stop:
+        cells = (shard_start - epoch) // shard_length + 1
+        shard_stop = min(epoch + cells * shard_length, stop)
+        shards.append((shard_start, shard_stop))
+        shard_start = shard_stop
+
+    return shards
+
+
+def plan_shards(dwh, start, stop, shard_length):
+    """ Record the shards of the interval and return the unfinished ones
+    as (shard_start, shard_stop, cursor) tuples.
+
+    The shards recorded over the interval are kept, even where they stick
+    out of it, and the gaps between them are split into new shards.
+    """
+    with dwh.db.begin() as c:
+        c.execute(CREATE_TABLE)
+        c.execute(CREATE_SHARD_TABLE)
+
+        recorded = sorted(c.execute(GET_SHARDS, {'start': start,
+                                                 'stop': stop}),
+                          key=lambda row: row.shard_start)
+
+        todo = []
+        shards = []
+        position = start
+        for row in recorded:
+            if row.shard_start > position:
+                shards.extend(split_interval(position, row.shard_start,
+                                             shard_length))
+            if not row.done:
+                todo.append((row.shard_start, row.shard_stop, row.cursor))
+            position = max(position, row.shard_stop)
+        shards.extend(split_interval(position, stop, shard_length))
+
+        for shard_start, shard_stop in shards:
+            c.execute(ADD_SHARD, {'shard_start': shard_start,
+                                  'shard_stop': shard_stop})
+
+    todo.extend(shard + (None,) for shard in shards)
+    planned = len(recorded) + len(shards)
+    log.info('%s shards planned, %s finished', planned, planned - len(todo))
+    return sorted(todo, key=lambda shard: shard[0])
+
+
+def extract_shard(dwh, shard_start, shard_stop, cursor, batch_size,
+                  store=None, tolerance=None, stationary_radius=None):
+    """ Follow one shard's cursor to its end. Return the points loaded. """
+    api = ValkfleetConnector()
+    url = api.url + '/' + ENDPOINT
+    params = {'begin': shard_start, 'end': shard_stop}
+    shard = {'shard_start': shard_start, 'shard_stop': shard_stop}
+    loaded = 0
+
+    if cursor:
+        log.info('Resuming shard %s to %s', shard_start, shard_stop)
+
+    pages = api.iter_cursor(url, params, cursor=cursor,
+                            batch_size=batch_size,
+                            batch_param='batchsize')
+
+    for records, cursor in pages:
+        checkpoint = dict(shard, cursor=cursor, done=cursor is None,
+                          points=len(records), raw_points=len(records),
+                          max_error=None, raw_length=0, length=0)
+
+        if records:
+            # The location is already in lat/lng
+            batch = DataFrame.from_records(records).reindex(columns=COLUMNS)
+
+            if tolerance:
+                batch, stats = simplify_trajectories(batch, tolerance,
+                                                     stationary_radius)
+                checkpoint.update((key, stats[key]) for key in
+                                  ('points', 'raw_points', 'max_error',
+                                   'raw_length', 'length'))
+                log.debug('Kept %s of %s points (mean error %.1fm)',
+                          stats['points'], stats['raw_points'],
+                          stats['mean_error'])
+
+            # Before the checkpoint: the store drops the points it gets twice
+            if store:
+                store.append(batch)
+            dwh.bulk_load(batch, TABLE, SCHEMA,
+                          statements=[(CHECKPOINT_SHARD, checkpoint)])
+        else:
+            dwh.db.execute(CHECKPOINT_SHARD, checkpoint)
+
+        loaded += checkpoint['points']
+
+    log.info('Loaded %s points for shard %s to %s',
+             loaded, shard_start, shard_stop)
+    return loaded
+
+
+def load_tracking_points(start, stop, shard=6, workers=4, batch=500,
+                         simplify=None, stationary=10, store=False):
+    dwh = WarehouseConnector()
+    shard_length = timedelta(hours=float(shard))
+    store = TrajectoryStore() if store else None
+    tolerance = float(simplify) if simplify else None
+
+    log.info('Loading tracking points for %s to %s (%s shards)',
+             start, stop, shard_length)
+
+    shards = plan_shards(dwh, start, stop, shard_length)
+
+    with concurrent.futures.ThreadPoolExecutor(int(workers)) as executor:
+        futures = [executor.submit(extract_shard, dwh, shard_start,
+                                   shard_stop, cursor, int(batch), store,
+                                   tolerance, float(stationary))
+                   for shard_start, shard_stop, cursor in shards]
+        total = sum(future.result()
+                    for future in concurrent.futures.as_completed(futures))
+
+    if store:
+        day = start.date()
+        while day <= stop.date():
+            points = store.compact(day)
+            log.info('%s points in the trajectory store on %s', points, day)
+            day += timedelta(days=1)
+
+    log.info('Finished loading %s tracking points for %s to %s',
+             total, start, stop)
+
+
+if __name__ == '__main__':
+    kwargs = {k.replace('--', ''): v for k, v in docopt(__doc__).items()}
+    start_, stop_ = parse(kwargs.pop('START')), parse(kwargs.pop('STOP'))
+    log.info('Tracking points options: %s', kwargs)
+    load_tracking_points(start_, stop_, **kwargs)
@@ -4,7 +4,8 @@ Usage:
     cronjob.odoo_etl_wizard SOURCE TARGET [--echo]
                                           [--chunksize=N]
                                           [--query=FILTER]...
-                                          [--replace]
+                                          [--replace | --incremental]
+                                          [--sweep]
                                           [--cache]
                                           [--grant=USER]...
 
@@ -15,33 +16,47 @@ Arguments:
 Options:
     --help                  Show this message
     --echo                  SQLAlchemy in mode debug
-    --cache                 Use the cache as a source (SOURCE.pickle in CACHE_DIR)
+    --cache                 Use the cache as a source (SOURCE in the extract cache)
     --replace               Drop and re-create the database table
-    --chunksize=N           Size of SQLAlchemy inserts [default: 100]
+    --incremental           Only merge the records written since the last run
+    --sweep                 Delete the records gone from Odoo (incremental
+                            runs also do it every week)
+    --chunksize=N           Rows per COPY into the warehouse [default: 10000]
     --query=FILTER          One or more Odoo filter (e.g. "active = True")
     --grant=USER            Grant SELECT access to selected users
 
 """
 
 
-from os.path import join, isfile
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 from logging import getLogger, DEBUG
 from docopt import docopt
-from pandas import DataFrame, read_pickle, to_datetime
+from pandas import DataFrame, NaT, to_datetime
 from petl import fromdataframe, look
 from sqlalchemy.types import DATE, TIMESTAMP, INTEGER, TEXT, BOOLEAN, NUMERIC
 
-from common.settings import CACHE_DIR
+from common.extract_cache import ExtractCache
+from common.sqlreader import sql
 from connectors import OdooConnector, WarehouseConnector
+from connectors.sql import format_identifiers
 from common.logger import configure_logger, MultilineFilter
 
 
+CREATE_WATERMARK_TABLE = sql('odoo_etl_wizard')[0]
+GET_WATERMARK = sql('odoo_etl_wizard')[1]
+UPDATE_WATERMARK = sql('odoo_etl_wizard')[2]
+INSERT_WATERMARK = sql('odoo_etl_wizard')[3]
+GET_IDS = sql('odoo_etl_wizard')[4]
+DELETE_IDS = sql('odoo_etl_wizard')[5]
+
 ALL_FIELDS = []
 NOW = datetime.now()
 TRUNCATE = 30
 MISSING_INT = -999999
+ODOO_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+SWEEP_INTERVAL = timedelta(days=7)
+DELETE_BATCH = 10000
 
 configure_logger()
 log = getLogger('odoo_etl_wizard')
@@ -56,12 +71,19 @@ class OdooETL(object):
     the display name field of the linked table) and grants
     access to selected users.
 
+    In incremental mode, only the records written since the last
+    run are extracted (the latest write_date is kept in a watermark
+    table) and they are merged into the table by id. Records deleted
+    in Odoo are swept out of the table every week or on demand.
+
     """
     def __init__(self,
                  source,
                  target,
-                 replace='append',
-                 chunksize=100,
+                 replace=False,
+                 incremental=False,
+                 sweep=False,
+                 chunksize=10000,
                  echo=False,
                  query=[],
                  cache=False,
@@ -91,11 +113,19 @@ class OdooETL(object):
         self.query = query
         self.use_cache = cache
         self.users = grant
-        self.db_mode = 'replace' if replace else 'append'
+        self.incremental = incremental
+        self.sweep = sweep
+
+        if incremental:
+            assert not replace, 'Incremental loads cannot replace the table'
+            assert not cache, 'Incremental loads cannot use the cache'
+            self.db_mode = 'merge'
+        else:
+            self.db_mode = 'replace' if replace else 'append'
 
         self.odoo = OdooConnector()
         self.dwh = WarehouseConnector()
-        self.filepath = join(CACHE_DIR, self.odoo_table + '.pickle')
+        self.cache = ExtractCache()
 
         self.client = self.odoo.db
         self.model = self.client.model(source)
@@ -109,6 +139,8 @@ class OdooETL(object):
 
         self.df = DataFrame()
         self.timestamp = NOW
+        self.watermark = None
+        self.swept_at = None
 
     def get_foreign_keys(self, relationship):
         return {key for key in self.model.keys()
@@ -126,7 +158,8 @@ class OdooETL(object):
         for column, data_type in self.column_types.items():
             if data_type == 'unsupported':
                 dropped.append(column)
-                del self.df[column]
+                if column in self.df:
+                    del self.df[column]
                 log.debug('Dropped column: %s (%s)', column)
 
         for column in dropped:
@@ -181,19 +214,73 @@ class OdooETL(object):
                 self.df[key] = self.df[key].map(str)
                 log.debug('Serialized foreign key ids: %s (*2many)', key)
 
+    @property
+    def sql_params(self):
+        return {'schema_': self.dwh.schema,
+                'table_': self.dwh_table}
+
+    def create_watermark_table(self):
+        create_table = format_identifiers(CREATE_WATERMARK_TABLE,
+                                          **self.sql_params)
+        self.dwh.db.execute(create_table + 'COMMIT;')
+
+    def read_watermark(self):
+        self.create_watermark_table()
+        watermarks = self.dwh.execute(GET_WATERMARK,
+                                      {'table_name': self.dwh_table},
+                                      **self.sql_params)
+        if not watermarks.empty:
+            self.watermark = self.to_datetime(watermarks['write_date'][0])
+            self.swept_at = self.to_datetime(watermarks['swept_at'][0])
+
+        log.info('Watermark of %s: %s (swept %s)',
+                 self.dwh_table, self.watermark, self.swept_at)
+
+    def write_watermark(self, write_date=None, swept_at=None):
+        parameters = {'table_name': self.dwh_table,
+                      'write_date': write_date,
+                      'swept_at': swept_at}
+
+        with self.dwh.db.begin() as c:
+            for dynamic_sql in (UPDATE_WATERMARK, INSERT_WATERMARK):
+                c.execute(format_identifiers(dynamic_sql, **self.sql_params),
+                          parameters)
+
+    @staticmethod
+    def to_datetime(value):
+        value = to_datetime(value)
+        return None if value is NaT else value.to_pydatetime()
+
     def extract(self):
-        if self.use_cache:
-            if isfile(self.filepath):
-                self.df = read_pickle(self.filepath)
-                log.info('Unpickled %s from %s', self.odoo_table, self.filepath)
-            else:
-                raise FileNotFoundError('%s has no cache yet', self.odoo_table)
+        if self.incremental:
+            self.read_watermark()
+
+            query = list(self.query)
+            if self.watermark:
+                # Records written in the watermark's second may have been
+                # missed, and merging them again is harmless.
+                since = self.watermark.strftime(ODOO_DATETIME_FORMAT)
+                query.append(('write_date', '>=', since))
+
+            fields = [column for column, data_type
+                      in self.column_types.items()
+                      if data_type != 'unsupported']
+            self.df = self.odoo.extract(self.odoo_table, query, fields)
+
+        elif self.use_cache:
+            self.df = self.cache.read(self.odoo_table)
+            log.info('Read %s from the extract cache', self.odoo_table)
 
         else:
-            records = self.client.read(self.odoo_table, self.query)
-            self.df = self.df.from_records(records)
-            self.df.to_pickle(self.filepath)
-            log.info('Cached %s to %s', self.odoo_table, self.filepath)
+            # Unsupported fields are dropped anyway so don't fetch them
+            fields = [column for column, data_type
+                      in self.column_types.items()
+                      if data_type != 'unsupported']
+            self.df = self.odoo.extract(self.odoo_table, self.query, fields)
+            self.cache.write(self.odoo_table, self.df,
+                             source='odoo', filters=self.query)
+            self.cache.evict()
+            log.info('Cached %s to %s', self.odoo_table, self.cache)
 
         log.info('Extracted in %s rows, %s columns from %s',
                  self.df.shape[0],
@@ -218,13 +305,13 @@ class OdooETL(object):
         self.df['etl_timestamp'] = NOW
         log.info('ETL cronjob timestamp: %s', NOW)
 
-        self.df.to_sql(self.dwh_table,
-                       self.dwh.db,
-                       index=False,
-                       schema=self.dwh.schema,
-                       if_exists=self.db_mode,
-                       dtype=self.column_types,
-                       chunksize=self.db_chunksize)
+        self.dwh.bulk_load(self.df,
+                           self.dwh_table,
+                           self.dwh.schema,
+                           mode=self.db_mode,
+                           key='id' if self.db_mode == 'merge' else None,
+                           dtype=self.column_types,
+                           chunksize=self.db_chunksize)
 
         log.info('Loaded (%s) %s rows, %s columns into %s.%s',
                  self.db_mode,
@@ -233,8 +320,38 @@ class OdooETL(object):
                  self.dwh.schema,
                  self.dwh_table)
         log.debug(look(fromdataframe(self.df), truncate=TRUNCATE))
+
+        if self.incremental and not self.df.empty:
+            write_date = self.to_datetime(self.df['write_date'].max())
+            self.write_watermark(write_date=write_date)
+            log.info('Watermark of %s moved to %s', self.dwh_table, write_date)
+
         self.grant_access()
 
+    def due_for_sweep(self):
+        if self.sweep:
+            return True
+        if self.incremental:
+            return self.swept_at is None or NOW - self.swept_at > SWEEP_INTERVAL
+        return False
+
+    def sweep_deleted(self):
+        """ Delete the records that are not in Odoo anymore. """
+        odoo_ids = set(self.client.search(self.odoo_table, self.query))
+
+        deleted = []
+        for chunk in self.dwh.execute_iter(GET_IDS, **self.sql_params):
+            deleted.extend(int(i) for i in chunk['id'] if i not in odoo_ids)
+
+        delete_ids = format_identifiers(DELETE_IDS, **self.sql_params)
+        for i in range(0, len(deleted), DELETE_BATCH):
+            self.dwh.db.execute(delete_ids, ids=deleted[i:i + DELETE_BATCH])
+
+        self.create_watermark_table()
+        self.write_watermark(swept_at=NOW)
+        log.info('Swept %s deleted records out of %s',
+                 len(deleted), self.dwh_table)
+
 
 def extract_transform_and_load(*io, **options):
     """ ETL job for Odoo tables. """
@@ -242,8 +359,13 @@ def extract_transform_and_load(*io, **options):
     log.info('Starting ETL job: %s into %s', *io)
     etl = OdooETL(*io, **options)
     etl.extract()
-    etl.transform()
-    etl.load()
+    if etl.df.empty:
+        log.info('Nothing to load from %s', io[0])
+    else:
+        etl.transform()
+        etl.load()
+    if etl.due_for_sweep():
+        etl.sweep_deleted()
     log.info('Completed ETL job: %s into %s', *io)
 
 
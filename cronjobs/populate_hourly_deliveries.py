@@ -4,11 +4,14 @@ Created on Jul 28, 2015
 @author: nicolasguenon
 '''
 import argparse
+import concurrent.futures
 import datetime
 import logging
 import pprint
 import psycopg2
 from common import logging_configurer
+from common.delivery_changes import (GET_WATERMARK_SQL, LOCK_CHANGES_SQL,
+                                     advance_watermark, create_change_tables)
 from common.logging_configurer import LOG_DIR
 
 INSERT_SQL = """
@@ -21,7 +24,11 @@ actual_datetime ,
 deliveries_created ,
 deliveries_done ,
 deliveries_cancelled_as_done ,
-total_deliveries_done
+total_deliveries_done ,
+fleet_display_name ,
+fleet_uuid ,
+fleet_country_code ,
+fleet_country_name
 )
 
 
@@ -29,7 +36,8 @@ select row_generator.fleet_backend_name, row_generator.gastronomic_day, row_gene
   coalesce(agg_deliveries.num_deliveries, 0) as deliveries_created,
   coalesce(agg_deliveries.dones, 0) as deliveries_done,
   coalesce(agg_deliveries.canc_dones, 0) as deliveries_cancelled_as_done,
-  coalesce(agg_deliveries.total_dones, 0) as total_deliveries_done
+  coalesce(agg_deliveries.total_dones, 0) as total_deliveries_done,
+  fleet.display_name, fleet.uuid, fleet.country_code, fleet.country_name
 
 FROM
 
@@ -42,7 +50,7 @@ FROM
   FROM
     generate_series (%s::timestamp, %s::timestamp, '1 day'::interval) dd,
     generate_series(0, 23, 1) hh,
-    (select distinct fleet_backend_name as fleet_backend_name, min(gastronomic_day) as first_day, max(gastronomic_day) as last_day from tableau.delivery_dwh group by fleet_backend_name) as fleets_table
+    tableau.fleet_date_range as fleets_table
   WHERE date_trunc('day', dd)::date >= fleets_table.first_day and date_trunc('day', dd)::date <= fleets_table.last_day
 
 ) AS row_generator
@@ -68,6 +76,9 @@ LEFT OUTER JOIN
 ON (row_generator.gastronomic_day = agg_deliveries.gastronomic_day
   AND row_generator.hour = agg_deliveries.hour
   AND row_generator.fleet_backend_name = agg_deliveries.fleet_backend_name)
+
+LEFT OUTER JOIN tableau.fleet AS fleet
+ON fleet.backend_name = row_generator.fleet_backend_name
 ;
 """
 
@@ -77,17 +88,178 @@ WHERE gastronomic_day >= %s
 AND gastronomic_day <= %s;
 """
 
-UPDATE_FLEET_INFO_SQL = """
-UPDATE tableau.hourly_deliveries
-SET fleet_display_name = tableau.fleet.display_name,
-    fleet_uuid = tableau.fleet.uuid,
-    fleet_country_code = tableau.fleet.country_code,
-    fleet_country_name = tableau.fleet.country_name
-FROM tableau.fleet
-WHERE tableau.hourly_deliveries.fleet_backend_name = tableau.fleet.backend_name;
+# The first and last gastronomic day of each fleet are kept in a summary
+# table, so that the row generator does not scan the whole of delivery_dwh.
+# It is seeded from delivery_dwh when empty, then it only ever grows: it is
+# merged from the days being rebuilt.
+CREATE_DATE_RANGE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS tableau.fleet_date_range (
+    fleet_backend_name text PRIMARY KEY,
+    first_day date NOT NULL,
+    last_day date NOT NULL
+);
+
+INSERT INTO tableau.fleet_date_range (fleet_backend_name, first_day, last_day)
+SELECT fleet_backend_name, min(gastronomic_day)::date, max(gastronomic_day)::date
+FROM tableau.delivery_dwh
+WHERE fleet_backend_name IS NOT NULL
+AND NOT EXISTS (SELECT 1 FROM tableau.fleet_date_range)
+GROUP BY fleet_backend_name;
+"""
+
+RANGE_DATE_RANGES_SQL = """
+CREATE TEMPORARY TABLE new_date_ranges
+ON COMMIT DROP AS
+SELECT fleet_backend_name,
+  min(gastronomic_day)::date as first_day,
+  max(gastronomic_day)::date as last_day
+FROM tableau.delivery_dwh
+WHERE gastronomic_day >= %s
+AND gastronomic_day <= %s
+AND fleet_backend_name IS NOT NULL
+GROUP BY fleet_backend_name;
+"""
+
+MERGE_DATE_RANGES_SQL = """
+UPDATE tableau.fleet_date_range AS ranges
+SET first_day = least(ranges.first_day, new_ranges.first_day),
+    last_day = greatest(ranges.last_day, new_ranges.last_day)
+FROM new_date_ranges AS new_ranges
+WHERE ranges.fleet_backend_name = new_ranges.fleet_backend_name;
+
+INSERT INTO tableau.fleet_date_range (fleet_backend_name, first_day, last_day)
+SELECT new_ranges.fleet_backend_name, new_ranges.first_day, new_ranges.last_day
+FROM new_date_ranges AS new_ranges
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM tableau.fleet_date_range AS ranges
+    WHERE ranges.fleet_backend_name = new_ranges.fleet_backend_name
+);
+"""
+
+# Incremental mode: the delivery loader appends the (fleet, gastronomic day)
+# pairs of every batch to tableau.delivery_changes (see
+# common.delivery_changes). The pairs past the watermark are rebuilt, plus
+# the empty days by which a fleet's date range grows.
+CHANGED_DAYS_SQL = """
+CREATE TEMPORARY TABLE changed_days
+ON COMMIT DROP AS
+SELECT DISTINCT fleet_backend_name, gastronomic_day
+FROM tableau.delivery_changes
+WHERE change_id > %s
+AND change_id <= %s
+AND fleet_backend_name IS NOT NULL
+AND gastronomic_day IS NOT NULL;
+
+CREATE TEMPORARY TABLE new_date_ranges
+ON COMMIT DROP AS
+SELECT fleet_backend_name,
+  min(gastronomic_day) as first_day,
+  max(gastronomic_day) as last_day
+FROM changed_days
+GROUP BY fleet_backend_name;
+
+CREATE TEMPORARY TABLE affected_days
+ON COMMIT DROP AS
+SELECT fleet_backend_name, gastronomic_day
+FROM changed_days
+UNION
+SELECT new_ranges.fleet_backend_name,
+  generate_series(ranges.last_day + 1, new_ranges.last_day, '1 day'::interval)::date
+FROM new_date_ranges AS new_ranges
+JOIN tableau.fleet_date_range AS ranges
+ON ranges.fleet_backend_name = new_ranges.fleet_backend_name
+WHERE new_ranges.last_day > ranges.last_day
+UNION
+SELECT new_ranges.fleet_backend_name,
+  generate_series(new_ranges.first_day, ranges.first_day - 1, '1 day'::interval)::date
+FROM new_date_ranges AS new_ranges
+JOIN tableau.fleet_date_range AS ranges
+ON ranges.fleet_backend_name = new_ranges.fleet_backend_name
+WHERE new_ranges.first_day < ranges.first_day;
+
+ANALYZE affected_days;
+"""
+
+DELETE_AFFECTED_SQL = """
+delete from tableau.hourly_deliveries
+USING affected_days
+WHERE tableau.hourly_deliveries.fleet_backend_name = affected_days.fleet_backend_name
+AND tableau.hourly_deliveries.gastronomic_day = affected_days.gastronomic_day;
+"""
+
+INSERT_AFFECTED_SQL = """
+insert into tableau.hourly_deliveries
+(
+fleet_backend_name,
+gastronomic_day,
+hour,
+actual_datetime ,
+deliveries_created ,
+deliveries_done ,
+deliveries_cancelled_as_done ,
+total_deliveries_done ,
+fleet_display_name ,
+fleet_uuid ,
+fleet_country_code ,
+fleet_country_name
+)
+
+
+select row_generator.fleet_backend_name, row_generator.gastronomic_day, row_generator.hour, row_generator.actual_datetime,
+  coalesce(agg_deliveries.num_deliveries, 0) as deliveries_created,
+  coalesce(agg_deliveries.dones, 0) as deliveries_done,
+  coalesce(agg_deliveries.canc_dones, 0) as deliveries_cancelled_as_done,
+  coalesce(agg_deliveries.total_dones, 0) as total_deliveries_done,
+  fleet.display_name, fleet.uuid, fleet.country_code, fleet.country_name
+
+FROM
+
+(
+
+  SELECT affected_days.gastronomic_day,
+    hh as hour,
+    CASE WHEN hh >= 8 THEN affected_days.gastronomic_day ELSE affected_days.gastronomic_day + 1 END + cast(to_char(hh, '99')||':00' AS time without time zone) as actual_datetime,
+    affected_days.fleet_backend_name
+  FROM
+    affected_days,
+    generate_series(0, 23, 1) hh
+
+) AS row_generator
+
+LEFT OUTER JOIN
+
+(
+  select date(delivery_dwh.gastronomic_day) as gastronomic_day,
+  date_part('hour', created_at_timestamp) as hour,
+  delivery_dwh.fleet_backend_name,
+  count(*) as num_deliveries,
+  count(CASE WHEN last_delivery_status = 'done' THEN 1 ELSE NULL END) as dones,
+  count(CASE WHEN last_delivery_status = 'cancelled' and cancellation_reason = 'Order delivered' THEN 1 ELSE NULL END) as canc_dones,
+  count(CASE WHEN last_delivery_status = 'done' OR (last_delivery_status = 'cancelled' and cancellation_reason = 'Order delivered') THEN 1 ELSE NULL END) as total_dones
+  from tableau.delivery_dwh
+  join affected_days
+  on delivery_dwh.fleet_backend_name = affected_days.fleet_backend_name
+  and date(delivery_dwh.gastronomic_day) = affected_days.gastronomic_day
+  where delivery_dwh.gastronomic_day >= (select min(gastronomic_day) from affected_days)
+  and delivery_dwh.gastronomic_day <= (select max(gastronomic_day) from affected_days)
+
+  group by delivery_dwh.fleet_backend_name, date(delivery_dwh.gastronomic_day), date_part('hour', created_at_timestamp)
+) AS agg_deliveries
+
+ON (row_generator.gastronomic_day = agg_deliveries.gastronomic_day
+  AND row_generator.hour = agg_deliveries.hour
+  AND row_generator.fleet_backend_name = agg_deliveries.fleet_backend_name)
+
+LEFT OUTER JOIN tableau.fleet AS fleet
+ON fleet.backend_name = row_generator.fleet_backend_name
+;
 """
 
 MODULE_NAME = 'populate_hourly_deliveries'
+WATERMARK_NAME = 'hourly_deliveries'
+
+DEFAULT_JOBS = 4
 
 # __name__ is the name of the module or '__main__'
 logger = logging.getLogger(__name__)
@@ -98,6 +270,13 @@ class ScriptError(Exception):
     pass
 
 
+def parse_date(string):
+    try:
+        return datetime.datetime.strptime(string, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid date: {}'.format(string))
+
+
 def parse_args():
 
     parser = argparse.ArgumentParser(
@@ -116,6 +295,21 @@ def parse_args():
                         dest='dbpassword', required=True,
                         help='password to log into the DB')
 
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('-i', '--incremental', action='store_true',
+                      dest='incremental',
+                      help='rebuild only the fleet days loaded since the '
+                           'last incremental run')
+    mode.add_argument('--backfill', action='store', nargs=2,
+                      dest='backfill', type=parse_date,
+                      metavar=('START', 'END'),
+                      help='rebuild a range of gastronomic days '
+                           '(YYYY-MM-DD), month by month')
+    parser.add_argument('-j', '--jobs', action='store', type=int,
+                        dest='jobs', default=DEFAULT_JOBS,
+                        help='months rebuilt in parallel in backfill mode '
+                             '(default: {})'.format(DEFAULT_JOBS))
+
     parsed_args = parser.parse_args()
     return parsed_args
 
@@ -142,12 +336,34 @@ def configure_logs(args):
                                      logging.WARNING)
 
 
-def update_db(username, password, start_date, end_date):
-
-    #conn = psycopg2.connect(("host='localhost' "
-    conn = psycopg2.connect(("host='bi-live-mon.deliveryhero.com' "
+def connect(username, password):
+    #return psycopg2.connect(("host='localhost' "
+    return psycopg2.connect(("host='bi-live-mon.deliveryhero.com' "
                              "dbname='valk_fleet' user='{}' "
                              "password='{}'").format(username, password))
+
+
+def create_tables(conn):
+    cur = conn.cursor()
+    cur.execute(CREATE_DATE_RANGE_TABLE_SQL)
+    conn.commit()
+    cur.close()
+    create_change_tables(conn)
+
+
+def update_date_ranges(conn, start_date, end_date):
+    cur = conn.cursor()
+
+    logger.debug('Updating fleet date ranges between dates {} and {}'.
+                 format(start_date, end_date))
+    cur.execute(RANGE_DATE_RANGES_SQL, (start_date, end_date))
+    cur.execute(MERGE_DATE_RANGES_SQL)
+
+    conn.commit()
+    cur.close()
+
+
+def rebuild_range(conn, start_date, end_date):
     cur = conn.cursor()
 
     logger.debug('Deleting between dates {} and {}'.format(start_date,
@@ -156,17 +372,112 @@ def update_db(username, password, start_date, end_date):
     logger.debug('Inserting between dates {} and {}'.format(start_date,
                                                             end_date))
     cur.execute(INSERT_SQL, (start_date, end_date, start_date, end_date))
-    conn.commit()
-
-    logger.debug('Updating fleet info')
-    cur.execute(UPDATE_FLEET_INFO_SQL)
+    logger.info('{} hourly rows between {} and {}'.
+                format(cur.rowcount, start_date, end_date))
 
     conn.commit()
     cur.close()
+
+
+def update_db(username, password, start_date, end_date):
+
+    conn = connect(username, password)
+    create_tables(conn)
+
+    update_date_ranges(conn, start_date, end_date)
+    rebuild_range(conn, start_date, end_date)
+
     conn.close()
 
 
+def update_db_incrementally(username, password):
+
+    conn = connect(username, password)
+    create_tables(conn)
+    cur = conn.cursor()
+
+    try:
+        cur.execute(LOCK_CHANGES_SQL)
+        cur.execute(GET_WATERMARK_SQL, (WATERMARK_NAME,))
+        last_change_id, max_change_id = cur.fetchone()
+
+        if max_change_id <= last_change_id:
+            logger.info('No changes since change {}'.format(last_change_id))
+            conn.rollback()
+            return
+
+        logger.debug('Rebuilding changes {} to {}'.format(last_change_id + 1,
+                                                          max_change_id))
+        cur.execute(CHANGED_DAYS_SQL, (last_change_id, max_change_id))
+        # Only now, as the affected days depend on the old date ranges
+        cur.execute(MERGE_DATE_RANGES_SQL)
+
+        cur.execute(DELETE_AFFECTED_SQL)
+        cur.execute(INSERT_AFFECTED_SQL)
+        logger.info('{} hourly rows rebuilt'.format(cur.rowcount))
+
+        advance_watermark(cur, WATERMARK_NAME, max_change_id)
+
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
+def month_chunks(start_date, end_date):
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        next_month = (chunk_start.replace(day=1) +
+                      datetime.timedelta(days=32)).replace(day=1)
+        chunk_end = min(next_month - datetime.timedelta(days=1), end_date)
+        yield chunk_start, chunk_end
+        chunk_start = next_month
+
+
+def rebuild_month(username, password, start_date, end_date):
+    # Each month runs in its own connection and transaction
+    conn = connect(username, password)
+    try:
+        rebuild_range(conn, start_date, end_date)
+    finally:
+        conn.close()
+
+
+def backfill_db(username, password, start_date, end_date, jobs=DEFAULT_JOBS):
+
+    conn = connect(username, password)
+    create_tables(conn)
+    update_date_ranges(conn, start_date, end_date)
+    conn.close()
+
+    chunks = list(month_chunks(start_date, end_date))
+    logger.info('Backfilling {} months with {} jobs'.format(len(chunks),
+                                                           jobs))
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(rebuild_month, username, password,
+                                   chunk_start, chunk_end)
+                   for chunk_start, chunk_end in chunks]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+
 def main(parsed_args):
+    if parsed_args.incremental:
+        update_db_incrementally(parsed_args.dbuser, parsed_args.dbpassword)
+        return
+
+    if parsed_args.backfill:
+        start_date, end_date = parsed_args.backfill
+        logger.debug('Start date = {}, end date = {}'.format(start_date,
+                                                             end_date))
+        backfill_db(parsed_args.dbuser, parsed_args.dbpassword,
+                    start_date, end_date, parsed_args.jobs)
+        return
+
     end_date = datetime.date.today() - datetime.timedelta(days=1)
     start_date = end_date - datetime.timedelta(days=2)
     logger.debug('Start date = {}, end date = {}'.format(start_date, end_date))
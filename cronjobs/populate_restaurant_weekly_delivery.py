@@ -9,6 +9,8 @@ import logging
 import pprint
 import psycopg2
 from common import logging_configurer
+from common.delivery_changes import (GET_WATERMARK_SQL, LOCK_CHANGES_SQL,
+                                     advance_watermark, create_change_tables)
 from common.logging_configurer import LOG_DIR
 
 COUNT_EXISTING_SQL = """SELECT COUNT(*)
@@ -17,6 +19,9 @@ COUNT_EXISTING_SQL = """SELECT COUNT(*)
                             AND week = %s
                             AND fleet = %s;"""
 
+# Weeks are ISO weeks (Monday to Sunday) of the gastronomic day. The
+# deliveries are filtered by gastronomic day before being aggregated, so a
+# range of weeks costs one scan of the matching days.
 INSERT_SQL = """
 INSERT INTO tableau.restaurant_weekly_delivery
 (year,
@@ -25,42 +30,117 @@ INSERT INTO tableau.restaurant_weekly_delivery
   restaurant_city,
   restaurant_name,
   restaurant_uuid,
-  deliveries)
-SELECT
-    date_part('year', gastronomic_day) as year,
-    date_part('week', gastronomic_day) as week,
-    fleet,
-    restaurant_city,
-    restaurant_name,
-    restaurant_uuid,
-    count(delivery_uuid) as deliveries
-FROM public.delivery
-WHERE driver_username NOT IN ('%%demo%%', '%%test%%', '%%valk%%')
-    AND (last_delivery_status LIKE ('done')
-    OR cancellation_reason LIKE ('Order delivered'))
-GROUP BY date_part('year', gastronomic_day),
-    DATE_PART('week', gastronomic_day),
-    fleet, restaurant_city, restaurant_name, restaurant_uuid
-HAVING date_part('year', gastronomic_day) = %s
-    AND date_part('week', gastronomic_day) = %s
+  deliveries,
+  fleet_display_name,
+  fleet_uuid,
+  fleet_country_code,
+  fleet_country_name)
+SELECT weekly.*,
+    fleet.display_name,
+    fleet.uuid,
+    fleet.country_code,
+    fleet.country_name
+FROM (
+    SELECT
+        date_part('isoyear', gastronomic_day) as year,
+        date_part('week', gastronomic_day) as week,
+        fleet,
+        restaurant_city,
+        restaurant_name,
+        restaurant_uuid,
+        count(delivery_uuid) as deliveries
+    FROM public.delivery
+    WHERE gastronomic_day >= %s
+        AND gastronomic_day < %s
+        AND driver_username NOT IN ('%%demo%%', '%%test%%', '%%valk%%')
+        AND (last_delivery_status LIKE ('done')
+        OR cancellation_reason LIKE ('Order delivered'))
+    GROUP BY date_part('isoyear', gastronomic_day),
+        DATE_PART('week', gastronomic_day),
+        fleet, restaurant_city, restaurant_name, restaurant_uuid
+) AS weekly
+LEFT JOIN tableau.fleet AS fleet
+    ON fleet.backend_name = weekly.fleet
 ;
 """
 
 DELETE_SQL = """DELETE FROM tableau.restaurant_weekly_delivery
-                    WHERE year = %s
-                        AND week = %s;"""
-
-UPDATE_FLEET_INFO_SQL = """
-UPDATE tableau.restaurant_weekly_delivery
-SET fleet_display_name = tableau.fleet.display_name,
-    fleet_uuid = tableau.fleet.uuid,
-    fleet_country_code = tableau.fleet.country_code,
-    fleet_country_name = tableau.fleet.country_name
-FROM tableau.fleet
-WHERE tableau.restaurant_weekly_delivery.fleet_backend_name = tableau.fleet.backend_name;
+                    WHERE year * 100 + week >= %s
+                        AND year * 100 + week <= %s;"""
+
+# One-off: the weeks used to be keyed on the calendar year of their days,
+# so that a week across New Year had rows under two keys (e.g. 2016-01-01
+# to 03 in week 53 of 2016), which the ISO keys never match. The whole
+# table is rebuilt with ISO years, from the first to the last delivery.
+DELIVERY_DAYS_SQL = """SELECT min(gastronomic_day)::date,
+                        max(gastronomic_day)::date
+                    FROM public.delivery;"""
+
+DELETE_ALL_SQL = """DELETE FROM tableau.restaurant_weekly_delivery;"""
+
+# Incremental mode: the weeks of the fleet days recorded in
+# tableau.delivery_changes past the watermark are rebuilt.
+CHANGED_WEEKS_SQL = """
+CREATE TEMPORARY TABLE changed_weeks
+ON COMMIT DROP AS
+SELECT DISTINCT date_trunc('week', gastronomic_day)::date AS week_start
+FROM tableau.delivery_changes
+WHERE change_id > %s
+AND change_id <= %s
+AND gastronomic_day IS NOT NULL;
+"""
+
+DELETE_CHANGED_SQL = """DELETE FROM tableau.restaurant_weekly_delivery
+                    USING changed_weeks
+                    WHERE year = date_part('isoyear', week_start)
+                        AND week = date_part('week', week_start);"""
+
+INSERT_CHANGED_SQL = """
+INSERT INTO tableau.restaurant_weekly_delivery
+(year,
+  week,
+  fleet_backend_name,
+  restaurant_city,
+  restaurant_name,
+  restaurant_uuid,
+  deliveries,
+  fleet_display_name,
+  fleet_uuid,
+  fleet_country_code,
+  fleet_country_name)
+SELECT weekly.*,
+    fleet.display_name,
+    fleet.uuid,
+    fleet.country_code,
+    fleet.country_name
+FROM (
+    SELECT
+        date_part('isoyear', gastronomic_day) as year,
+        date_part('week', gastronomic_day) as week,
+        fleet,
+        restaurant_city,
+        restaurant_name,
+        restaurant_uuid,
+        count(delivery_uuid) as deliveries
+    FROM public.delivery
+    JOIN changed_weeks
+        ON date_trunc('week', gastronomic_day)::date = changed_weeks.week_start
+    WHERE gastronomic_day >= (SELECT min(week_start) FROM changed_weeks)
+        AND gastronomic_day < (SELECT max(week_start) + 7 FROM changed_weeks)
+        AND driver_username NOT IN ('%%demo%%', '%%test%%', '%%valk%%')
+        AND (last_delivery_status LIKE ('done')
+        OR cancellation_reason LIKE ('Order delivered'))
+    GROUP BY date_part('isoyear', gastronomic_day),
+        DATE_PART('week', gastronomic_day),
+        fleet, restaurant_city, restaurant_name, restaurant_uuid
+) AS weekly
+LEFT JOIN tableau.fleet AS fleet
+    ON fleet.backend_name = weekly.fleet
+;
 """
 
 MODULE_NAME = 'populate_restaurant_weekly_delivery'
+WATERMARK_NAME = 'restaurant_weekly_delivery'
 
 # __name__ is the name of the module or '__main__'
 logger = logging.getLogger(__name__)
@@ -71,6 +151,18 @@ class ScriptError(Exception):
     pass
 
 
+def parse_week(string):
+    try:
+        monday = datetime.datetime.strptime(string + '-1', '%G-W%V-%u')
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid week: {}'.format(string))
+
+    # strptime takes week 53 of a year of 52 weeks for the next week 1
+    if '{}-W{:02d}'.format(*monday.isocalendar()[:2]) != string:
+        raise argparse.ArgumentTypeError('Invalid week: {}'.format(string))
+    return monday.date()
+
+
 def parse_args():
 
     parser = argparse.ArgumentParser(
@@ -89,6 +181,19 @@ def parse_args():
                         dest='dbpassword', required=True,
                         help='password to log into the DB')
 
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('-i', '--incremental', action='store_true',
+                      dest='incremental',
+                      help='rebuild only the weeks with deliveries loaded '
+                           'since the last incremental run')
+    mode.add_argument('--weeks', action='store', nargs=2,
+                      dest='weeks', type=parse_week,
+                      metavar=('START', 'END'),
+                      help='rebuild a range of ISO weeks (YYYY-Www)')
+    mode.add_argument('--rekey', action='store_true', dest='rekey',
+                      help='rebuild every week, once, to key the rows '
+                           'on ISO years instead of calendar years')
+
     parsed_args = parser.parse_args()
     return parsed_args
 
@@ -115,34 +220,121 @@ def configure_logs(args):
                                      logging.WARNING)
 
 
-def update_db(username, password, year, week):
-
-    #conn = psycopg2.connect(("host='localhost' "
-    conn = psycopg2.connect(("host='bi-live-mon.deliveryhero.com' "
+def connect(username, password):
+    #return psycopg2.connect(("host='localhost' "
+    return psycopg2.connect(("host='bi-live-mon.deliveryhero.com' "
                              "dbname='valk_fleet' user='{}' "
                              "password='{}'").format(username, password))
+
+
+def week_key(monday):
+    (year, week, _) = monday.isocalendar()
+    return year * 100 + week
+
+
+def week_start(day):
+    return day - datetime.timedelta(days=day.weekday())
+
+
+def update_db(username, password, first_monday, last_monday):
+
+    conn = connect(username, password)
     cur = conn.cursor()
 
-    logger.debug('Deleting Week {}'.format(week))
-    cur.execute(DELETE_SQL, (year, week))
-    logger.debug('Inserting Week {}'.format(week))
-    cur.execute(INSERT_SQL, (year, week))
-    logger.debug('Updating fleet info')
-    cur.execute(UPDATE_FLEET_INFO_SQL)
+    first_week = week_key(first_monday)
+    last_week = week_key(last_monday)
+    end_date = last_monday + datetime.timedelta(days=7)
+
+    logger.debug('Deleting Weeks {} to {}'.format(first_week, last_week))
+    cur.execute(DELETE_SQL, (first_week, last_week))
+    logger.debug('Inserting Weeks {} to {}'.format(first_week, last_week))
+    cur.execute(INSERT_SQL, (first_monday, end_date))
+    logger.info('{} weekly rows between weeks {} and {}'.
+                format(cur.rowcount, first_week, last_week))
+
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def rekey_db(username, password):
+
+    conn = connect(username, password)
+    cur = conn.cursor()
+
+    cur.execute(DELIVERY_DAYS_SQL)
+    (first_day, last_day) = cur.fetchone()
+    first_monday = week_start(first_day)
+    end_date = week_start(last_day) + datetime.timedelta(days=7)
+
+    logger.debug('Deleting all weeks')
+    cur.execute(DELETE_ALL_SQL)
+    logger.debug('Inserting weeks from {} to {}'.format(first_monday,
+                                                        end_date))
+    cur.execute(INSERT_SQL, (first_monday, end_date))
+    logger.info('{} weekly rows between weeks {} and {}'.
+                format(cur.rowcount, week_key(first_monday),
+                       week_key(week_start(last_day))))
 
     conn.commit()
     cur.close()
     conn.close()
 
 
+def update_db_incrementally(username, password):
+
+    conn = connect(username, password)
+    create_change_tables(conn)
+    cur = conn.cursor()
+
+    try:
+        cur.execute(LOCK_CHANGES_SQL)
+        cur.execute(GET_WATERMARK_SQL, (WATERMARK_NAME,))
+        last_change_id, max_change_id = cur.fetchone()
+
+        if max_change_id <= last_change_id:
+            logger.info('No changes since change {}'.format(last_change_id))
+            conn.rollback()
+            return
+
+        cur.execute(CHANGED_WEEKS_SQL, (last_change_id, max_change_id))
+        logger.info('Rebuilding {} weeks'.format(cur.rowcount))
+
+        cur.execute(DELETE_CHANGED_SQL)
+        cur.execute(INSERT_CHANGED_SQL)
+        logger.info('{} weekly rows rebuilt'.format(cur.rowcount))
+
+        advance_watermark(cur, WATERMARK_NAME, max_change_id)
+
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+
 def main(parsed_args):
-    # This ensures the week has already been completed
-    yesterday = datetime.date.today() - 7 * datetime.timedelta(days=1)
-    (year, week, _) = yesterday.isocalendar()
-    logger.debug('Filling table for year = {}, week = {}'.
-                 format(year, week))
+    if parsed_args.incremental:
+        update_db_incrementally(parsed_args.dbuser, parsed_args.dbpassword)
+        return
 
-    update_db(parsed_args.dbuser, parsed_args.dbpassword, year, week)
+    if parsed_args.rekey:
+        rekey_db(parsed_args.dbuser, parsed_args.dbpassword)
+        return
+
+    if parsed_args.weeks:
+        (first_monday, last_monday) = parsed_args.weeks
+    else:
+        # This ensures the week has already been completed
+        yesterday = datetime.date.today() - 7 * datetime.timedelta(days=1)
+        first_monday = last_monday = week_start(yesterday)
+    logger.debug('Filling table for weeks {} to {}'.
+                 format(week_key(first_monday), week_key(last_monday)))
+
+    update_db(parsed_args.dbuser, parsed_args.dbpassword,
+              first_monday, last_monday)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,212 @@
+'''
+Copies the fleet info of tableau.fleet into the tables aggregated by fleet,
+after tableau.fleet has changed.
+
+The jobs writing these tables enrich their rows on the way in, so this only
+catches up the rows written before a fleet was renamed or added. Nothing
+happens while the fingerprint of tableau.fleet is the one of the last run,
+and only the rows whose fleet info differs are rewritten.
+'''
+import argparse
+import logging
+
+import psycopg2
+
+from common import logging_configurer
+from common.logging_configurer import LOG_DIR
+
+MODULE_NAME = 'reenrich_fleet_info'
+
+# Table, its fleet key, the matching tableau.fleet column
+# and the (table column, tableau.fleet column) pairs to copy
+ENRICHED_TABLES = (
+    ('tableau.delivery_dwh', 'fleet_backend_name', 'backend_name',
+     (('fleet_display_name', 'display_name'),
+      ('fleet_uuid', 'uuid'),
+      ('fleet_country_code', 'country_code'),
+      ('fleet_country_name', 'country_name'),
+      ('fleet_city', 'city'))),
+    ('tableau.hourly_deliveries', 'fleet_backend_name', 'backend_name',
+     (('fleet_display_name', 'display_name'),
+      ('fleet_uuid', 'uuid'),
+      ('fleet_country_code', 'country_code'),
+      ('fleet_country_name', 'country_name'))),
+    ('tableau.restaurant_weekly_delivery', 'fleet_backend_name',
+     'backend_name',
+     (('fleet_display_name', 'display_name'),
+      ('fleet_uuid', 'uuid'),
+      ('fleet_country_code', 'country_code'),
+      ('fleet_country_name', 'country_name'))),
+    ('tableau.backend_hourly_drivers', 'fleet_uuid', 'uuid',
+     (('fleet_display_name', 'display_name'),
+      ('fleet_backend_name', 'backend_name'),
+      ('fleet_country_code', 'country_code'),
+      ('fleet_country_name', 'country_name'))),
+    ('tableau.backend_shift', 'fleet_uuid', 'uuid',
+     (('fleet_display_name', 'display_name'),
+      ('fleet_backend_name', 'backend_name'),
+      ('fleet_country_code', 'country_code'),
+      ('fleet_country_name', 'country_name'),
+      ('fleet_city', 'city'))),
+)
+
+REENRICH_SQL = """
+UPDATE {table} AS target
+SET {assignments}
+FROM tableau.fleet AS fleet
+WHERE target.{key} = fleet.{fleet_key}
+AND ({changes});
+"""
+
+CREATE_FINGERPRINT_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS tableau.fleet_fingerprint (
+    name text PRIMARY KEY,
+    fingerprint text NOT NULL,
+    updated_at timestamp with time zone NOT NULL DEFAULT now()
+);
+"""
+
+GET_FINGERPRINTS_SQL = """
+SELECT
+  (SELECT md5(string_agg(fleet::text, ',' ORDER BY fleet::text))
+   FROM tableau.fleet AS fleet),
+  (SELECT fingerprint
+   FROM tableau.fleet_fingerprint
+   WHERE name = %s);
+"""
+
+UPDATE_FINGERPRINT_SQL = """
+UPDATE tableau.fleet_fingerprint
+SET fingerprint = %(fingerprint)s,
+    updated_at = now()
+WHERE name = %(name)s;
+
+INSERT INTO tableau.fleet_fingerprint (name, fingerprint)
+SELECT %(name)s, %(fingerprint)s
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM tableau.fleet_fingerprint
+    WHERE name = %(name)s
+);
+"""
+
+FINGERPRINT_NAME = 'tableau.fleet'
+
+# __name__ is the name of the module or '__main__'
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(
+            description='Copies the fleet info into the tables aggregated by '
+                        'fleet when tableau.fleet has changed',
+            epilog='')
+
+    parser.add_argument('-d', '--debug', action='store_true', dest='debug',
+                        help='generates debug log file')
+    parser.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+                        help='print debug logs on console')
+
+    parser.add_argument('--dbuser', action='store',
+                        dest='dbuser', required=True,
+                        help='user to log into the DB')
+    parser.add_argument('--dbpassword', action='store',
+                        dest='dbpassword', required=True,
+                        help='password to log into the DB')
+
+    parser.add_argument('-f', '--force', action='store_true', dest='force',
+                        help='check the tables even if tableau.fleet has '
+                             'not changed')
+    parser.add_argument('-t', '--table', action='append', dest='tables',
+                        choices=[table for table, *_ in ENRICHED_TABLES],
+                        help='only check this table (repeatable)')
+
+    parsed_args = parser.parse_args()
+    return parsed_args
+
+
+def configure_logs(args):
+
+    log_file_name = MODULE_NAME + '.log'
+    debug_log_file_name = MODULE_NAME + '-debug.log'
+
+    log_file_folder = LOG_DIR
+
+    log_file_path = log_file_folder + '/' + log_file_name
+
+    if args.debug:
+        debug_log_file_path = log_file_folder + '/' + debug_log_file_name
+    else:
+        debug_log_file_path = None
+
+    if args.verbose:
+        logging_configurer.configure("", debug_log_file_path, log_file_path,
+                                     logging.DEBUG)
+    else:
+        logging_configurer.configure("", debug_log_file_path, log_file_path,
+                                     logging.WARNING)
+
+
+def reenrich_sql(table, key, fleet_key, columns):
+    assignments = ',\n    '.join('{} = fleet.{}'.format(column, fleet_column)
+                                 for column, fleet_column in columns)
+    changes = '\n  OR '.join('target.{} IS DISTINCT FROM fleet.{}'.
+                             format(column, fleet_column)
+                             for column, fleet_column in columns)
+    return REENRICH_SQL.format(table=table, assignments=assignments,
+                               key=key, fleet_key=fleet_key, changes=changes)
+
+
+def update_db(username, password, tables=None, force=False):
+
+    conn = psycopg2.connect(("host='bi-live-mon.deliveryhero.com' "
+                             "dbname='valk_fleet' user='{}' "
+                             "password='{}'").format(username, password))
+    cur = conn.cursor()
+
+    cur.execute(CREATE_FINGERPRINT_TABLE_SQL)
+    cur.execute(GET_FINGERPRINTS_SQL, (FINGERPRINT_NAME,))
+    (fingerprint, last_fingerprint) = cur.fetchone()
+    conn.commit()
+
+    if fingerprint == last_fingerprint and not force:
+        logger.info('tableau.fleet has not changed')
+    else:
+        for table, key, fleet_key, columns in ENRICHED_TABLES:
+            if tables and table not in tables:
+                continue
+
+            logger.debug('Updating fleet info of {}'.format(table))
+            cur.execute(reenrich_sql(table, key, fleet_key, columns))
+            logger.info('{} rows updated in {}'.format(cur.rowcount, table))
+            conn.commit()
+
+        # A partial run does not prove the other tables are up to date
+        if not tables:
+            cur.execute(UPDATE_FINGERPRINT_SQL,
+                        {'name': FINGERPRINT_NAME,
+                         'fingerprint': fingerprint})
+            conn.commit()
+
+    cur.close()
+    conn.close()
+
+
+def main(parsed_args):
+    update_db(parsed_args.dbuser, parsed_args.dbpassword,
+              parsed_args.tables, parsed_args.force)
+
+
+if __name__ == '__main__':
+
+    parsed_args = parse_args()
+    configure_logs(parsed_args)
+
+    logger.info(60 * '=')
+    logger.info("Script execution started")
+
+    main(parsed_args)
+
+    logger.info("Script execution finished")
+    logger.info(60 * '=')
@@ -0,0 +1,144 @@
+"""Summarize the trajectories of routes, shifts and driver days.
+
+Usage:
+    cronjob.summarize_trajectories START STOP [--margin=HOURS]
+
+Arguments:
+    START                   Start datetime (included)
+    STOP                    Stop datetime (excluded)
+
+Options:
+    --help                  Show this message
+    --margin=HOURS          Points read around the interval [default: 12]
+
+The distance, duration, moving and idle time, stops and speed percentiles
+of each route, shift and driver day are computed from our own tracking
+points (see common.trajectory_metrics) and merged into
+tableau.route_trajectory, tableau.shift_trajectory and
+tableau.driver_day_trajectory. The route and shift tables join the
+deliveries and shifts on their UUIDs, e.g. to check the backend's
+distance_traveled_to_customer against the tracked distance.
+
+The routes and shifts that start in the interval are summarized, and the
+driver days from the day of START to the day before STOP. Points are read
+from a margin around the interval, so that routes and shifts crossing its
+bounds are complete. They are streamed in driver order and summarized
+chunk by chunk, each cut between two drivers, as every trajectory belongs
+to a single driver.
+
+The points must not have been simplified (get_tracking_points
+--simplify): a stop is then collapsed to its first and last points, and
+when it lasts longer than the maximum gap of common.trajectory_metrics,
+its time counts as a signal loss instead of idle time and the stop goes
+missing. The job fails if any shard of the interval was simplified.
+
+"""
+
+
+from datetime import datetime, time, timedelta
+from logging import getLogger
+from dateutil.parser import parse
+from docopt import docopt
+from pandas import concat
+
+from common.logger import configure_logger
+from common.sqlreader import sql
+from common.trajectory_metrics import (summarize_driver_days,
+                                       summarize_routes, summarize_shifts)
+from connectors import WarehouseConnector
+
+
+CREATE_TABLES = sql('summarize_trajectories')[:3]
+GET_POINTS = sql('summarize_trajectories')[3]
+COUNT_SIMPLIFIED_SHARDS = sql('summarize_trajectories')[4]
+CREATE_SHARD_TABLE = sql('get_tracking_points')[2]
+
+SCHEMA = 'tableau'
+
+# Table, key and summary function
+SUMMARIES = (('route_trajectory', ['route', 'driver'], summarize_routes),
+             ('shift_trajectory', ['shift', 'driver'], summarize_shifts),
+             ('driver_day_trajectory', ['driver', 'day'],
+              summarize_driver_days))
+
+configure_logger()
+log = getLogger('summarize_trajectories')
+
+
+def iter_drivers(dwh, start, stop):
+    """ Yield the points of the interval as frames of whole drivers. """
+    rest = None
+
+    for chunk in dwh.execute_iter(GET_POINTS, {'start': start,
+                                               'stop': stop}):
+        if rest is not None:
+            chunk = concat([rest, chunk], ignore_index=True)
+
+        # The last driver may go on in the next chunk
+        complete = (chunk['driver'] != chunk['driver'].iloc[-1]).values
+        rest = chunk[~complete]
+        if complete.any():
+            yield chunk[complete]
+
+    if rest is not None:
+        yield rest
+
+
+def check_not_simplified(dwh, start, stop):
+    with dwh.db.begin() as c:
+        c.execute(CREATE_SHARD_TABLE)
+        simplified = c.execute(COUNT_SIMPLIFIED_SHARDS,
+                               {'start': start, 'stop': stop}).scalar()
+
+    if simplified:
+        raise ValueError('%s shards of tracking points from %s to %s were '
+                         'simplified, which distorts the idle time and the '
+                         'stops' % (simplified, start, stop))
+
+
+def in_interval(summary, start, stop):
+    if 'day' in summary:
+        return summary[(summary['day'] >= start.date()) &
+                       (summary['day'] < stop.date())]
+    return summary[(summary['start'] >= start) & (summary['start'] < stop)]
+
+
+def summarize_trajectories(start, stop, margin=12):
+    dwh = WarehouseConnector()
+    margin = timedelta(hours=float(margin))
+
+    with dwh.db.begin() as c:
+        for statement in CREATE_TABLES:
+            c.execute(statement)
+
+    # The first driver day starts at midnight
+    read_start = min(start - margin, datetime.combine(start.date(), time()))
+    read_stop = stop + margin
+    check_not_simplified(dwh, read_start, read_stop)
+
+    summaries = {table: [] for table, _, _ in SUMMARIES}
+    points = 0
+    for drivers in iter_drivers(dwh, read_start, read_stop):
+        points += len(drivers)
+        for table, _, summarize in SUMMARIES:
+            summaries[table].append(in_interval(summarize(drivers), start,
+                                                stop))
+
+    log.info('Read %s tracking points for %s to %s (%s margin)',
+             points, start, stop, margin)
+
+    computed_at = datetime.now()
+    for table, key, _ in SUMMARIES:
+        if not summaries[table]:
+            continue
+        summary = concat(summaries[table], ignore_index=True)
+        summary = summary.assign(computed_at=computed_at)
+        dwh.bulk_load(summary, table, SCHEMA, mode='merge', key=key)
+        log.info('Merged %s summaries into %s.%s', len(summary), SCHEMA, table)
+
+
+if __name__ == '__main__':
+    kwargs = {k.replace('--', ''): v for k, v in docopt(__doc__).items()}
+    start_, stop_ = parse(kwargs.pop('START')), parse(kwargs.pop('STOP'))
+    log.info('Trajectory summary options: %s', kwargs)
+    summarize_trajectories(start_, stop_, **kwargs)
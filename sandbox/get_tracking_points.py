@@ -9,14 +9,18 @@ Postgres:
     The relevant SQL statements are in get_tracking_points.sql. A table needs to be created
     before the script is run (the first statement).
 
+Production:
+    cronjobs/get_tracking_points.py extracts time shards in parallel and resumes them.
+
 """
 
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from logging import getLogger
 from pandas import DataFrame
 from dateutil.parser import parse
 
+from common.bloom import SeenKeys
 from common.logger import configure_logger
 from common.parser import InternalToolsParser
 from common.sqlreader import sql
@@ -34,6 +38,12 @@ DEFAULT_STOP = datetime(2016, 1, 31)
 
 POSTGRES = 'get_tracking_points'
 LAST_RECORD = 1
+GET_LOADED_KEYS = 6
+GET_KEYS_SINCE = 7
+
+# Points re-read before the last one loaded, see common.bloom
+OVERLAP = timedelta(minutes=10)
+TRACKING_POINTS_PER_DAY = 20000000
 
 
 configure_logger()
@@ -41,8 +51,9 @@ log = getLogger('get_tracking_points')
 
 
 def fetch_time_interval(args):
-    session = ValkfleetConnector().db
-    engine = WarehouseConnector().db
+    api = ValkfleetConnector()
+    dwh = WarehouseConnector()
+    engine = dwh.db
 
     log.info('Starting to load tracking points for %s to %s (batches of %s)...',
              args.start,
@@ -53,71 +64,65 @@ def fetch_time_interval(args):
     result = engine.execute(query)
     resume_from = args.start
 
+    # The points of the overlap that were loaded already are dropped
+    seen = SeenKeys(SCHEMA + '.' + TABLE, capacity=TRACKING_POINTS_PER_DAY)
+    seen.evict()
+    last_timestamp = None
+
     if result.rowcount:
         last_timestamp = list(result)[0][0]
-        if last_timestamp > args.start:
-            resume_from = last_timestamp
+        if last_timestamp - OVERLAP > args.start:
+            resume_from = last_timestamp - OVERLAP
             log.info('Resuming at %s', resume_from)
 
-    cursor = None
-    more = True
-    batch_counter = 0
-    batch_max_timestamp = None
-
-    while more:
-        url = ENDPOINT + '?begin={start}&end={stop}&batchsize={batch_size}'.format(start=resume_from,
-                                                                                   stop=args.stop,
-                                                                                   batch_size=args.batch_size)
-        if cursor:
-            url += '&cursor=%s' % cursor
-
-        log.info('Requesting %s', url)
-        response = session.get(url)
-        json = response.json()
-
-        if 'error' not in json.keys():
-            records = json['items']
-            more = json['more']
-            cursor = json['cursor']
-
-            batch = DataFrame().from_records(records)
-            # Postgres doesn't swallow dicts and the
-            # information is already in lat/lng anyways.
-            del batch['location']
-
-            # Pandas will create a table if it doesn't
-            # exist but column types won't be optimal.
-            batch.to_sql(TABLE, engine,
-                         schema=SCHEMA,
-                         if_exists='append',
-                         index=False)
-
-            # The time columns are actually strings
-            batch_min_timestamp = batch['datetime'].min()[:19]
-            batch_max_timestamp = batch['datetime'].max()[:19]
-
-            batch_counter += 1
-            log.info("Loaded batch {index} into table {schema}.{table} | "
-                     "{tmin} to {tmax} | "
-                     "{nrecords} records | "
-                     "{nfields} fields".format(schema=SCHEMA,
-                                               table=TABLE,
-                                               index=batch_counter,
-                                               nrecords=batch.shape[0],
-                                               nfields=batch.shape[1],
-                                               tmin=batch_min_timestamp,
-                                               tmax=batch_max_timestamp))
-
-        else:
-            message = 'Lost the cursor on batch {n} ({time}): aborting! {status} {error}'.format(
-                n=batch_counter,
-                time=batch_max_timestamp,
-                status=response.status_code,
-                error=response.json()
-            )
-            log.error(message, exc_info=True)
-            raise ConnectionAbortedError(message)
+    if last_timestamp and seen.missing_days(resume_from, last_timestamp):
+        loaded = dwh.execute(sql(POSTGRES)[GET_KEYS_SINCE],
+                             {'since': resume_from})
+        seen.add(loaded['uuid'].values, loaded['datetime'])
+        seen.save()
+
+    def loaded_keys(uuids):
+        loaded = dwh.execute(sql(POSTGRES)[GET_LOADED_KEYS],
+                             {'since': resume_from, 'uuids': uuids})
+        return loaded['uuid'].values
 
+    batch_counter = 0
+    params = {'begin': resume_from, 'end': args.stop}
+    pages = api.iter_pages(ENDPOINT, params,
+                           batch_size=args.batch_size,
+                           batch_param='batchsize')
+
+    for records in pages:
+        batch = DataFrame().from_records(records)
+        # Postgres doesn't swallow dicts and the
+        # information is already in lat/lng anyways.
+        del batch['location']
+
+        batch = seen.drop_seen(batch, 'uuid', 'datetime',
+                               confirm=loaded_keys)
+        if batch.empty:
+            log.info('Batch %s was loaded already', batch_counter)
+            continue
+
+        dwh.bulk_load(batch, TABLE, SCHEMA)
+
+        # The time columns are actually strings
+        batch_min_timestamp = batch['datetime'].min()[:19]
+        batch_max_timestamp = batch['datetime'].max()[:19]
+
+        batch_counter += 1
+        log.info("Loaded batch {index} into table {schema}.{table} | "
+                 "{tmin} to {tmax} | "
+                 "{nrecords} records | "
+                 "{nfields} fields".format(schema=SCHEMA,
+                                           table=TABLE,
+                                           index=batch_counter,
+                                           nrecords=batch.shape[0],
+                                           nfields=batch.shape[1],
+                                           tmin=batch_min_timestamp,
+                                           tmax=batch_max_timestamp))
+
+    seen.save()
     log.info('Finished loading tracks for %s to %s', args.start, args.stop)
 
 
@@ -143,7 +148,7 @@ if __name__ == '__main__':
 
     p.add_argument(
         '--batch',
-        help='batch size (default = %s)' % DEFAULT_BATCH_SIZE,
+        help='initial batch size, adapted on the way (default = %s)' % DEFAULT_BATCH_SIZE,
         type=int,
         dest='batch_size',
         default=DEFAULT_BATCH_SIZE
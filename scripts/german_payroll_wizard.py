@@ -34,8 +34,6 @@ def produce_delivery_count_table():
     filters = [('supplier', '=', True),
                ('active', '=', True),
                ('company_id', '=', 5)]  # 5 is germany
-    df = odoo.extract('res.partner', filters)
-    odoo_drivers = fromdataframe(df)
 
     mappings = {
         'driver_app_username': 'x_driver_app_username',
@@ -43,6 +41,10 @@ def produce_delivery_count_table():
         'odoo_id': 'id',
         'fullname_in_odoo': 'display_name'
     }
+
+    df = odoo.extract('res.partner', filters, list(mappings.values()))
+    odoo_drivers = fromdataframe(df)
+
     odoo_drivers = odoo_drivers.fieldmap(mappings)
 
     # cache the results
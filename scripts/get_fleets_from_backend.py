@@ -4,16 +4,20 @@ Created on Jul 28, 2015
 @author: nicolasguenon
 '''
 import argparse
+import concurrent.futures
 import csv
+import fcntl
 import io
 import json
 import logging
+import os
 import pprint
 import sys
 import time
 import urllib.request
 
 from common.logging_configurer import configure_default, LOG_DIR
+from common.settings import CACHE_DIR
 from connectors.backend import BackendConnector
 from common import logging_configurer
 
@@ -22,6 +26,14 @@ LOGIN_URL = 'https://api.valkfleet.com/login'
 FLEETS_URL = 'https://api.valkfleet.com/fleets/'
 # RESTAURANTS_URL = 'http://localhost:8080/restaurants/'
 
+# Fleets are shared between jobs through a cache file. The list of fleets
+# is checked again after CACHE_TTL seconds, and only the fleets that are
+# not cached yet are fetched. Every fleet is fetched again once a day.
+CACHE_FILE = os.path.join(CACHE_DIR, 'fleets.json')
+CACHE_TTL = 3600
+FULL_REFRESH_AGE = 86400
+DOWNLOAD_WORKERS = 8
+
 # __name__ is the name of the module or '__main__'
 logger = logging.getLogger(__name__)
 pp = pprint.PrettyPrinter(indent=4)
@@ -48,6 +60,9 @@ def _parse_args():
     parser.add_argument('-p', '--password', action='store',
                         dest='password', required=True,
                         help='password to log into the backend')
+    parser.add_argument('-r', '--refresh', action='store_true',
+                        dest='refresh',
+                        help='fetch every fleet again, ignoring the cache')
 
     parsed_args = parser.parse_args()
     return parsed_args
@@ -77,7 +92,83 @@ def _configure_logs(args):
     logger.debug('Script args={}'.format(args))
 
 
-def download_data(backend_connector):
+def download_data(backend_connector, max_age=CACHE_TTL, refresh=False):
+    """ Return the fleets dict keyed by fleet UUID.
+
+    Fleets come from the cache file when it was checked less than max_age
+    seconds ago. Jobs starting together wait on the lock for the first one
+    to refresh the cache, then read it.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    with open(CACHE_FILE + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        cache = _read_cache()
+        now = time.time()
+
+        if not refresh and now - cache['checked_at'] < max_age:
+            logger.info('Using {} cached fleets'.
+                        format(len(cache['fleets'])))
+            return cache['fleets']
+
+        full = refresh or now - cache['refreshed_at'] >= FULL_REFRESH_AGE
+        cache = _refresh_cache(backend_connector, cache, full)
+        _write_cache(cache)
+
+    return cache['fleets']
+
+
+def _read_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logger.info('No usable fleet cache in {}'.format(CACHE_FILE))
+        return {'checked_at': 0,
+                'refreshed_at': 0,
+                'modified_at': None,
+                'fleets': {}}
+
+
+def _write_cache(cache):
+    # Readers never see a half written file
+    temp_file = CACHE_FILE + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(cache, f)
+    os.replace(temp_file, CACHE_FILE)
+
+
+def _refresh_cache(backend_connector, cache, full):
+    fleet_uuids = _download_fleet_uuids(backend_connector)
+
+    cached_fleets = {} if full else cache['fleets']
+    missing_uuids = [fleet_uuid for fleet_uuid in fleet_uuids
+                     if fleet_uuid not in cached_fleets]
+
+    logger.info('Getting fleet data for {} of {} fleets'.
+                format(len(missing_uuids), len(fleet_uuids)))
+    new_fleets = _download_fleets(backend_connector, missing_uuids)
+
+    # Fleets that are no longer listed drop out of the cache
+    fleets_dict = {}
+    for fleet_uuid in fleet_uuids:
+        fleets_dict[fleet_uuid] = (new_fleets.get(fleet_uuid) or
+                                   cached_fleets[fleet_uuid])
+
+    modified_at = max((fleet['modified_at'] for fleet in fleets_dict.values()
+                       if fleet['modified_at']), default=None)
+    if modified_at != cache['modified_at']:
+        logger.info('Fleets modified up to {}'.format(modified_at))
+
+    now = time.time()
+    return {'checked_at': now,
+            'refreshed_at': now if full else cache['refreshed_at'],
+            'modified_at': modified_at,
+            'fleets': fleets_dict}
+
+
+def _download_fleet_uuids(backend_connector):
 
     logger.info('Getting the list of fleets UUIDs')
 
@@ -88,66 +179,41 @@ def download_data(backend_connector):
         if cursor is None:
             url = FLEETS_URL
         else:
-            # request = API_DRIVERS_URL + '?cursor={}'.format(cursor)
             url = (FLEETS_URL + '?' +
                    urllib.parse.urlencode({'cursor': cursor}))
-            logger.debug('URL: ' + url)
-
-        print(url)
-        request = urllib.request.Request(url)
-        request.add_header('Authorization', backend_connector.auth_token)
-        logger.debug('Getting JSON data')
-        with backend_connector.opener.open(request) as response:
-
-            logger.debug('Retrieved JSON from this URL: {}'.
-                         format(response.geturl()))
-
-            # The response shouldn't be larger than 1 MiB
-            fleet_json = response.read(1048576).decode('utf-8')
-
-            if (response.read(1024) != b''):
-                raise ScriptError('Dowloaded JSON is larger than 1 MiB')
+        logger.debug('URL: ' + url)
 
-        data = json.loads(fleet_json)
+        data = backend_connector.get_json(url)
         fleet_uuids.extend(data['items'])
         more = data['more']
         cursor = data['cursor']
 
-    logger.info('Getting all fleet data for each fleet')
-
-    fleets_dict = {}
-    for fleet_uuid in fleet_uuids:
-        url = (FLEETS_URL + urllib.parse.quote_plus(fleet_uuid))
-        logger.debug('URL: ' + url)
-        print(url)
-        request = urllib.request.Request(url)
-        request.add_header('Authorization', backend_connector.auth_token)
-        logger.debug('Getting JSON data for fleet = {}'.format(fleet_uuid))
-        with backend_connector.opener.open(request) as response:
-
-            logger.debug('Retrieved JSON from this URL: {}'.
-                         format(response.geturl()))
+    return fleet_uuids
 
-            # The response shouldn't be larger than 1 MiB
-            fleet_json = response.read(1048576).decode('utf-8')
 
-            if (response.read(1024) != b''):
-                raise ScriptError('Dowloaded JSON is larger than 1 MiB')
+def _download_fleet(backend_connector, fleet_uuid):
+    url = (FLEETS_URL + urllib.parse.quote_plus(fleet_uuid))
+    logger.debug('Getting JSON data for fleet = {}'.format(fleet_uuid))
+    # Structure of each fleet dict:
 
-        data = json.loads(fleet_json)
-        # Structure of each "data" dict:
+    # {   'cc_phone': '0800 612 6220',
+    #     'created_at': '2015-10-28T10:19:25+00:00',
+    #     'deleted_at': None,
+    #     'drivers': [],
+    #     'modified_at': '2015-11-02T16:28:11+00:00',
+    #     'name': 'leeds',
+    #     'restaurants': [],
+    #     'uuid': '0f7d2ef4-e397-4979-8051-0057becfac23'}
+    return backend_connector.get_json(url)
 
-        # {   'cc_phone': '0800 612 6220',
-        #     'created_at': '2015-10-28T10:19:25+00:00',
-        #     'deleted_at': None,
-        #     'drivers': [],
-        #     'modified_at': '2015-11-02T16:28:11+00:00',
-        #     'name': 'leeds',
-        #     'restaurants': [],
-        #     'uuid': '0f7d2ef4-e397-4979-8051-0057becfac23'}
 
-        fleets_dict[fleet_uuid] = data
-    return fleets_dict
+def _download_fleets(backend_connector, fleet_uuids):
+    with concurrent.futures.ThreadPoolExecutor(DOWNLOAD_WORKERS) as executor:
+        fleets = executor.map(
+                    lambda fleet_uuid: _download_fleet(backend_connector,
+                                                       fleet_uuid),
+                    fleet_uuids)
+        return dict(zip(fleet_uuids, fleets))
 
 
 def generate_csv(fleets_dict):
@@ -201,7 +267,8 @@ def generate_restaurants_csv(fleets_dict):
 def main(parsed_args):
     backend_connector = BackendConnector()
     backend_connector.authenticate(parsed_args.username, parsed_args.password)
-    fleets_dict = download_data(backend_connector)
+    fleets_dict = download_data(backend_connector,
+                                refresh=parsed_args.refresh)
     print('\nFleets')
     print(generate_csv(fleets_dict))
     print('\nDrivers')
@@ -24,6 +24,10 @@
     The output is a tree of reports: ~reports/blueprint/group_by/select_by/output.pdf.
     Caution! Any existing file will be overwritten.
 
+    To render several reports at the same time, e.g. on billing days, add -w 4.
+    The reports are rendered by a pool of processes, each on its own core. A report
+    that fails is logged and the others go on: the failures are listed at the end.
+
     If no date arguments are specified, the program will process the last half-month,
     which is either from the 1st to the 15th or from the 16th to the end of the month.
 
@@ -33,11 +37,13 @@
 
 from argparse import RawDescriptionHelpFormatter
 from calendar import monthrange
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import date
+from functools import lru_cache
 from importlib import import_module
 from logging import getLogger
 from os import makedirs, remove
-from os.path import join, isdir, isfile, dirname, abspath, expanduser
+from os.path import join, isfile, dirname, abspath, expanduser
 from textwrap import dedent
 from time import strptime
 from bunch import Bunch
@@ -90,29 +96,76 @@ def mass_produce_reports(**kwargs):
     log.info('Data loaded from %s', factory.engine)
     log.info('Processing %d %s pdf_report_blueprints', factory.total_reports, options.blueprint)
 
-    for name, data in factory.extract_report_data():
-        report = Report(name, data, options)
-        report.create_folder()
+    # Partitioned up front, so that each worker gets its report's rows only
+    reports = list(factory.extract_report_data())
+    workers = options.get('workers') or 1
+    failures = []
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = {executor.submit(render_report, name, data, options): name
+                       for name, data in reports}
+            results = ((futures[future], future) for future in as_completed(futures))
+            for done, (name, future) in enumerate(results, 1):
+                _log_progress(log, name, future.result, done, len(reports), failures)
+    else:
+        for done, (name, data) in enumerate(reports, 1):
+            _log_progress(log, name, lambda: render_report(name, data, options),
+                          done, len(reports), failures)
 
-        table_df = report.build_custom_table()
+    if failures:
+        raise ReportError('%d of %d reports failed: %s' % (
+            len(failures), len(reports), ', '.join(str(name) for name in failures)))
 
-        if options.format == 'pdf':
-            table_html = table_df.to_html(index=False, justify='left')
-            report_html = factory.jinja_template.render(options=options, header=report.header, table=table_html)
-            HTML(string=report_html).write_pdf(report.filepath, stylesheets=factory.css_stylesheets)
+    log.info('Done processing %s pdf_report_blueprints', options.blueprint)
+    log.info(LINE)
 
-        elif options.format == 'xlsx':
-            writer = ExcelWriter(report.filepath)
-            table_df.to_excel(writer, name)
-            writer.save()
 
-        else:
-            raise ReportError('Unsupported output file format')
+def _log_progress(log, name, render, done, total, failures):
+    try:
+        filepath = render()
+    except Exception:
+        log.exception('Failed to produce the report for %s (%d/%d)', name, done, total)
+        failures.append(name)
+    else:
+        log.info('Saved %s (%d/%d)', filepath, done, total)
 
-        log.debug('Saved %s', report.filepath)
 
-    log.info('Done processing %s pdf_report_blueprints', options.blueprint)
-    log.info(LINE)
+def render_report(name, data, options):
+    """ Produce one report and return its filepath. This runs in the worker processes. """
+
+    report = Report(name, data, options)
+    report.create_folder()
+
+    table_df = report.build_custom_table()
+
+    if options.format == 'pdf':
+        folder = blueprint_folder(options.blueprint)
+        table_html = table_df.to_html(index=False, justify='left')
+        report_html = jinja_template(folder).render(options=options, header=report.header, table=table_html)
+        HTML(string=report_html).write_pdf(report.filepath, stylesheets=[join(folder, 'stylesheet.css')])
+
+    elif options.format == 'xlsx':
+        writer = ExcelWriter(report.filepath)
+        table_df.to_excel(writer, name)
+        writer.save()
+
+    else:
+        raise ReportError('Unsupported output file format')
+
+    return report.filepath
+
+
+def blueprint_folder(blueprint_name):
+    return join(blueprints_dir, blueprint_name)
+
+
+@lru_cache()
+def jinja_template(folder):
+    # Compiled once per process
+    jinja_loader = FileSystemLoader(folder)
+    environment = Environment(loader=jinja_loader)
+    return environment.get_template('template.html')
 
 
 class Factory(object):
@@ -162,9 +215,7 @@ class Factory(object):
 
     @property
     def jinja_template(self):
-        jinja_loader = FileSystemLoader(self._blueprint_folder)
-        environment = Environment(loader=jinja_loader)
-        return environment.get_template('template.html')
+        return jinja_template(self._blueprint_folder)
 
     @property
     def css_stylesheets(self):
@@ -172,7 +223,7 @@ class Factory(object):
 
     @property
     def _blueprint_folder(self):
-        return join(blueprints_dir, self.options.blueprint)
+        return blueprint_folder(self.options.blueprint)
 
 
 class Report(object):
@@ -190,8 +241,8 @@ class Report(object):
         return columns.build()
 
     def create_folder(self):
-        if not isdir(self._output_folder):
-            makedirs(self._output_folder)
+        # Workers may create the same group folder at the same time
+        makedirs(self._output_folder, exist_ok=True)
         if isfile(self.filepath):
             remove(self.filepath)
 
@@ -380,6 +431,14 @@ def build_parser():
         choices=('pdf', 'xlsx')
     )
 
+    p.add_argument(
+        '-w', '--workers',
+        help='number of reports rendered at the same time (default = 1)',
+        type=int,
+        dest='workers',
+        default=1
+    )
+
     return p
 
 
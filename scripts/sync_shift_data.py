@@ -6,7 +6,6 @@ Created on Sep 23, 2015
 import argparse
 import datetime
 import logging
-import math
 import pprint
 import sys
 import time
@@ -15,6 +14,7 @@ import pandas as pd
 import psycopg2
 
 from common import logging_configurer
+from common.grid import OccupancyGrid
 
 # See: ('http://pandas.pydata.org/pandas-docs/stable/indexing.html' +
 #       '#indexing-view-versus-copy')
@@ -24,6 +24,8 @@ pd.set_option('mode.chained_assignment', 'raise')
 
 MODULE_NAME = 'sync_shift_data'
 GASTRO_DAY_FIRST_HOUR = 8
+START_DATE = datetime.date(2015, 9, 1)
+END_DATE = datetime.date(2015, 10, 25)
 
 FLEETS = ('Basildon', 'Birmingham', 'Manchester', 'Nottingham', 'London',
           'Derby')
@@ -46,9 +48,7 @@ SALARY_TO_ON_CALL = {1201: False,
 DB_FIELDS = ('actual_datetime', 'regular_drivers', 'team_leaders',
              'total_active_drivers', 'on_call_drivers',
              'total_drivers')
-DB_REAL_FIELDS = ('regular_drivers', 'team_leaders',
-                  'total_active_drivers', 'on_call_drivers',
-                  'total_drivers')
+SHIFT_FIELDS = ('regular_drivers', 'team_leaders', 'on_call_drivers')
 COUNT_EXISTING_SQL = """SELECT COUNT(*)
                         FROM tableau.planday_hourly_drivers
                         WHERE gastronomic_date = %s
@@ -130,70 +130,16 @@ def configure_logs(args):
     # print(pp.pprint(restaurants[0]))
 
 
-def create_output_df():
-    start_date = datetime.date(2015, 9, 1)
-    end_date = datetime.date(2015, 10, 25)
-    one_day = datetime.timedelta(days=1)
-    one_hour = datetime.timedelta(hours=1)
-    hours = [_ for _ in range(8, 24)]
-    hours.extend([_ for _ in range(8)])
-
-    num_fleets = len(FLEETS)
-    gastro_datetimes = []
-    real_datetimes = []
-    init_values = []
-    current_gastro_date = start_date  # dates are immutable
-    while current_gastro_date <= end_date:
-        current_real_datetime = datetime.datetime(current_gastro_date.year,
-                                                  current_gastro_date.month,
-                                                  current_gastro_date.day,
-                                                  8)
-
-        for hour in hours:
-            current_gastro_datetime = datetime.datetime(
-                            current_gastro_date.year,
-                            current_gastro_date.month,
-                            current_gastro_date.day,
-                            hour)
-            gastro_datetimes.append(current_gastro_datetime)
-            for _ in range(num_fleets):
-                real_datetimes.append(current_real_datetime)
-                # TODO get rid of this ugly thing
-                init_values.append(0.0)
-
-            current_real_datetime += one_hour
-        current_gastro_date += one_day
-
-    index = pd.MultiIndex.from_product((gastro_datetimes, FLEETS),
-                                       names=['gastronomic_datetime',
-                                              'fleet'])
-
-    output_df = pd.DataFrame(index=index, columns=DB_FIELDS)
-    output_df['actual_datetime'] = real_datetimes
-    for field_name in DB_REAL_FIELDS:
-        output_df[field_name] = init_values
-
-    # print(output_df.head(8))
-    # print(output_df.tail(8))
-    logger.info('Output DataFrame created')
-    return output_df
-
-
 def read_data():
     input_df = pd.read_excel(file_path, sheet_name='Valkfleet')
-    output_df = create_output_df()
-
-    for i in input_df.index:
-        if i % 100 == 0:
-            logger.info('Read {} input rows so far'.format(i))
 
-        row = input_df.ix[i]
-        start = row['start date']
-        end = row['End date']
-        role = row['Employee Group (role)']
+    shifts = {field_name: ([], [], []) for field_name in SHIFT_FIELDS}
+    for start, end, role, salary_type in zip(input_df['start date'],
+                                             input_df['End date'],
+                                             input_df['Employee Group (role)'],
+                                             input_df['Salary type']):
         if role in ('sdjfjds', 'Month salary'):
             continue
-        salary_type = row['Salary type']
         if salary_type == 1:
             continue
 
@@ -209,44 +155,34 @@ def read_data():
         else:
             relevant_field = 'regular_drivers'
 
-        # logger.debug((start, end, role, fleet, captain, on_call))
-
-        start_hour_contribution = (60 - start.minute) / 60
-        end_hour_contribution = end.minute / 60
-        # logger.debug(start.hour, start.minute, start_hour_contribution)
-        # logger.debug(end.hour, end.minute, end_hour_contribution)
-
-        gastro_date = datetime.date(start.year, start.month, start.day)
-
-        if end.hour < start.hour:
-            hours = range(start.hour, end.hour + 25)
+        starts, ends, fleets = shifts[relevant_field]
+        starts.append(start)
+        ends.append(end)
+        fleets.append(fleet)
+
+    logger.info('Read {} input rows'.format(len(input_df)))
+
+    output_df = None
+    for field_name, (starts, ends, fleets) in shifts.items():
+        grid = OccupancyGrid(START_DATE, END_DATE, FLEETS,
+                             first_hour=GASTRO_DAY_FIRST_HOUR)
+        dropped = grid.add(starts, ends, fleets)
+        if dropped:
+            logger.warning('{} {} shifts from unknown fleets ignored'.
+                           format(dropped, field_name))
+
+        field_df = grid.to_frame(field_name)
+        if output_df is None:
+            output_df = field_df
         else:
-            hours = range(start.hour, end.hour + 1)
-        for hour in hours:
-            hour %= 24
-            gastro_datetime = datetime.datetime(gastro_date.year,
-                                                gastro_date.month,
-                                                gastro_date.day,
-                                                hour)
-            current_drivers = output_df.loc[(gastro_datetime, fleet),
-                                            relevant_field]
-            if math.isnan(current_drivers):
-                current_drivers = 0.0
-            if hour == start.hour:
-                current_drivers += start_hour_contribution
-            elif hour == end.hour:
-                current_drivers += end_hour_contribution
-            else:
-                current_drivers += 1.0
-            output_df.loc[(gastro_datetime, fleet),
-                          relevant_field] = current_drivers
-            # logger.debug((gastro_date, hour, fleet, current_drivers))
+            output_df[field_name] = field_df[field_name]
 
     logger.info('Computing totals')
     output_df['total_active_drivers'] = (output_df['regular_drivers'] +
                                          output_df['team_leaders'])
     output_df['total_drivers'] = (output_df['total_active_drivers'] +
                                   output_df['on_call_drivers'])
+    output_df = output_df[list(DB_FIELDS)]
     # Output last day
     logger.info(output_df.tail(24 * len(FLEETS)))
     return output_df
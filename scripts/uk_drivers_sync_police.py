@@ -8,8 +8,9 @@ from re import compile, IGNORECASE
 from uuid import UUID
 
 from pandas import DataFrame, read_excel, Series, concat
-from petl import fromdataframe, frompickle, join, antijoin, outerjoin
+from petl import fromdataframe, join, antijoin, outerjoin
 
+from common.extract_cache import ExtractCache
 from common.logger import configure_logger
 from common.settings import CACHE_DIR
 from common.sqlreader import SQLReader
@@ -27,10 +28,11 @@ timestamp = datetime.now()
 OFFLINE = False
 
 
-DRIVERS_IN_ODOO_FILEPATH = os.path.join(CACHE_DIR, 'drivers_from_odoo.pickle')
-USERS_IN_BACKEND_FILEPATH = os.path.join(CACHE_DIR, 'users_from_backend.pickle')
-DRIVERS_IN_BACKEND_FILEPATH = os.path.join(CACHE_DIR, 'drivers_from_backend.pickle')
-FLEETS_IN_BACKEND_FILEPATH = os.path.join(CACHE_DIR, 'fleets_from_backend.pickle')
+# Names in the extract cache
+DRIVERS_IN_ODOO = 'uk_drivers_from_odoo'
+USERS_IN_BACKEND = 'uk_users_from_backend'
+DRIVERS_IN_BACKEND = 'uk_drivers_from_backend'
+FLEETS_IN_BACKEND = 'uk_fleets_from_backend'
 DRIVERS_IN_PLANDAY_FILEPATH = os.path.join(CACHE_DIR, 'all_employees_from_planday.xlsx')
 
 ODOO_WITH_BACKEND_FILENAME = os.path.join(CACHE_DIR, 'odoo_with_backend.xlsx')
@@ -90,10 +92,11 @@ def extract_odoo(offline=OFFLINE):
 
         drivers = drivers.fieldmap(mappings)
         drivers = drivers.suffixheader('_in_odoo')
-        drivers.topickle(DRIVERS_IN_ODOO_FILEPATH)
+        ExtractCache().write(DRIVERS_IN_ODOO, drivers.todataframe(),
+                             source='odoo', filters=filters)
 
     else:
-        drivers = frompickle(DRIVERS_IN_ODOO_FILEPATH)
+        drivers = fromdataframe(ExtractCache().read(DRIVERS_IN_ODOO))
 
     drivers = drivers.addfield('backend_username', lambda rec: rec['backend_username_in_odoo'])
     drivers = drivers.addfield('salary_id', lambda rec: rec['salary_id_in_odoo'])
@@ -170,14 +173,16 @@ def extract_backend(offline=OFFLINE):
         fleets = extract_fleets_from_dwh()
         users = extract_users()
 
-        drivers.topickle(DRIVERS_IN_BACKEND_FILEPATH)
-        fleets.topickle(FLEETS_IN_BACKEND_FILEPATH)
-        users.topickle(USERS_IN_BACKEND_FILEPATH)
+        cache = ExtractCache()
+        cache.write(DRIVERS_IN_BACKEND, drivers.todataframe(), source='cloudsql')
+        cache.write(FLEETS_IN_BACKEND, fleets.todataframe(), source='tableau')
+        cache.write(USERS_IN_BACKEND, users.todataframe(), source='valkfleet')
 
     else:
-        drivers = frompickle(DRIVERS_IN_BACKEND_FILEPATH)
-        fleets = frompickle(FLEETS_IN_BACKEND_FILEPATH)
-        users = frompickle(USERS_IN_BACKEND_FILEPATH)
+        cache = ExtractCache()
+        drivers = fromdataframe(cache.read(DRIVERS_IN_BACKEND))
+        fleets = fromdataframe(cache.read(FLEETS_IN_BACKEND))
+        users = fromdataframe(cache.read(USERS_IN_BACKEND))
 
     write_to_log(drivers, 'drivers', 'backend')
     write_to_log(fleets, 'fleets', 'backend')
@@ -92,4 +92,14 @@ WHERE event.delivery_uuid = delivery.delivery_uuid;
 
 
 GRANT SELECT ON tableau.audit_logs TO valkfleet_ro;
-GRANT SELECT ON tableau.delivery_dwh TO valkfleet_ro
\ No newline at end of file
+GRANT SELECT ON tableau.delivery_dwh TO valkfleet_ro;
+
+
+SELECT uuid
+FROM tableau.audit_logs
+WHERE "timestamp" >= %(since)s
+AND uuid = ANY(%(uuids)s);
+
+SELECT uuid, "timestamp"
+FROM tableau.audit_logs
+WHERE "timestamp" >= %(since)s;
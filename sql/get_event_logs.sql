@@ -21,4 +21,14 @@ FROM {schema_}.{table_}
 ORDER BY {time_field}
 DESC LIMIT 1;
 
-GRANT SELECT ON {schema_}.{table_} TO valkfleet_ro;
\ No newline at end of file
+GRANT SELECT ON {schema_}.{table_} TO valkfleet_ro;
+
+SELECT uuid
+FROM {schema_}.{table_}
+WHERE {time_field} >= %(since)s
+AND uuid = ANY(%(uuids)s);
+
+
+SELECT uuid, {time_field}
+FROM {schema_}.{table_}
+WHERE {time_field} >= %(since)s;
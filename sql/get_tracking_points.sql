@@ -1,4 +1,4 @@
-CREATE TABLE tableau.tracking_points (
+CREATE TABLE IF NOT EXISTS tableau.tracking_points (
   accuracy DOUBLE PRECISION,
   altitude DOUBLE PRECISION,
   battery DOUBLE PRECISION,
@@ -23,3 +23,58 @@ CREATE TABLE tableau.tracking_points (
 );
 
 SELECT datetime from tableau.tracking_points ORDER BY datetime DESC LIMIT 1;
+
+
+CREATE TABLE IF NOT EXISTS tableau.tracking_points_shard (
+  shard_start TIMESTAMP NOT NULL,
+  shard_stop TIMESTAMP NOT NULL,
+  cursor TEXT,
+  points BIGINT NOT NULL DEFAULT 0,
+  raw_points BIGINT NOT NULL DEFAULT 0,
+  max_error DOUBLE PRECISION,
+  raw_length DOUBLE PRECISION NOT NULL DEFAULT 0,
+  length DOUBLE PRECISION NOT NULL DEFAULT 0,
+  done BOOLEAN NOT NULL DEFAULT FALSE,
+  updated_at TIMESTAMP NOT NULL DEFAULT now(),
+  PRIMARY KEY (shard_start, shard_stop)
+);
+
+
+SELECT shard_start, shard_stop, cursor, points, done
+FROM tableau.tracking_points_shard
+WHERE shard_start < %(stop)s
+AND shard_stop > %(start)s;
+
+
+INSERT INTO tableau.tracking_points_shard (shard_start, shard_stop)
+SELECT %(shard_start)s, %(shard_stop)s
+WHERE NOT EXISTS (
+  SELECT 1
+  FROM tableau.tracking_points_shard
+  WHERE shard_start = %(shard_start)s
+  AND shard_stop = %(shard_stop)s
+);
+
+
+UPDATE tableau.tracking_points_shard
+SET cursor = %(cursor)s,
+    points = points + %(points)s,
+    raw_points = raw_points + %(raw_points)s,
+    max_error = GREATEST(max_error, %(max_error)s),
+    raw_length = raw_length + %(raw_length)s,
+    length = length + %(length)s,
+    done = %(done)s,
+    updated_at = now()
+WHERE shard_start = %(shard_start)s
+AND shard_stop = %(shard_stop)s;
+
+
+SELECT uuid
+FROM tableau.tracking_points
+WHERE datetime >= %(since)s
+AND uuid = ANY(%(uuids)s);
+
+
+SELECT uuid, datetime
+FROM tableau.tracking_points
+WHERE datetime >= %(since)s;
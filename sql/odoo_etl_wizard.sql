@@ -0,0 +1,35 @@
+CREATE TABLE IF NOT EXISTS {schema_}.odoo_etl_watermark (
+  table_name TEXT PRIMARY KEY,
+  write_date TIMESTAMP,
+  swept_at TIMESTAMP,
+  updated_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+
+SELECT write_date, swept_at
+FROM {schema_}.odoo_etl_watermark
+WHERE table_name = %(table_name)s;
+
+
+UPDATE {schema_}.odoo_etl_watermark
+SET write_date = COALESCE(%(write_date)s, write_date),
+    swept_at = COALESCE(%(swept_at)s, swept_at),
+    updated_at = now()
+WHERE table_name = %(table_name)s;
+
+
+INSERT INTO {schema_}.odoo_etl_watermark (table_name, write_date, swept_at)
+SELECT %(table_name)s, %(write_date)s, %(swept_at)s
+WHERE NOT EXISTS (
+  SELECT 1
+  FROM {schema_}.odoo_etl_watermark
+  WHERE table_name = %(table_name)s
+);
+
+
+SELECT id
+FROM {schema_}.{table_};
+
+
+DELETE FROM {schema_}.{table_}
+WHERE id = ANY(%(ids)s);
@@ -0,0 +1,74 @@
+CREATE TABLE IF NOT EXISTS tableau.route_trajectory (
+  route TEXT NOT NULL,
+  driver CHAR(36) NOT NULL,
+  start TIMESTAMP,
+  stop TIMESTAMP,
+  points BIGINT,
+  duration DOUBLE PRECISION,
+  distance DOUBLE PRECISION,
+  moving_time DOUBLE PRECISION,
+  idle_time DOUBLE PRECISION,
+  gap_time DOUBLE PRECISION,
+  stops BIGINT,
+  speed_p50 DOUBLE PRECISION,
+  speed_p90 DOUBLE PRECISION,
+  speed_max DOUBLE PRECISION,
+  computed_at TIMESTAMP,
+  PRIMARY KEY (route, driver)
+);
+
+
+CREATE TABLE IF NOT EXISTS tableau.shift_trajectory (
+  shift TEXT NOT NULL,
+  driver CHAR(36) NOT NULL,
+  start TIMESTAMP,
+  stop TIMESTAMP,
+  points BIGINT,
+  duration DOUBLE PRECISION,
+  distance DOUBLE PRECISION,
+  moving_time DOUBLE PRECISION,
+  idle_time DOUBLE PRECISION,
+  gap_time DOUBLE PRECISION,
+  stops BIGINT,
+  speed_p50 DOUBLE PRECISION,
+  speed_p90 DOUBLE PRECISION,
+  speed_max DOUBLE PRECISION,
+  computed_at TIMESTAMP,
+  PRIMARY KEY (shift, driver)
+);
+
+
+CREATE TABLE IF NOT EXISTS tableau.driver_day_trajectory (
+  driver CHAR(36) NOT NULL,
+  day DATE NOT NULL,
+  start TIMESTAMP,
+  stop TIMESTAMP,
+  points BIGINT,
+  duration DOUBLE PRECISION,
+  distance DOUBLE PRECISION,
+  moving_time DOUBLE PRECISION,
+  idle_time DOUBLE PRECISION,
+  gap_time DOUBLE PRECISION,
+  stops BIGINT,
+  speed_p50 DOUBLE PRECISION,
+  speed_p90 DOUBLE PRECISION,
+  speed_max DOUBLE PRECISION,
+  computed_at TIMESTAMP,
+  PRIMARY KEY (driver, day)
+);
+
+
+SELECT driver, route, shift, datetime, lat, lng
+FROM tableau.tracking_points
+WHERE datetime >= %(start)s
+AND datetime < %(stop)s
+AND driver IS NOT NULL
+AND deleted_at IS NULL
+ORDER BY driver;
+
+
+SELECT count(*)
+FROM tableau.tracking_points_shard
+WHERE shard_start < %(stop)s
+AND shard_stop > %(start)s
+AND points < raw_points;
@@ -0,0 +1,32 @@
+""" Shared fixtures. """
+
+
+from importlib import import_module
+
+import pytest
+
+import common.logger
+
+
+def importer(monkeypatch, package):
+    """ Return a function that imports a module of the package without
+    configuring the loggers from the YAML file, which the tests don't have.
+    """
+    monkeypatch.setattr(common.logger, 'configure_logger', lambda: None)
+
+    def import_from_package(name):
+        return import_module(package + '.' + name)
+
+    return import_from_package
+
+
+@pytest.fixture
+def cronjob(monkeypatch):
+    """ Import a cronjob module. """
+    return importer(monkeypatch, 'cronjobs')
+
+
+@pytest.fixture
+def script(monkeypatch):
+    """ Import a script module. """
+    return importer(monkeypatch, 'scripts')
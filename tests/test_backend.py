@@ -0,0 +1,213 @@
+""" Test the pooled opener and the streaming downloads of the backend
+connector.
+"""
+
+
+import gzip
+
+from io import BytesIO
+from urllib.error import HTTPError
+from urllib.request import Request
+
+import pytest
+
+from requests import Response as RequestsResponse, exceptions
+from urllib3.response import HTTPResponse
+
+from connectors import backend
+from connectors.backend import (BackendConnector, PooledOpener,
+                                PooledResponse, ScriptError)
+
+
+URL = 'https://api.valkfleet.com/reporting/deliveries.csv'
+
+
+class Response(object):
+    """ A urllib response with a body. """
+
+    def __init__(self, body):
+        self.body = BytesIO(body)
+
+    def read(self, amt=None):
+        return self.body.read(amt)
+
+    def geturl(self):
+        return URL
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class Opener(object):
+
+    def __init__(self, body):
+        self.body = body
+
+    def open(self, request, data=None, timeout=None):
+        return Response(self.body)
+
+
+def connector(body, **kwargs):
+    backend_conn = BackendConnector(**kwargs)
+    backend_conn.opener = Opener(body)
+    return backend_conn
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Every character and line break ends up on a chunk boundary
+    monkeypatch.setattr(backend, 'CHUNK_SIZE', 1)
+
+
+def test_iter_lines(small_chunks):
+    body = 'Käse,€\nStraße\n\nend'.encode('utf-8')
+
+    lines = list(connector(body).iter_lines(Response(body)))
+
+    assert lines == ['Käse,€\n', 'Straße\n', '\n', 'end']
+
+
+def test_iter_chunks_max_bytes():
+    backend_conn = connector(b'', max_bytes=10)
+
+    assert backend_conn.read(Response(b'0123456789')) == b'0123456789'
+    with pytest.raises(ScriptError):
+        backend_conn.read(Response(b'0123456789!'))
+    assert backend_conn.read(Response(b'0123456789!'), max_bytes=20) == \
+        b'0123456789!'
+
+
+def test_iter_csv(small_chunks):
+    body = ('uuid,address\r\n'
+            'a,"Kastanienallee 1\nHinterhof"\r\n'
+            '\r\n'
+            'b,Müllerstraße 2\r\n'
+            'c,"Say ""hi"""\r\n').encode('utf-8')
+
+    batches = list(connector(body).iter_csv(URL, ('uuid', 'address'),
+                                            batch_size=2))
+
+    assert batches == [[['a', 'Kastanienallee 1\nHinterhof'],
+                        ['b', 'Müllerstraße 2']],
+                       [['c', 'Say "hi"']]]
+
+
+def test_iter_csv_checks_fields():
+    with pytest.raises(ScriptError):
+        list(connector(b'uuid,name\r\na,b\r\n').iter_csv(URL, ('uuid',)))
+    with pytest.raises(ScriptError):
+        list(connector(b'uuid,name\r\na\r\n').iter_csv(URL))
+    assert list(connector(b'').iter_csv(URL)) == []
+
+
+class Session(object):
+    """ A requests session that fails. """
+
+    def __init__(self, error):
+        self.error = error
+
+    def request(self, method, url, **kwargs):
+        raise self.error
+
+
+class Chunks(object):
+    """ A requests response whose download breaks off. """
+
+    url = URL
+
+    def iter_content(self, chunk_size):
+        yield b'uuid\r\n'
+        raise exceptions.ConnectionError('Connection broken')
+
+
+def test_timeouts_are_http_errors():
+    opener = PooledOpener()
+    opener.session = Session(exceptions.ReadTimeout('Read timed out'))
+
+    with pytest.raises(HTTPError) as err:
+        opener.open(URL)
+    assert err.value.code == backend.TIMEOUT_STATUS
+
+    response = PooledResponse(Chunks())
+    with pytest.raises(HTTPError) as err:
+        response.read()
+    assert err.value.code == backend.CONNECTION_ERROR_STATUS
+
+
+class RecordingSession(object):
+    """ A requests session that answers every request with a status. """
+
+    def __init__(self, status_code=200, body=b'', headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.requests = []
+        self.responses = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        response = requests_response(self.status_code, self.body,
+                                     self.headers)
+        self.responses.append(response)
+        return response
+
+
+def requests_response(status_code, body, headers):
+    response = RequestsResponse()
+    response.status_code = status_code
+    response.reason = 'Not Found' if status_code == 404 else 'OK'
+    response.url = URL
+    response.headers.update(headers)
+    response.raw = HTTPResponse(body=BytesIO(body), headers=headers,
+                                status=status_code, preload_content=False)
+    return response
+
+
+def test_pooled_opener_session():
+    opener = PooledOpener(pool_size=4, timeout=7)
+    adapter = opener.session.get_adapter(URL)
+
+    assert 'gzip' in opener.session.headers['Accept-Encoding']
+    assert adapter is opener.session.get_adapter('http://localhost/')
+    assert (adapter._pool_connections, adapter._pool_maxsize) == (4, 4)
+
+    opener.session = RecordingSession()
+    request = Request(URL)
+    request.add_header('Authorization', 'token')
+    opener.open(request)
+    opener.open(URL, b'{}', timeout=60)
+
+    (method, url, get), (post, _, posted) = opener.session.requests
+    assert (method, url, post) == ('GET', URL, 'POST')
+    assert get['headers'] == {'Authorization': 'token'}
+    assert (get['timeout'], get['stream'], get['data']) == (7, True, None)
+    assert (posted['timeout'], posted['data']) == (60, b'{}')
+
+
+def test_pooled_response_gzip():
+    body = b'uuid,address\r\n' * 1000
+    opener = PooledOpener()
+    opener.session = RecordingSession(body=gzip.compress(body),
+                                      headers={'Content-Encoding': 'gzip'})
+
+    with opener.open(URL) as response:
+        assert response.getcode() == 200
+        assert response.geturl() == URL
+        assert response.read(10) == body[:10]
+        assert response.read() == body[10:]
+        assert response.read(10) == b''
+
+
+def test_http_errors():
+    opener = PooledOpener()
+    opener.session = RecordingSession(status_code=404)
+
+    with pytest.raises(HTTPError) as err:
+        opener.open(URL)
+
+    assert (err.value.code, err.value.reason) == (404, 'Not Found')
+    assert err.value.geturl() == URL
+    assert opener.session.responses[0].raw.closed
@@ -0,0 +1,115 @@
+""" Test the Bloom filters of loaded keys. """
+
+
+from datetime import date, datetime, timedelta
+from os.path import join
+from uuid import uuid4
+
+from pandas import DataFrame
+
+from common import bloom
+from common.bloom import BloomFilter, SeenKeys
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    keys = [str(uuid4()) for _ in range(1000)]
+    others = [str(uuid4()) for _ in range(10000)]
+    bloom.add(keys)
+
+    assert bloom.contains(keys).all()
+    assert keys[0] in bloom
+    assert bloom.contains(others).mean() < 0.03
+
+
+def test_save_and_load(tmpdir):
+    filepath = join(str(tmpdir), 'bloom.npz')
+    bloom = BloomFilter(capacity=100)
+    bloom.add(['a', 'b'])
+    bloom.save(filepath)
+
+    loaded = BloomFilter.load(filepath)
+    assert len(loaded) == 2
+    assert list(loaded.contains(['a', 'b'])) == [True, True]
+    assert (loaded.bits == bloom.bits).all()
+
+
+def test_drop_seen(tmpdir):
+    seen = SeenKeys('events', directory=str(tmpdir), capacity=100)
+    day1 = datetime(2016, 1, 1, 23, 59)
+    day2 = datetime(2016, 1, 2, 0, 1)
+    first = DataFrame({'uuid': ['a', 'b', 'b'], 'created_at': [day1] * 3})
+
+    assert list(seen.drop_seen(first, 'uuid', 'created_at')['uuid']) == \
+        ['a', 'b']
+    assert seen.days() == []
+    seen.save()
+    assert seen.days() == [day1.date()]
+    assert seen.missing_days(day1, day2) == [day2.date()]
+
+    # Resumed with an overlap, from another process
+    seen = SeenKeys('events', directory=str(tmpdir), capacity=100)
+    second = DataFrame({'uuid': ['b', 'c', 'd'],
+                        'created_at': [day1, day1, day2]})
+    new = seen.drop_seen(second, 'uuid', 'created_at')
+    assert list(new['uuid']) == ['c', 'd']
+
+    # Claimed keys are kept unless the database confirms them
+    again = seen.drop_seen(second, 'uuid', 'created_at',
+                           confirm=lambda keys: ['c'])
+    assert list(again['uuid']) == ['b', 'd']
+
+
+def test_days_behind_are_released(tmpdir, monkeypatch):
+    seen = SeenKeys('points', directory=str(tmpdir), capacity=100)
+    saved = []
+    monkeypatch.setattr(BloomFilter, 'save',
+                        lambda bloom, filepath: saved.append(filepath))
+
+    for hour in (8, 12, 23):
+        page = DataFrame({'uuid': ['a%s' % hour, 'b%s' % hour],
+                          'datetime': [datetime(2016, 1, 1, hour)] * 2})
+        seen.drop_seen(page, 'uuid', 'datetime')
+    assert saved == []
+
+    # The next day's page saves and frees the first day, once
+    page = DataFrame({'uuid': ['c', 'd'],
+                      'datetime': [datetime(2016, 1, 1, 23, 59),
+                                   datetime(2016, 1, 2, 0, 1)]})
+    seen.drop_seen(page, 'uuid', 'datetime')
+    assert saved == []
+    page = DataFrame({'uuid': ['e'], 'datetime': [datetime(2016, 1, 2, 1)]})
+    seen.drop_seen(page, 'uuid', 'datetime')
+    assert saved == [seen.path(date(2016, 1, 1))]
+    assert list(seen.filters) == [date(2016, 1, 2)]
+
+    seen.save()
+    assert saved[1:] == [seen.path(date(2016, 1, 2))]
+
+
+def test_save_interval(tmpdir, monkeypatch):
+    seen = SeenKeys('points', directory=str(tmpdir), capacity=100)
+    clock = [seen.saved_at]
+    monkeypatch.setattr(bloom, 'time', lambda: clock[0])
+    page = DataFrame({'uuid': ['a'], 'datetime': [datetime(2016, 1, 1)]})
+
+    seen.drop_seen(page, 'uuid', 'datetime')
+    assert seen.days() == []
+
+    clock[0] += bloom.SAVE_INTERVAL
+    seen.drop_seen(page.assign(uuid=['b']), 'uuid', 'datetime')
+    assert seen.days() == [date(2016, 1, 1)]
+    assert not seen.changed
+
+
+def test_evict(tmpdir):
+    seen = SeenKeys('points', directory=str(tmpdir), capacity=100)
+    today = datetime.combine(date.today(), datetime.min.time())
+    old = today - bloom.MAX_AGE - timedelta(days=1)
+    page = DataFrame({'uuid': ['a', 'b'], 'datetime': [old, today]})
+    seen.drop_seen(page, 'uuid', 'datetime')
+    seen.save()
+
+    assert seen.evict() == [old.date()]
+    assert seen.days() == [today.date()]
+    assert old.date() not in seen.filters
@@ -0,0 +1,182 @@
+""" Test the loading of the backend deliveries. """
+
+
+import csv
+
+from datetime import date, datetime, timedelta
+from io import StringIO
+
+import psycopg2
+import pytest
+
+from pandas import DataFrame, Series, isnull
+
+
+def test_parse_integers(cronjob):
+    deliveries = cronjob('get_deliveries_from_backend')
+    column = Series(['3', '', '12', None, '0'])
+
+    integers = deliveries.parse_integers(column)
+
+    assert list(integers) == [3, None, 12, None, 0]
+    with StringIO() as f:
+        integers.to_csv(f, header=False, index=False,
+                        na_rep=deliveries.COPY_NULL)
+        assert f.getvalue() == '3\n\\N\n12\n\\N\n0\n'
+
+
+def test_parse_deliveries_keeps_local_time(cronjob):
+    deliveries = cronjob('get_deliveries_from_backend')
+    row = dict.fromkeys(deliveries.EXPECTED_FIELDS, '')
+    row.update(delivery_uuid='a',
+               created_at_timestamp='2016-03-01T07:30:00+02:00',
+               accepted_timestamp='2016-03-01T07:31:15.500+02:00')
+
+    batch = deliveries.parse_deliveries([row])
+
+    # The wall time of the fleet, which its hour and day are read from
+    delivery = batch.iloc[0]
+    assert delivery['created_at_timestamp'] == datetime(2016, 3, 1, 7, 30)
+    assert delivery['accepted_timestamp'] == \
+        datetime(2016, 3, 1, 7, 31, 15, 500000)
+    assert delivery['created_at_hour'] == 7
+    assert delivery['gastronomic_day'] == datetime(2016, 2, 29)
+    assert isnull(delivery['start_route_timestamp'])
+
+    with StringIO() as f:
+        batch.to_csv(f, columns=['created_at_timestamp'], header=False,
+                     index=False, na_rep=deliveries.COPY_NULL)
+        assert f.getvalue() == '2016-03-01 07:30:00\n'
+
+
+class Cursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+
+    def execute(self, statement, parameters=None):
+        self.connection.statements.append(statement)
+        if statement == self.connection.fail_on:
+            raise psycopg2.Error(statement)
+
+    def copy_expert(self, statement, f):
+        self.connection.statements.append(statement)
+        self.connection.copied.append(f.read())
+
+    def close(self):
+        pass
+
+
+class Connection(object):
+
+    def __init__(self, fail_on=None):
+        self.statements = []
+        self.copied = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.fail_on = fail_on
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def delivery_batch(deliveries, **columns):
+    batch = DataFrame(columns=deliveries.STAGING_FIELDS)
+    for field, values in columns.items():
+        batch[field] = values
+    return batch
+
+
+def test_merge_in_db(cronjob):
+    deliveries = cronjob('get_deliveries_from_backend')
+    batch = delivery_batch(deliveries,
+                           delivery_uuid=['a', 'b', 'a'],
+                           fleet=['berlin', 'berlin', 'berlin'],
+                           delivery_fee=deliveries.parse_integers(
+                               Series(['100', '', '300'])),
+                           customer_city=['Berlin', '', 'Potsdam'])
+    connection = Connection()
+
+    deliveries.merge_in_db(connection, batch)
+
+    merges = [statement for merge in deliveries.MERGE_SQL
+              for statement in merge[1:]]
+    assert connection.statements == [deliveries.CREATE_STAGING_SQL,
+                                     deliveries.COPY_STAGING_SQL,
+                                     deliveries.RECORD_CHANGES_SQL] + \
+        merges + [deliveries.CLEANUP_SQL_DWH]
+    assert connection.commits == 1
+
+    # The last version of a delivery wins and nulls are written as \N,
+    # while empty strings stay empty
+    fields = [deliveries.STAGING_FIELDS.index(field) for field
+              in ('delivery_uuid', 'delivery_fee', 'customer_city')]
+    rows = csv.reader(StringIO(connection.copied[0]))
+    assert [[row[i] for i in fields] for row in rows] == [
+        ['b', deliveries.COPY_NULL, ''], ['a', '300', 'Potsdam']]
+
+
+def test_merge_in_db_rolls_back(cronjob):
+    deliveries = cronjob('get_deliveries_from_backend')
+    batch = delivery_batch(deliveries, delivery_uuid=['a'], fleet=['berlin'])
+    connection = Connection(fail_on=deliveries.RECORD_CHANGES_SQL)
+
+    with pytest.raises(psycopg2.Error):
+        deliveries.merge_in_db(connection, batch)
+
+    assert (connection.commits, connection.rollbacks) == (0, 1)
+
+
+def test_report_windows(cronjob):
+    deliveries = cronjob('get_deliveries_from_backend')
+    day = date(2016, 3, 1)
+
+    windows = list(deliveries.report_windows(day, day + timedelta(days=1),
+                                             5))
+
+    # Gastronomic days run from 8:00 to 8:00, the last window is cut short
+    assert len(windows) == 10
+    assert windows[0] == (datetime(2016, 3, 1, 8), datetime(2016, 3, 1, 13))
+    assert windows[4] == (datetime(2016, 3, 2, 4), datetime(2016, 3, 2, 8))
+    assert windows[-1] == (datetime(2016, 3, 3, 4), datetime(2016, 3, 3, 8))
+    assert all(stop == start for (_, stop), (start, _)
+               in zip(windows, windows[1:]))
+
+
+def test_download_data(cronjob, monkeypatch):
+    deliveries = cronjob('get_deliveries_from_backend')
+    skipped = next(iter(deliveries.FLEETS_TO_SKIP))
+    fleets = {'berlin-uuid': {'name': 'berlin'},
+              'munich-uuid': {'name': 'munich'},
+              skipped: {'name': 'skipped'}}
+    monkeypatch.setattr(deliveries.fleets, 'download_data',
+                        lambda backend_conn: fleets)
+
+    def fetch_report(backend_conn, fleet_uuid, fleet_name, start_datetime,
+                     end_datetime):
+        return delivery_batch(deliveries,
+                              delivery_uuid=[fleet_uuid + str(start_datetime)],
+                              fleet=[fleet_name])
+
+    loaded = []
+    monkeypatch.setattr(deliveries, 'fetch_report', fetch_report)
+    monkeypatch.setattr(deliveries, 'merge_in_db',
+                        lambda conn, batch: loaded.append(batch))
+
+    day = date(2016, 3, 1)
+    deliveries.download_data(None, None, day, day, workers=3, window=4)
+
+    # One batch per window, in order, with the reports of every fleet
+    assert len(loaded) == 6
+    assert [sorted(batch['fleet']) for batch in loaded] == \
+        [['berlin', 'munich']] * 6
+    assert [batch['delivery_uuid'].max() for batch in loaded] == [
+        'munich-uuid' + str(start) for start, _
+        in deliveries.report_windows(day, day, 4)]
@@ -0,0 +1,196 @@
+""" Test the incremental aggregates of the deliveries. """
+
+
+import argparse
+
+from datetime import date
+
+import pytest
+
+from common import delivery_changes
+
+
+class Cursor(object):
+    """ A psycopg2 cursor that records its statements and answers fetchone
+    with the results it is given, in order.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+
+    def execute(self, statement, parameters=None):
+        self.connection.statements.append((statement, parameters))
+
+    def fetchone(self):
+        return self.connection.results.pop(0)
+
+    def close(self):
+        pass
+
+
+class Connection(object):
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.statements = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+    def executed(self, statement):
+        return [parameters for sql, parameters in self.statements
+                if sql == statement]
+
+
+def test_create_change_tables():
+    connection = Connection()
+
+    delivery_changes.create_change_tables(connection)
+
+    assert connection.executed(delivery_changes.REGISTER_CONSUMER_SQL) == [
+        {'name': name} for name in delivery_changes.CONSUMERS]
+    assert connection.commits == 1
+
+
+def test_prune_waits_for_every_consumer():
+    connection = Connection()
+
+    delivery_changes.advance_watermark(connection.cursor(),
+                                       'hourly_deliveries', 42)
+
+    assert connection.executed(delivery_changes.UPDATE_WATERMARK_SQL) == [
+        {'name': 'hourly_deliveries', 'change_id': 42}]
+    assert connection.executed(delivery_changes.PRUNE_CHANGES_SQL) == [
+        {'consumers': list(delivery_changes.CONSUMERS)}]
+
+    # The lowest watermark of the consumers passed, where a missing one is 0
+    prune = delivery_changes.PRUNE_CHANGES_SQL
+    assert 'min(coalesce(watermark.last_change_id, 0))' in prune
+    assert 'unnest(%(consumers)s::text[])' in prune
+    assert 'LEFT OUTER JOIN tableau.materialization_watermark' in prune
+
+
+def test_watermarks_name_consumers(cronjob):
+    hourly = cronjob('populate_hourly_deliveries')
+    weekly = cronjob('populate_restaurant_weekly_delivery')
+
+    assert set(delivery_changes.CONSUMERS) == {hourly.WATERMARK_NAME,
+                                               weekly.WATERMARK_NAME}
+
+
+def test_month_chunks(cronjob):
+    hourly = cronjob('populate_hourly_deliveries')
+
+    assert list(hourly.month_chunks(date(2016, 1, 15), date(2016, 3, 3))) == [
+        (date(2016, 1, 15), date(2016, 1, 31)),
+        (date(2016, 2, 1), date(2016, 2, 29)),
+        (date(2016, 3, 1), date(2016, 3, 3))]
+    assert list(hourly.month_chunks(date(2016, 12, 31), date(2017, 1, 1))) == [
+        (date(2016, 12, 31), date(2016, 12, 31)),
+        (date(2017, 1, 1), date(2017, 1, 1))]
+    assert list(hourly.month_chunks(date(2016, 2, 2), date(2016, 2, 1))) == []
+
+
+def test_hourly_incremental(cronjob, monkeypatch):
+    hourly = cronjob('populate_hourly_deliveries')
+    connection = Connection((10, 25))
+    monkeypatch.setattr(hourly, 'connect', lambda *args: connection)
+
+    hourly.update_db_incrementally('user', 'password')
+
+    statements = [sql for sql, _ in connection.statements]
+    lock = statements.index(delivery_changes.LOCK_CHANGES_SQL)
+    changed = statements.index(hourly.CHANGED_DAYS_SQL)
+
+    # The affected days are taken under the lock, from the changes past the
+    # watermark, and against the date ranges before they are merged
+    assert lock < statements.index(delivery_changes.GET_WATERMARK_SQL)
+    assert connection.executed(hourly.CHANGED_DAYS_SQL) == [(10, 25)]
+    assert changed < statements.index(hourly.MERGE_DATE_RANGES_SQL)
+    # Plus the empty days by which the date range of a fleet grows
+    assert 'generate_series(ranges.last_day + 1, new_ranges.last_day' in \
+        hourly.CHANGED_DAYS_SQL
+    assert 'generate_series(new_ranges.first_day, ranges.first_day - 1' in \
+        hourly.CHANGED_DAYS_SQL
+    assert statements[changed + 1:changed + 4] == [
+        hourly.MERGE_DATE_RANGES_SQL, hourly.DELETE_AFFECTED_SQL,
+        hourly.INSERT_AFFECTED_SQL]
+
+    assert connection.executed(delivery_changes.UPDATE_WATERMARK_SQL) == [
+        {'name': hourly.WATERMARK_NAME, 'change_id': 25}]
+    assert statements[-1] == delivery_changes.PRUNE_CHANGES_SQL
+    assert connection.rollbacks == 0
+
+
+def test_hourly_incremental_without_changes(cronjob, monkeypatch):
+    hourly = cronjob('populate_hourly_deliveries')
+    connection = Connection((25, 25))
+    monkeypatch.setattr(hourly, 'connect', lambda *args: connection)
+
+    hourly.update_db_incrementally('user', 'password')
+
+    assert connection.executed(hourly.CHANGED_DAYS_SQL) == []
+    assert connection.executed(delivery_changes.UPDATE_WATERMARK_SQL) == []
+    assert connection.rollbacks == 1
+
+
+def test_week_keys(cronjob):
+    weekly = cronjob('populate_restaurant_weekly_delivery')
+
+    # ISO years: New Year's days belong to the week of their Monday
+    assert weekly.week_key(date(2015, 12, 28)) == 201553
+    assert weekly.week_key(date(2016, 1, 4)) == 201601
+    assert weekly.week_key(date(2014, 12, 29)) == 201501
+    assert weekly.week_start(date(2016, 1, 3)) == date(2015, 12, 28)
+    assert weekly.week_start(date(2016, 1, 4)) == date(2016, 1, 4)
+
+    assert weekly.parse_week('2015-W53') == date(2015, 12, 28)
+    assert weekly.parse_week('2015-W01') == date(2014, 12, 29)
+    for invalid in ('2016-W53', '2016-W00', '2016-12'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            weekly.parse_week(invalid)
+
+
+def test_weekly_range(cronjob, monkeypatch):
+    weekly = cronjob('populate_restaurant_weekly_delivery')
+    connection = Connection()
+    monkeypatch.setattr(weekly, 'connect', lambda *args: connection)
+
+    weekly.update_db('user', 'password', date(2015, 12, 21),
+                     date(2016, 1, 4))
+
+    # Keys compare in order across New Year, the days run to the Sunday
+    assert connection.executed(weekly.DELETE_SQL) == [(201552, 201601)]
+    assert connection.executed(weekly.INSERT_SQL) == [
+        (date(2015, 12, 21), date(2016, 1, 11))]
+    for statement in (weekly.INSERT_SQL, weekly.INSERT_CHANGED_SQL):
+        assert "date_part('isoyear', gastronomic_day) as year" in statement
+    assert "year = date_part('isoyear', week_start)" in \
+        weekly.DELETE_CHANGED_SQL
+
+
+def test_weekly_rekey(cronjob, monkeypatch):
+    weekly = cronjob('populate_restaurant_weekly_delivery')
+    connection = Connection((date(2015, 10, 1), date(2016, 1, 2)))
+    monkeypatch.setattr(weekly, 'connect', lambda *args: connection)
+
+    weekly.rekey_db('user', 'password')
+
+    statements = [sql for sql, _ in connection.statements]
+    assert statements == [weekly.DELIVERY_DAYS_SQL, weekly.DELETE_ALL_SQL,
+                          weekly.INSERT_SQL]
+    assert connection.executed(weekly.INSERT_SQL) == [
+        (date(2015, 9, 28), date(2016, 1, 4))]
+    assert connection.commits == 1
@@ -0,0 +1,67 @@
+""" Test the event audit logs ETL. """
+
+
+import json
+
+from datetime import date, datetime, timedelta
+from os.path import join
+
+from common.bloom import MAX_AGE, SeenKeys
+from common.settings import ASSETS_DIR
+
+
+class Warehouse(object):
+    schema = 'tableau'
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def db(self):
+        return self
+
+    def execute(self, statement, *args):
+        self.statements.append(statement)
+
+
+def sample_records():
+    with open(join(ASSETS_DIR, 'event_audit_log.json')) as f:
+        return json.load(f)['items']
+
+
+def test_transform_sample(cronjob, tmpdir):
+    get_event_logs = cronjob('get_event_logs')
+    etl_timestamp = datetime(2016, 2, 1)
+
+    for time_field in ('timestamp', 'created_at'):
+        sink = get_event_logs.EventSink(Warehouse(), 'fleet-controllers',
+                                        'fleet_controller_events',
+                                        time_field)
+        sink.seen = SeenKeys(time_field, directory=str(tmpdir))
+
+        batch_df = sink.transform(sample_records(), etl_timestamp,
+                                  datetime(2016, 1, 1))
+        assert len(batch_df) == 1
+        assert batch_df[time_field].iloc[0].hour == 14
+        assert batch_df['delivery_uuid'].iloc[0] == \
+            'a80f53f1-401c-41d6-b9c5-594e110c03df'
+
+        # Resumed after the event (naive, as read from the warehouse)
+        later = sink.transform(sample_records(), etl_timestamp,
+                               datetime(2016, 1, 21, 15))
+        assert later.empty
+
+
+def test_setup_evicts_old_keys(cronjob, tmpdir):
+    get_event_logs = cronjob('get_event_logs')
+    sink = get_event_logs.EventSink(Warehouse(), 'drivers', 'driver_events')
+    sink.seen = SeenKeys('driver_events', directory=str(tmpdir))
+    old = datetime.combine(date.today() - MAX_AGE - timedelta(days=1),
+                           datetime.min.time())
+    sink.seen.add(['a', 'b'], [old, datetime.now()])
+    sink.seen.save()
+
+    sink.setup()
+
+    assert len(sink.dwh.statements) == 1
+    assert sink.seen.days() == [date.today()]
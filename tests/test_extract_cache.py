@@ -0,0 +1,68 @@
+""" Test the columnar extract cache. """
+
+
+import json
+
+from datetime import datetime, timedelta
+
+from numpy import memmap
+from pandas import DataFrame, to_datetime
+
+from common.extract_cache import DATETIME_FORMAT, ExtractCache
+
+
+def make_frame():
+    return DataFrame({'id': [1, 2, 3],
+                      'price': [1.5, None, 3.0],
+                      'name': ['a', 'b', 'c'],
+                      'fleet': [[1, 'x'], False, [2, 'y']],
+                      'write_date': to_datetime(['2016-01-01', None,
+                                                 '2016-01-03'])},
+                     columns=['id', 'price', 'name', 'fleet', 'write_date'])
+
+
+def test_round_trip(tmpdir):
+    cache = ExtractCache(str(tmpdir))
+    df = make_frame()
+    metadata = cache.write('res.partner', df, source='odoo',
+                           filters=[('active', '=', True)])
+
+    assert 'res.partner' in cache
+    assert metadata['rows'] == 3
+    assert cache.metadata('res.partner')['source'] == 'odoo'
+
+    cached = cache.read('res.partner')
+    assert list(cached.columns) == list(df.columns)
+    assert list(cached.dtypes) == list(df.dtypes)
+    assert cached['fleet'].tolist() == df['fleet'].tolist()
+    assert cached['name'].tolist() == ['a', 'b', 'c']
+    assert cached['write_date'].isnull().tolist() == [False, True, False]
+
+
+def test_reads_columns_from_memory_maps(tmpdir):
+    cache = ExtractCache(str(tmpdir))
+    cache.write('drivers', make_frame())
+
+    cached = cache.read('drivers', columns=['price', 'id'])
+    assert list(cached.columns) == ['price', 'id']
+
+    id_column = cache.metadata('drivers')['columns'][0]
+    values = cache._read_column('drivers', id_column, mmap=True).values
+    assert isinstance(values, memmap) or isinstance(values.base, memmap)
+
+
+def test_evict_by_age_and_size(tmpdir):
+    cache = ExtractCache(str(tmpdir))
+    for name in ('old', 'middle', 'new'):
+        cache.write(name, make_frame())
+
+    metadata_file = tmpdir.join('old', 'metadata.json')
+    metadata = json.loads(metadata_file.read())
+    two_months_ago = datetime.now() - timedelta(days=60)
+    metadata['extracted_at'] = two_months_ago.strftime(DATETIME_FORMAT)
+    metadata_file.write(json.dumps(metadata))
+
+    assert cache.evict(max_bytes=None) == ['old']
+    size = cache.metadata('new')['bytes']
+    assert cache.evict(max_bytes=size) == ['middle']
+    assert cache.names() == ['new']
@@ -0,0 +1,145 @@
+""" Test the fleet dimension and the re-enrichment of the fleet info. """
+
+
+from uuid import UUID
+
+import pytest
+
+from common.fleets import UNKNOWN_FLEET, Fleet, FleetDimension
+
+
+BERLIN = Fleet('7c0ab4b2-2cd2-4b6a-a6d4-9c1b8e7a1f51', 'berlin', 'Berlin',
+               'DE', 'Germany', 'Berlin')
+LEEDS = Fleet('0f7d2ef4-e397-4979-8051-0057becfac23', 'leeds', 'Leeds',
+              'GB', 'United Kingdom', None)
+
+
+class Cursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+
+    def execute(self, statement, parameters=None):
+        self.connection.statements.append((statement, parameters))
+
+    def fetchone(self):
+        return self.connection.rows[0]
+
+    def fetchall(self):
+        return self.connection.rows
+
+    def close(self):
+        pass
+
+
+class Connection(object):
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        pass
+
+
+def test_fleet_dimension():
+    fleets = FleetDimension([BERLIN, LEEDS])
+
+    assert fleets.get(uuid=BERLIN.uuid) == BERLIN
+    assert fleets.get(backend_name='leeds') == LEEDS
+    assert fleets.get(uuid=LEEDS.uuid, backend_name='berlin') == LEEDS
+    assert fleets.get(uuid='unknown') is UNKNOWN_FLEET
+    assert fleets.get(backend_name='unknown') is UNKNOWN_FLEET
+    assert fleets.get() is UNKNOWN_FLEET
+    assert UNKNOWN_FLEET.display_name is None
+
+
+def test_load_fleet_dimension():
+    # psycopg2 returns the uuid column as a UUID
+    row = (UUID(BERLIN.uuid),) + BERLIN[1:]
+    connection = Connection([row, LEEDS])
+
+    fleets = FleetDimension.load(connection)
+
+    assert fleets.get(uuid=BERLIN.uuid) == BERLIN
+    assert fleets.get(backend_name='leeds').city is None
+
+
+def test_reenrich_sql(cronjob):
+    reenrich = cronjob('reenrich_fleet_info')
+
+    statement = reenrich.reenrich_sql(
+        'tableau.backend_shift', 'fleet_uuid', 'uuid',
+        (('fleet_display_name', 'display_name'), ('fleet_city', 'city')))
+
+    assert 'UPDATE tableau.backend_shift AS target' in statement
+    assert 'fleet_display_name = fleet.display_name,\n' \
+        '    fleet_city = fleet.city' in statement
+    assert 'WHERE target.fleet_uuid = fleet.uuid' in statement
+    # Only the rows whose fleet info differs, NULLs included
+    assert 'AND (target.fleet_display_name IS DISTINCT FROM ' \
+        'fleet.display_name\n  OR target.fleet_city IS DISTINCT FROM ' \
+        'fleet.city);' in statement
+
+
+class Database(object):
+    """ Connects to a database whose tableau.fleet has a fingerprint and
+    the fingerprint of the last run.
+    """
+
+    def __init__(self, fingerprint, last_fingerprint):
+        self.fingerprints = (fingerprint, last_fingerprint)
+        self.connection = None
+
+    def connect(self, dsn):
+        self.connection = Connection([self.fingerprints])
+        return self.connection
+
+    def updated(self, reenrich):
+        """ Return the tables updated and the fingerprints saved. """
+        statements = self.connection.statements
+        tables = [table for table, *_ in reenrich.ENRICHED_TABLES]
+        return ([table for table in tables for sql, _ in statements
+                 if sql.startswith('\nUPDATE {} '.format(table))],
+                [parameters for sql, parameters in statements
+                 if sql == reenrich.UPDATE_FINGERPRINT_SQL])
+
+
+@pytest.fixture
+def reenrich(cronjob):
+    return cronjob('reenrich_fleet_info')
+
+
+def test_reenrich_unchanged(reenrich, monkeypatch):
+    database = Database('new', 'new')
+    monkeypatch.setattr(reenrich.psycopg2, 'connect', database.connect)
+
+    reenrich.update_db('user', 'password')
+    assert database.updated(reenrich) == ([], [])
+
+    reenrich.update_db('user', 'password', force=True)
+    tables, _ = database.updated(reenrich)
+    assert tables == [table for table, *_ in reenrich.ENRICHED_TABLES]
+
+
+def test_reenrich_changed(reenrich, monkeypatch):
+    database = Database('new', None)
+    monkeypatch.setattr(reenrich.psycopg2, 'connect', database.connect)
+
+    reenrich.update_db('user', 'password')
+    tables, fingerprints = database.updated(reenrich)
+    assert tables == [table for table, *_ in reenrich.ENRICHED_TABLES]
+    assert fingerprints == [{'name': reenrich.FINGERPRINT_NAME,
+                             'fingerprint': 'new'}]
+
+    # A partial run keeps the old fingerprint
+    reenrich.update_db('user', 'password', tables=['tableau.backend_shift'])
+    assert database.updated(reenrich) == (['tableau.backend_shift'], [])
@@ -0,0 +1,74 @@
+""" Test the trajectory geometry. """
+
+
+from numpy import array, flatnonzero
+from pandas import DataFrame
+
+from common.geo import (collapse_stationary, douglas_peucker, haversine,
+                        simplify, simplify_trajectories)
+
+
+def test_haversine():
+    # One degree of latitude is about 111.2 km
+    assert round(haversine(52, 13, 53, 13) / 1000, 1) == 111.2
+    assert haversine(52, 13, 52, 13) == 0
+
+
+def test_douglas_peucker():
+    x = array([0.0, 1.0, 2.0, 3.0, 4.0])
+    y = array([0.0, 0.1, -0.1, 5.0, 6.0])
+
+    assert list(douglas_peucker(x, y, 0.5)) == [True, False, True, True,
+                                                True]
+    assert list(douglas_peucker(x, y, 10)) == [True, False, False, False,
+                                               True]
+
+
+def test_collapse_stationary():
+    x = array([0.0, 1.0, 2.0, 1.0, 50.0, 100.0])
+    y = array([0.0, 1.0, 0.0, 2.0, 0.0, 0.0])
+
+    # Parked from the 1st to the 4th point
+    assert list(collapse_stationary(x, y, 5)) == [True, False, False, True,
+                                                  True, True]
+
+
+def test_simplify_trajectories():
+    # A straight drive north with a stop, for two drivers
+    lats = [52.0, 52.001, 52.002, 52.002, 52.002, 52.003, 52.004]
+    df = DataFrame({'driver': ['a'] * 7 + ['b'] * 2,
+                    'route': ['r'] * 7 + [None] * 2,
+                    'datetime': ['2016-01-01T08:00:%02d' % i
+                                 for i in range(9)],
+                    'lat': lats + [52.0, 52.1],
+                    'lng': 13.0})
+
+    simplified, stats = simplify_trajectories(df, tolerance=1,
+                                              stationary_radius=5)
+
+    assert stats['raw_points'] == 9
+    assert stats['points'] == len(simplified) == 6
+    assert stats['max_error'] < 1
+    assert round(stats['length']) == round(stats['raw_length'])
+    assert sorted(simplified['driver']) == ['a'] * 4 + ['b'] * 2
+
+    # The stop from the 3rd to the 5th point keeps its ends, on the line
+    assert list(simplified['datetime'][simplified['driver'] == 'a']) == [
+        '2016-01-01T08:00:00', '2016-01-01T08:00:02', '2016-01-01T08:00:04',
+        '2016-01-01T08:00:06']
+
+
+def test_simplify_keeps_stops():
+    # 100 m apart on a line, with a stop from the 3rd to the 6th point
+    lats = 52.0 + array([0, 100, 200, 202, 199, 201, 300, 400]) / 111195.0
+    lngs = [13.0] * 8
+
+    keep, errors = simplify(lats, lngs, tolerance=5, stationary_radius=10)
+
+    assert list(flatnonzero(keep)) == [0, 2, 5, 7]
+    assert len(errors) == 4
+    assert errors.max() < 5
+
+    # Without a stationary radius, it is just a line
+    keep, _ = simplify(lats, lngs, tolerance=5)
+    assert list(flatnonzero(keep)) == [0, 7]
@@ -0,0 +1,106 @@
+""" Test the fleet cache of the backend jobs. """
+
+
+import json
+
+import pytest
+
+
+class Backend(object):
+    """ A backend listing its fleets two per page. """
+
+    def __init__(self, fleets, fleet_uuids):
+        self.fleets = fleets
+        self.fleet_uuids = list(fleet_uuids)
+        self.urls = []
+
+    def get_json(self, url):
+        self.urls.append(url)
+
+        fleets_url = self.fleets.FLEETS_URL
+        if url.startswith(fleets_url + '?cursor='):
+            page = int(url.rsplit('=', 1)[1])
+        elif url == fleets_url:
+            page = 0
+        else:
+            fleet_uuid = url[len(fleets_url):]
+            return {'uuid': fleet_uuid, 'name': fleet_uuid,
+                    'modified_at': '2016-03-0%sT10:00:00+00:00' % len(
+                        fleet_uuid)}
+
+        items = self.fleet_uuids[2 * page:2 * page + 2]
+        more = 2 * page + 2 < len(self.fleet_uuids)
+        return {'items': items, 'more': more, 'cursor': page + 1}
+
+    def fetched(self):
+        """ Return the fleets fetched, one by one. """
+        fleets_url = self.fleets.FLEETS_URL
+        return sorted(url[len(fleets_url):] for url in self.urls
+                      if '?' not in url and url != fleets_url)
+
+
+@pytest.fixture
+def fleets(script):
+    return script('get_fleets_from_backend')
+
+
+@pytest.fixture
+def clock(fleets, tmpdir, monkeypatch):
+    monkeypatch.setattr(fleets, 'CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(fleets, 'CACHE_FILE', str(tmpdir.join('fleets.json')))
+
+    now = [1000000.0]
+    monkeypatch.setattr(fleets.time, 'time', lambda: now[0])
+    return now
+
+
+def test_cache_ttl(fleets, clock):
+    backend = Backend(fleets, ['a', 'bb', 'ccc'])
+
+    fleets_dict = fleets.download_data(backend)
+    assert sorted(fleets_dict) == ['a', 'bb', 'ccc']
+    assert backend.fetched() == ['a', 'bb', 'ccc']
+
+    # Fresh: read from the cache file alone
+    backend.urls = []
+    clock[0] += fleets.CACHE_TTL - 1
+    assert fleets.download_data(backend) == fleets_dict
+    assert backend.urls == []
+
+    # Stale: the list is checked and only the new fleets are fetched,
+    # while the fleets no longer listed drop out
+    backend.fleet_uuids = ['bb', 'ccc', 'dddd']
+    clock[0] += 1
+    fleets_dict = fleets.download_data(backend)
+    assert sorted(fleets_dict) == ['bb', 'ccc', 'dddd']
+    assert backend.fetched() == ['dddd']
+
+    with open(fleets.CACHE_FILE) as f:
+        cache = json.load(f)
+    assert cache['fleets'] == fleets_dict
+    assert cache['checked_at'] == clock[0]
+    assert cache['refreshed_at'] == clock[0] - fleets.CACHE_TTL
+    assert cache['modified_at'] == '2016-03-04T10:00:00+00:00'
+
+
+def test_full_refresh(fleets, clock):
+    backend = Backend(fleets, ['a', 'bb'])
+    fleets.download_data(backend)
+
+    backend.urls = []
+    fleets.download_data(backend, refresh=True)
+    assert backend.fetched() == ['a', 'bb']
+
+    backend.urls = []
+    clock[0] += fleets.FULL_REFRESH_AGE
+    fleets.download_data(backend)
+    assert backend.fetched() == ['a', 'bb']
+
+
+def test_corrupt_cache(fleets, clock):
+    with open(fleets.CACHE_FILE, 'w') as f:
+        f.write('{"checked_at": ')
+
+    backend = Backend(fleets, ['a'])
+    assert sorted(fleets.download_data(backend)) == ['a']
+    assert backend.fetched() == ['a']
@@ -0,0 +1,129 @@
+""" Test the time shards of the tracking points extraction. """
+
+
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+Shard = namedtuple('Shard', 'shard_start shard_stop cursor points done')
+
+SIX_HOURS = timedelta(hours=6)
+
+
+@pytest.fixture
+def tracking_points(cronjob):
+    return cronjob('get_tracking_points')
+
+
+def day(hour, minute=0, date=1):
+    return datetime(2016, 3, date, hour, minute)
+
+
+def test_split_interval(tracking_points):
+    split_interval = tracking_points.split_interval
+
+    # On the grid of the shard length, clipped to the interval
+    assert split_interval(day(3), day(20), SIX_HOURS) == [
+        (day(3), day(6)), (day(6), day(12)), (day(12), day(18)),
+        (day(18), day(20))]
+    assert split_interval(day(0), day(12), SIX_HOURS) == [
+        (day(0), day(6)), (day(6), day(12))]
+    assert split_interval(day(1, 30), day(1, 45), SIX_HOURS) == [
+        (day(1, 30), day(1, 45))]
+    assert split_interval(day(12), day(12), SIX_HOURS) == []
+
+    # Lengths that do not divide a day are on the grid since the epoch
+    five_hours = timedelta(hours=5)
+    shards = split_interval(day(20), day(4, date=3), five_hours)
+    assert shards[0][0] == day(20) and shards[-1][1] == day(4, date=3)
+    assert all(shard_stop - shard_start <= five_hours and
+               shard_start < shard_stop for shard_start, shard_stop in shards)
+    epoch = tracking_points.EPOCH
+    assert all((shard_stop - epoch) % five_hours == timedelta()
+               for _, shard_stop in shards[:-1])
+
+    utc = timezone.utc
+    assert split_interval(day(3).replace(tzinfo=utc),
+                          day(7).replace(tzinfo=utc), SIX_HOURS) == [
+        (day(3).replace(tzinfo=utc), day(6).replace(tzinfo=utc)),
+        (day(6).replace(tzinfo=utc), day(7).replace(tzinfo=utc))]
+
+
+class Connection(object):
+
+    def __init__(self, module, recorded):
+        self.module = module
+        self.recorded = recorded
+        self.added = []
+
+    def execute(self, statement, parameters=None):
+        if statement == self.module.GET_SHARDS:
+            return [row for row in self.recorded
+                    if row.shard_start < parameters['stop'] and
+                    row.shard_stop > parameters['start']]
+        if statement == self.module.ADD_SHARD:
+            self.added.append((parameters['shard_start'],
+                               parameters['shard_stop']))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class Warehouse(object):
+    """ A warehouse with shards recorded by earlier runs. """
+
+    def __init__(self, module, recorded):
+        self.connection = Connection(module, recorded)
+
+    @property
+    def db(self):
+        return self
+
+    def begin(self):
+        return self.connection
+
+
+def test_plan_shards(tracking_points):
+    dwh = Warehouse(tracking_points, [])
+
+    todo = tracking_points.plan_shards(dwh, day(3), day(13), SIX_HOURS)
+
+    assert dwh.connection.added == [(day(3), day(6)), (day(6), day(12)),
+                                    (day(12), day(13))]
+    assert todo == [(day(3), day(6), None), (day(6), day(12), None),
+                    (day(12), day(13), None)]
+
+
+def test_plan_shards_rerun(tracking_points):
+    # A first run from 3:00 to 13:00, stopped in the middle
+    recorded = [Shard(day(3), day(6), None, 10, True),
+                Shard(day(6), day(12), 'abc', 5, False),
+                Shard(day(12), day(13), None, 0, False)]
+    dwh = Warehouse(tracking_points, recorded)
+
+    # Rerun over a larger interval, with other bounds
+    todo = tracking_points.plan_shards(dwh, day(0), day(20), SIX_HOURS)
+
+    # The recorded shards are kept, the gaps are cut on the grid
+    assert dwh.connection.added == [(day(0), day(3)), (day(13), day(18)),
+                                    (day(18), day(20))]
+    assert todo == [(day(0), day(3), None), (day(6), day(12), 'abc'),
+                    (day(12), day(13), None), (day(13), day(18), None),
+                    (day(18), day(20), None)]
+
+
+def test_plan_shards_inside_recorded(tracking_points):
+    recorded = [Shard(day(0), day(6), None, 10, True),
+                Shard(day(6), day(12), 'abc', 5, False)]
+    dwh = Warehouse(tracking_points, recorded)
+
+    # An interval within recorded shards resumes them as they are
+    todo = tracking_points.plan_shards(dwh, day(4), day(8), SIX_HOURS)
+
+    assert dwh.connection.added == []
+    assert todo == [(day(6), day(12), 'abc')]
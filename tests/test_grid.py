@@ -0,0 +1,74 @@
+""" Test the occupancy grid. """
+
+
+from datetime import date, datetime
+
+from common.grid import OccupancyGrid
+
+
+def test_fractional_slots():
+    grid = OccupancyGrid(date(2016, 1, 1), date(2016, 1, 1), ['a', 'b'])
+    grid.add([datetime(2016, 1, 1, 10, 30)],
+             [datetime(2016, 1, 1, 12, 15)], ['a'])
+
+    assert list(grid.values[0, 2:5, 0]) == [0.5, 1.0, 0.25]
+    assert grid.values[:, :, 1].sum() == 0
+    assert grid.values.sum() == 1.75
+
+
+def test_within_one_slot():
+    grid = OccupancyGrid(date(2016, 1, 1), date(2016, 1, 1), ['a'])
+    grid.add([datetime(2016, 1, 1, 9, 15)],
+             [datetime(2016, 1, 1, 9, 45)], ['a'])
+
+    assert grid.values[0, 1, 0] == 0.5
+    assert grid.values.sum() == 0.5
+
+
+def test_crosses_midnight_and_gastro_day():
+    grid = OccupancyGrid(date(2016, 1, 1), date(2016, 1, 2), ['a'])
+    grid.add([datetime(2016, 1, 1, 23), datetime(2016, 1, 2, 7)],
+             [datetime(2016, 1, 2, 1), datetime(2016, 1, 2, 9)],
+             ['a', 'a'])
+
+    # 23:00 and 00:00 are slots 15 and 16 of the 1st gastronomic day
+    assert list(grid.values[0, 15:17, 0]) == [1.0, 1.0]
+    # 7:00 closes the 1st gastronomic day and 8:00 opens the 2nd
+    assert grid.values[0, 23, 0] == 1.0
+    assert grid.values[1, 0, 0] == 1.0
+    assert grid.values.sum() == 4.0
+
+
+def test_unknown_keys_and_outside_grid():
+    grid = OccupancyGrid(date(2016, 1, 1), date(2016, 1, 1), ['a'])
+    dropped = grid.add([datetime(2016, 1, 1, 6), datetime(2016, 1, 1, 10)],
+                       [datetime(2016, 1, 1, 9), datetime(2016, 1, 1, 11)],
+                       ['a', 'z'])
+
+    assert dropped == 1
+    assert grid.values.sum() == 1.0
+
+
+def test_quarter_hour_slots():
+    grid = OccupancyGrid(date(2016, 1, 1), date(2016, 1, 1), ['a'],
+                         slot_minutes=15)
+    grid.add([datetime(2016, 1, 1, 8, 10)],
+             [datetime(2016, 1, 1, 8, 40)], ['a'])
+
+    assert grid.values.shape == (1, 96, 1)
+    assert [round(v, 6) for v in grid.values[0, :3, 0]] == [
+        round(5 / 15, 6), 1.0, round(10 / 15, 6)]
+
+
+def test_to_frame():
+    grid = OccupancyGrid(date(2016, 1, 1), date(2016, 1, 1), ['a', 'b'])
+    grid.add([datetime(2016, 1, 2, 2)], [datetime(2016, 1, 2, 3)], ['b'])
+    df = grid.to_frame('total_active_drivers')
+
+    assert df.shape == (48, 2)
+    assert list(df.columns) == ['actual_datetime', 'total_active_drivers']
+    assert df.index[0] == (datetime(2016, 1, 1, 8), 'a')
+
+    row = df.loc[(datetime(2016, 1, 1, 2), 'b')]
+    assert row['actual_datetime'] == datetime(2016, 1, 2, 2)
+    assert row['total_active_drivers'] == 1.0
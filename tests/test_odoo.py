@@ -0,0 +1,100 @@
+""" Test the paged reads of the Odoo connector. """
+
+
+import threading
+import time
+
+from connectors.odoo import OdooConnector
+
+
+class Client(object):
+    """ An erppeek client over a table of records with ids 1 to size.
+
+    The first pages are the slowest to read, so that pages complete out of
+    order.
+    """
+
+    def __init__(self, server, size):
+        self.server = server
+        self.size = size
+        self.thread = threading.current_thread()
+
+    def search(self, table, filters, order=None):
+        self.server.searches.append((table, filters, order))
+        return list(range(1, self.size + 1))
+
+    def execute(self, table, method, ids, fields=None):
+        # Each client is only used by the thread it was created in
+        assert threading.current_thread() is self.thread
+        self.server.reads.append((ids[0], fields))
+        time.sleep(0.01 * max(0, 4 - ids[0] // 10))
+        return [{'id': record_id, 'name': 'record %s' % record_id}
+                for record_id in ids]
+
+
+class Server(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.clients = []
+        self.searches = []
+        self.reads = []
+
+    def connect(self):
+        client = Client(self, self.size)
+        self.clients.append(client)
+        return client
+
+
+def connector(server):
+    # Skip the constructor, which reads the configuration and logs in
+    odoo = OdooConnector.__new__(OdooConnector)
+    odoo.db = server.connect()
+    odoo._authenticate = server.connect
+    return odoo
+
+
+def test_extract_iter_pages():
+    server = Server(95)
+    odoo = connector(server)
+
+    chunks = list(odoo.extract_iter('res.partner', [('active', '=', True)],
+                                    ['name'], page_size=10, workers=3))
+
+    assert [len(chunk) for chunk in chunks] == [10] * 9 + [5]
+    assert server.searches == [('res.partner', [('active', '=', True)], 'id')]
+    assert sorted(first for first, _ in server.reads) == \
+        list(range(1, 96, 10))
+    assert all(fields == ['name'] for _, fields in server.reads)
+
+    # In id order, whatever the order the pages were read in
+    assert [record_id for chunk in chunks for record_id in chunk['id']] == \
+        list(range(1, 96))
+
+    # One client per worker thread, besides the one searching
+    workers = server.clients[1:]
+    assert 1 <= len(workers) <= 3
+    assert len({client.thread for client in workers}) == len(workers)
+
+
+def test_extract_iter_reads_ahead():
+    server = Server(100)
+    odoo = connector(server)
+
+    chunks = odoo.extract_iter('res.partner', page_size=10, workers=2)
+    first = next(chunks)
+
+    # Two pages per worker are read ahead, one more once a page is taken
+    assert list(first['id']) == list(range(1, 11))
+    time.sleep(0.1)
+    assert len(server.reads) == 5
+    assert [fields for _, fields in server.reads] == [None] * 5
+
+    assert sum(len(chunk) for chunk in chunks) == 90
+
+
+def test_extract_without_records():
+    odoo = connector(Server(0))
+
+    assert list(odoo.extract_iter('res.partner')) == []
+    assert odoo.extract('res.partner').empty
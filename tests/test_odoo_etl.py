@@ -0,0 +1,45 @@
+""" Test the Odoo ETL wizard. """
+
+
+from datetime import datetime
+
+from pandas import DataFrame
+
+
+class Warehouse(object):
+    schema = 'odoo'
+
+    def __init__(self):
+        self.loads = []
+
+    def bulk_load(self, df, table, schema, mode='append', key=None,
+                  **options):
+        assert mode != 'merge' or key, 'A merge needs a key'
+        self.loads.append((table, mode, key, len(df)))
+        return len(df)
+
+
+def test_incremental_load_merges_by_id(cronjob):
+    odoo_etl_wizard = cronjob('odoo_etl_wizard')
+
+    # Skip the constructor, which connects to Odoo
+    etl = odoo_etl_wizard.OdooETL.__new__(odoo_etl_wizard.OdooETL)
+    etl.dwh = Warehouse()
+    etl.dwh_table = 'hr_employee'
+    etl.db_echo = False
+    etl.db_chunksize = 10000
+    etl.db_mode = 'merge'
+    etl.incremental = True
+    etl.column_types = {}
+    etl.df = DataFrame({'id': [1, 2],
+                        'write_date': [datetime(2016, 3, 1),
+                                       datetime(2016, 3, 2)]})
+
+    watermarks = []
+    etl.write_watermark = lambda **kwargs: watermarks.append(kwargs)
+    etl.grant_access = lambda: None
+
+    etl.load()
+
+    assert etl.dwh.loads == [('hr_employee', 'merge', 'id', 2)]
+    assert watermarks == [{'write_date': datetime(2016, 3, 2)}]
@@ -0,0 +1,212 @@
+""" Test the SQL connectors without a server. """
+
+
+from datetime import datetime
+from io import StringIO
+
+import pytest
+
+from pandas import DataFrame
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+
+from connectors.sql import COPY_NULL, BaseSQLConnector, is_preparable
+
+
+def sqlite_connector():
+    # Skip the constructor, which reads the connector configuration
+    connector = BaseSQLConnector.__new__(BaseSQLConnector)
+    connector.config = {}
+    connector.db = create_engine('sqlite://')
+    return connector
+
+
+def test_is_preparable():
+    assert is_preparable('SELECT * FROM {table_} WHERE id = %(id)s;')
+    assert is_preparable('-- The last one\nWITH t AS (SELECT 1) SELECT 1')
+    assert not is_preparable('CREATE TABLE IF NOT EXISTS t (id INT);')
+    assert not is_preparable('GRANT SELECT ON t TO valkfleet_ro;')
+    assert not is_preparable('DELETE FROM t; INSERT INTO t VALUES (1);')
+
+
+def test_execute_without_rows():
+    connector = sqlite_connector()
+
+    assert connector.execute('CREATE TABLE {table_} (id INT)',
+                             table_='events').empty
+    assert connector.execute('INSERT INTO events VALUES (:id)',
+                             {'id': 1}).empty
+
+    df = connector.execute('SELECT id FROM {table_}', table_='events')
+    assert list(df['id']) == [1]
+
+
+def points_connector(*rows):
+    connector = sqlite_connector()
+    connector.execute('CREATE TABLE points (id INT, lat REAL, active BOOLEAN, '
+                      'driver TEXT)')
+    for row in rows:
+        connector.execute('INSERT INTO points VALUES (:id, :lat, :active, '
+                          ':driver)', dict(zip(('id', 'lat', 'active',
+                                                'driver'), row)))
+    return connector
+
+
+def test_execute_iter():
+    connector = points_connector((1, 52.5, True, 'a'), (2, 52.6, False, None),
+                                 (3, None, True, 'c'), (4, 52.7, False, 'd'),
+                                 (5, 52.8, True, None))
+
+    chunks = list(connector.execute_iter(
+        'SELECT * FROM {table_} WHERE id >= :first ORDER BY id',
+        {'first': 1}, chunksize=2, table_='points'))
+
+    assert [list(chunk['id']) for chunk in chunks] == [[1, 2], [3, 4], [5]]
+    for chunk in chunks:
+        assert list(chunk.columns) == ['id', 'lat', 'active', 'driver']
+        assert chunk.dtypes.equals(chunks[0].dtypes)
+    assert chunks[0]['id'].dtype.kind == 'i'
+    assert chunks[1]['lat'].isnull().tolist() == [True, False]
+
+    assert list(connector.execute_iter('SELECT * FROM points WHERE id > 5')) \
+        == []
+
+
+def test_execute_iter_keeps_dtypes():
+    connector = points_connector((1, 52.5, True, 'a'), (2, 52.6, False, 'b'),
+                                 (None, 52.7, True, 'c'))
+
+    # A NULL in a column of integers cannot keep its dtype
+    chunks = connector.execute_iter('SELECT * FROM points ORDER BY lat',
+                                    chunksize=2)
+    assert list(next(chunks)['id']) == [1, 2]
+    with pytest.raises(ValueError):
+        next(chunks)
+
+
+class Cursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+
+    def execute(self, statement, parameters=None):
+        self.connection.statements.append(statement)
+
+    def copy_expert(self, statement, f):
+        self.connection.statements.append(statement)
+        self.connection.copied.append(f.read())
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.statements = []
+        self.copied = []
+        self.commits = 0
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Postgres(object):
+    """ An engine that hands out one fake raw connection. """
+
+    dialect = postgresql.dialect()
+
+    def __init__(self):
+        self.connection = Connection()
+
+    def raw_connection(self):
+        return self.connection
+
+
+def postgres_connector():
+    connector = BaseSQLConnector.__new__(BaseSQLConnector)
+    connector.config = {}
+    connector.db = Postgres()
+    return connector
+
+
+def test_to_copy_frame():
+    df = DataFrame({'id': [1.0, None, 3.0],
+                    'active': [True, False, True],
+                    'at': [datetime(2016, 3, 1, 12, 30), None,
+                           datetime(2016, 3, 1, 14, 0, 5)],
+                    'name': ['a', None, '']},
+                   columns=['id', 'active', 'at', 'name'])
+    connector = postgres_connector()
+    column_types = connector._column_types(df, {'id': 'INTEGER'})
+
+    assert list(column_types.values()) == ['INTEGER', 'BOOLEAN', 'TIMESTAMP',
+                                           'TEXT']
+    copy_frame = connector._to_copy_frame(df, column_types)
+    assert list(copy_frame['id']) == [1, None, 3]
+    assert df['id'].dtype.kind == 'f'
+
+    # NULLs are \\N, so that empty fields remain empty strings
+    with StringIO() as f:
+        copy_frame.to_csv(f, header=False, index=False, na_rep=COPY_NULL)
+        assert f.getvalue().splitlines() == [
+            '1,True,2016-03-01 12:30:00,a',
+            '\\N,False,\\N,\\N',
+            '3,True,2016-03-01 14:00:05,']
+
+
+def test_bulk_load_merge():
+    df = DataFrame({'id': [1, 2, 1], 'day': ['2016-03-01'] * 3,
+                    'deliveries': [10, 20, 11]},
+                   columns=['id', 'day', 'deliveries'])
+    connector = postgres_connector()
+
+    loaded = connector.bulk_load(df, 'daily', 'tableau', mode='merge',
+                                 key=['id', 'day'])
+
+    connection = connector.db.connection
+    create, staging, copy, update, insert = connection.statements
+    assert loaded == 2
+    assert create == ('CREATE TABLE IF NOT EXISTS "tableau"."daily" ('
+                      '"id" BIGINT, "day" TEXT, "deliveries" BIGINT);')
+    assert 'CREATE TEMPORARY TABLE bulk_load_staging\n' in staging
+    assert 'FROM "tableau"."daily"\nWITH NO DATA;' in staging
+    assert copy == ('COPY bulk_load_staging ("id", "day", "deliveries") '
+                    "FROM STDIN WITH CSV NULL '\\N';")
+    assert 'SET "deliveries" = staging."deliveries"\n' in update
+    assert 'WHERE target."id" = staging."id" AND ' \
+        'target."day" = staging."day";' in update
+    assert 'INSERT INTO "tableau"."daily" ("id", "day", "deliveries")' in \
+        insert
+    assert '    WHERE target."id" = staging."id" AND ' \
+        'target."day" = staging."day"\n);' in insert
+    assert connection.commits == 1
+
+    # The last version of a row wins
+    assert connection.copied == ['2,2016-03-01,20\n1,2016-03-01,11\n']
+
+
+def test_bulk_load_merge_needs_a_key():
+    with pytest.raises(AssertionError):
+        postgres_connector().bulk_load(DataFrame({'id': [1]}), 'daily',
+                                       'tableau', mode='merge')
+
+
+def test_merge_staging_with_key_columns_only():
+    connector = postgres_connector()
+    connection = connector.db.connection
+
+    connector._merge_staging(connection.cursor(), '"tableau"."seen"',
+                             ['id'], ['id'])
+
+    # Nothing to update: only the missing rows are inserted
+    assert len(connection.statements) == 1
+    assert connection.statements[0].startswith(
+        '\nINSERT INTO "tableau"."seen" ("id")\n')
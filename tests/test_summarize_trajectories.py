@@ -0,0 +1,119 @@
+""" Test the trajectory summaries job. """
+
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from pandas import DataFrame
+
+
+def points(driver, route, start, count):
+    # One point every ten seconds, moving north by 100 metres
+    return [{'driver': driver,
+             'route': route,
+             'shift': 's-' + driver,
+             'datetime': start + timedelta(seconds=i * 10),
+             'lat': 52 + i * 100 / 111195.0,
+             'lng': 13.0}
+            for i in range(count)]
+
+
+class Result(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+
+class Warehouse(object):
+    """ A warehouse streaming points in chunks of three rows, in driver
+    order, and counting the simplified shards it is given.
+    """
+
+    def __init__(self, rows, simplified=0):
+        self.rows = sorted(rows, key=lambda row: row['driver'])
+        self.simplified = simplified
+        self.chunks = []
+        self.loads = []
+
+    @property
+    def db(self):
+        return self
+
+    def begin(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, statement, parameters=None):
+        return Result(self.simplified)
+
+    def execute_iter(self, statement, parameters=None):
+        for start in range(0, len(self.rows), 3):
+            chunk = DataFrame(self.rows[start:start + 3])
+            self.chunks.append(chunk)
+            yield chunk
+
+    def bulk_load(self, df, table, schema, mode='append', key=None):
+        self.loads.append((table, mode, key, df))
+        return len(df)
+
+
+@pytest.fixture
+def summaries(cronjob):
+    return cronjob('summarize_trajectories')
+
+
+def test_iter_drivers(summaries):
+    start = datetime(2016, 1, 1, 12)
+    dwh = Warehouse(points('a', 'r1', start, 4) + points('b', 'r2', start, 1) +
+                    points('c', 'r3', start, 2))
+
+    drivers = list(summaries.iter_drivers(dwh, start, start))
+
+    # Whole drivers, whatever the chunks: a, a, a | a, b, c | c
+    assert [list(frame['driver']) for frame in drivers] == [
+        ['a'] * 4 + ['b'], ['c'] * 2]
+    assert list(drivers[0]['datetime'][:4]) == [
+        start + timedelta(seconds=i * 10) for i in range(4)]
+
+
+def test_summarize_by_driver_chunks(summaries, monkeypatch):
+    start = datetime(2016, 1, 1, 12)
+    dwh = Warehouse(points('a', 'r1', start, 4) +
+                    points('a', 'r0', start - timedelta(hours=1), 2) +
+                    points('b', 'r2', start, 3))
+    monkeypatch.setattr(summaries, 'WarehouseConnector', lambda: dwh)
+
+    summaries.summarize_trajectories(start, datetime(2016, 1, 2))
+
+    loads = {table: (mode, key, df) for table, mode, key, df in dwh.loads}
+    assert sorted(loads) == ['driver_day_trajectory', 'route_trajectory',
+                             'shift_trajectory']
+
+    # The route before the interval is read, but not summarized
+    mode, key, routes = loads['route_trajectory']
+    assert (mode, key) == ('merge', ['route', 'driver'])
+    assert sorted(routes['route']) == ['r1', 'r2']
+    assert sorted(routes['points']) == [3, 4]
+    assert routes['computed_at'].nunique() == 1
+
+    _, _, days = loads['driver_day_trajectory']
+    assert sorted(days['points']) == [3, 6]
+
+
+def test_refuse_simplified_points(summaries, monkeypatch):
+    start = datetime(2016, 1, 1, 12)
+    dwh = Warehouse(points('a', 'r1', start, 4), simplified=2)
+    monkeypatch.setattr(summaries, 'WarehouseConnector', lambda: dwh)
+
+    with pytest.raises(ValueError):
+        summaries.summarize_trajectories(start, start + timedelta(hours=1))
+    assert dwh.chunks == [] and dwh.loads == []
@@ -0,0 +1,62 @@
+""" Test the trajectory metrics. """
+
+
+from datetime import datetime, timedelta
+
+from pandas import DataFrame
+
+from common.trajectory_metrics import summarize, summarize_driver_days
+
+
+def points(route, driver, start, positions, seconds=10):
+    # One point every ten seconds, moving north by the given metres
+    return [{'route': route,
+             'driver': driver,
+             'datetime': start + timedelta(seconds=i * seconds),
+             'lat': 52 + metres / 111195.0,
+             'lng': 13.0}
+            for i, metres in enumerate(positions)]
+
+
+def test_distance_and_speed():
+    start = datetime(2016, 1, 1, 12)
+    # 100 metres in 10 seconds is 36 km/h
+    df = DataFrame(points('r1', 'd1', start, [0, 100, 200, 300]) +
+                   points('r2', 'd1', start, [0, 50]))
+
+    summary = summarize(df.iloc[::-1], ['route']).set_index('route')
+
+    assert list(summary.loc[['r1', 'r2'], 'points']) == [4, 2]
+    assert round(summary.loc['r1', 'distance']) == 300
+    assert summary.loc['r1', 'duration'] == 30
+    assert round(summary.loc['r1', 'speed_p50'], 1) == 36.0
+    assert round(summary.loc['r2', 'speed_max'], 1) == 18.0
+    assert summary.loc['r1', 'start'] == start
+
+
+def test_stops_and_gaps():
+    start = datetime(2016, 1, 1, 12)
+    # Moves, waits 2 minutes, moves, loses the signal for 10 minutes
+    positions = [0, 100] + [100] * 12 + [200]
+    df = DataFrame(points('r1', 'd1', start, positions) +
+                   points('r1', 'd1', start + timedelta(minutes=15), [800]))
+
+    summary = summarize(df, ['route']).iloc[0]
+
+    assert summary['stops'] == 1
+    assert summary['idle_time'] == 120
+    assert summary['moving_time'] == 20
+    assert summary['gap_time'] == 760
+    assert round(summary['distance']) == 800
+
+
+def test_driver_days():
+    df = DataFrame(points('r1', 'd1', datetime(2016, 1, 1, 23, 59, 50),
+                          [0, 100, 200]) +
+                   points(None, 'd2', datetime(2016, 1, 1, 12), [0]))
+
+    summary = summarize_driver_days(df)
+
+    assert list(summary['driver']) == ['d1', 'd1', 'd2']
+    assert list(summary['points']) == [1, 2, 1]
+    assert list(summary['stops']) == [0, 0, 0]
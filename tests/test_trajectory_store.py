@@ -0,0 +1,104 @@
+""" Test the trajectory store. """
+
+
+from datetime import date, datetime
+from os import listdir
+
+from numpy import memmap
+from pandas import DataFrame
+
+from common.trajectory_store import TrajectoryStore
+
+
+def make_points(driver, route, hours, day=1):
+    return DataFrame({'driver': driver,
+                      'route': route,
+                      'datetime': ['2016-01-%02dT%02d:00:00Z' % (day, hour)
+                                   for hour in hours],
+                      'lat': [52.0 + hour / 100 for hour in hours],
+                      'lng': 13.0,
+                      'speed': 10.0,
+                      'battery': 0.5})
+
+
+def test_append_compact_and_query(tmpdir):
+    store = TrajectoryStore(str(tmpdir))
+    store.append(make_points('b', 'r2', [9, 10]))
+    store.append(make_points('a', 'r1', [8, 11]))
+    store.append(make_points('a', None, [12]))
+
+    assert store.days() == []
+    assert store.compact(date(2016, 1, 1)) == 5
+    assert store.days() == [date(2016, 1, 1)]
+    assert store.drivers(date(2016, 1, 1)) == ['a', 'b']
+    assert store.routes(date(2016, 1, 1)) == ['r1', 'r2']
+
+    points = store.driver_day('a', date(2016, 1, 1))
+    assert len(points) == 3
+    assert isinstance(points, memmap)
+    assert list(points['lat'].round(2)) == [52.08, 52.11, 52.12]
+
+    route = store.route('r2')
+    assert len(route) == 1
+    assert list(route[0]['lat'].round(2)) == [52.09, 52.10]
+
+
+def test_compact_drops_duplicates_and_merges(tmpdir):
+    store = TrajectoryStore(str(tmpdir))
+    store.append(make_points('a', 'r1', [8, 9]))
+    store.compact(date(2016, 1, 1))
+
+    # A resumed extraction sends a point again, plus a new one
+    store.append(make_points('a', 'r1', [9, 10]))
+    assert store.compact(date(2016, 1, 1)) == 3
+    assert store.compact(date(2016, 1, 1)) == 3
+
+
+def test_driver_range_across_days(tmpdir):
+    store = TrajectoryStore(str(tmpdir))
+    store.append(make_points('a', 'r1', [20, 22]))
+    store.append(make_points('a', 'r1', [1, 3], day=2))
+    store.append(make_points('b', 'r9', [2], day=2))
+    store.compact(date(2016, 1, 1))
+    store.compact(date(2016, 1, 2))
+
+    views = store.driver_range('a', datetime(2016, 1, 1, 21),
+                               datetime(2016, 1, 2, 3))
+    assert [len(view) for view in views] == [1, 1]
+    assert store.driver_range('c', datetime(2016, 1, 1),
+                              datetime(2016, 1, 3)) == []
+
+
+def test_segments_appear_whole(tmpdir):
+    store = TrajectoryStore(str(tmpdir))
+    store.append(make_points('a', 'r1', [8, 9]))
+
+    folder = tmpdir.join('2016-01-01')
+    [segment] = listdir(str(folder))
+    assert segment.startswith('segment-') and segment.endswith('.npz')
+
+    # A segment being written by another extraction is left alone
+    folder.join('.segment-0123.partial').write(b'PK')
+    assert store.compact(date(2016, 1, 1)) == 2
+    files = sorted(listdir(str(folder)))
+    assert files[:3] == ['.lock', '.segment-0123.partial', 'index.json']
+    assert len(files) == 4 and files[3].startswith('points-')
+
+
+def test_compacted_frame_labels(tmpdir):
+    store = TrajectoryStore(str(tmpdir))
+    store.append(make_points('b', 'r2', [9, 10]))
+    store.append(make_points('a', 'r1', [8]))
+    store.append(make_points('a', None, [12]))
+    store.compact(date(2016, 1, 1))
+
+    df = store._compacted_frame(date(2016, 1, 1))
+
+    assert list(df['driver']) == ['a', 'a', 'b', 'b']
+    assert list(df['route']) == ['r1', '', 'r2', 'r2']
+
+    # Compacting again keeps the labels of the compacted points
+    store.append(make_points('b', 'r3', [11]))
+    store.compact(date(2016, 1, 1))
+    assert store.routes(date(2016, 1, 1)) == ['r1', 'r2', 'r3']
+    assert [len(run) for run in store.route('r2')] == [2]
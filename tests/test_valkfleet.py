@@ -0,0 +1,157 @@
+""" Test the adaptive batch size and the retries of the valkfleet
+connector.
+"""
+
+
+import pytest
+
+from requests import exceptions
+
+from connectors import valkfleet
+from connectors.valkfleet import (AdaptiveBatchSize, ValkfleetAPIError,
+                                  ValkfleetConnector)
+
+
+URL = 'https://api.valkfleet.com/deliveries/'
+
+
+def test_batch_size_grows_and_shrinks():
+    batches = AdaptiveBatchSize(100, min_size=10, max_size=300,
+                                target_latency=4.0, target_bytes=1000)
+
+    # Fast and small full pages double the size, up to the maximum
+    batches.record(100, 1.0, 100)
+    assert batches.size == 200
+    batches.record(200, 1.0, 100)
+    batches.record(300, 1.0, 100)
+    assert batches.size == 300
+
+    # A short page is the last one: it says nothing about the size
+    batches.record(50, 1.0, 100)
+    assert batches.size == 300
+
+    # Neither slow nor fast keeps the size
+    batches.record(300, 3.0, 100)
+    assert batches.size == 300
+
+    # Slow or large pages halve it
+    batches.record(300, 5.0, 100)
+    assert batches.size == 150
+    batches.record(150, 1.0, 1001)
+    assert batches.size == 75
+
+    assert batches.stats == {'pages': 7, 'items': 1400, 'errors': 0,
+                             'changes': 4, 'mean_latency': 1.857,
+                             'batch_size': 75}
+
+
+def test_batch_size_bounds():
+    assert AdaptiveBatchSize(1, min_size=10).size == 10
+    assert AdaptiveBatchSize(10 ** 6, max_size=5000).size == 5000
+    assert AdaptiveBatchSize().size == valkfleet.DEFAULT_BATCH_SIZE
+
+    batches = AdaptiveBatchSize(10, min_size=10, target_latency=4.0)
+    batches.record(10, 5.0, 100)
+    batches.record_error('502 Bad Gateway')
+    assert batches.size == 10
+    assert batches.changes == 0
+
+
+def test_batch_size_holds_after_errors():
+    batches = AdaptiveBatchSize(100, target_latency=4.0, target_bytes=1000)
+
+    batches.record_error('502 Bad Gateway')
+    assert batches.size == 50
+    assert batches.errors == 1
+
+    # No growth for HOLD_PAGES pages, however fast
+    for _ in range(valkfleet.HOLD_PAGES - 1):
+        batches.record(50, 1.0, 100)
+        assert batches.size == 50
+    batches.record(50, 1.0, 100)
+    assert batches.size == 100
+
+
+class Response(object):
+
+    def __init__(self, json, status_code=200, reason='OK'):
+        self._json = json
+        self.status_code = status_code
+        self.reason = reason
+        self.content = b'x' * 100
+
+    def json(self):
+        return self._json
+
+
+class Session(object):
+    """ A requests session answering with the responses given, in order,
+    where an exception is raised.
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.params = []
+
+    def get(self, url, params=None, timeout=None):
+        self.params.append(dict(params))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def connector(*responses):
+    # Skip the constructor, which reads the configuration and logs in
+    valkfleet_conn = ValkfleetConnector.__new__(ValkfleetConnector)
+    valkfleet_conn.db = Session(*responses)
+    return valkfleet_conn
+
+
+def page(items, cursor=None):
+    return Response({'items': items, 'more': cursor is not None,
+                     'cursor': cursor})
+
+
+def test_iter_cursor_retries():
+    valkfleet_conn = connector(
+        page([1, 2], 'a'),
+        Response(None, 502, 'Bad Gateway'),
+        exceptions.ReadTimeout('Read timed out'),
+        page([3], None))
+
+    pages = list(valkfleet_conn.iter_cursor(URL, batch_size=100))
+
+    assert pages == [([1, 2], 'a'), ([3], None)]
+    # Each failure halves the batch of the retry, from the same cursor
+    assert [params['batch_size'] for params in valkfleet_conn.db.params] == \
+        [100, 100, 50, 25]
+    assert [params.get('cursor') for params in valkfleet_conn.db.params] == \
+        [None, 'a', 'a', 'a']
+
+
+def test_iter_cursor_gives_up():
+    valkfleet_conn = connector(
+        page([1], 'a'),
+        Response({'error': {}}),
+        Response({'error': 'Cursor expired', 'items': []}),
+        Response(None, 503, 'Service Unavailable'),
+        page([2], None))
+
+    pages = valkfleet_conn.iter_cursor(URL, cursor='start', batch_size=100)
+    assert next(pages) == ([1], 'a')
+
+    # An error, even an empty one, is a failure
+    with pytest.raises(ValkfleetAPIError) as err:
+        next(pages)
+    assert '503 Service Unavailable' in str(err.value)
+    assert len(valkfleet_conn.db.params) == valkfleet.MAX_RETRIES + 1
+
+
+def test_failures_in_a_row():
+    # The count of failures starts over after a page
+    errors = [Response({'error': 'busy'})] * (valkfleet.MAX_RETRIES - 1)
+    valkfleet_conn = connector(*(errors + [page([1], 'a')] +
+                                 errors + [page([2], None)]))
+
+    assert list(valkfleet_conn.iter_pages(URL)) == [[1], [2]]